@@ -102,11 +102,17 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'booking.metrics.MetricsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'booking.instrumentation.QueryBudgetMiddleware',
+    'booking.instrumentation.RepeatedQueriesMiddleware',
+    # Refreshes Booking.affordable of customers whose cash the request changed,
+    # after the request transaction (see booking/escrow.py).
+    'booking.escrow.AffordableSyncMiddleware',
     # Uncomment the next line for simple clickjacking protection:
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
@@ -157,6 +163,10 @@ LOGGING = {
             'level': 'ERROR',
             'filters': ['require_debug_false'],
             'class': 'django.utils.log.AdminEmailHandler'
+        },
+        'console': {
+            'level': 'WARNING',
+            'class': 'logging.StreamHandler'
         }
     },
     'loggers': {
@@ -165,6 +175,11 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        # Query budget violations (booking.instrumentation)
+        'booking': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+        },
     }
 }
 
@@ -182,3 +197,99 @@ LOGIN_REDIRECT_URL = '/'  # The page you want users to arrive at after they succ
 LOGIN_URL = '/accounts/login/'
 
 INITIAL_CASH = 1100.00
+
+# Lifetime (seconds) of the cached booking rows in the booking list.
+BOOKING_ROW_CACHE_TIMEOUT = 60 * 60
+
+# Number of bookings fetched per query by the streaming booking API.
+BOOKING_API_CHUNK_SIZE = 1000
+
+# Lifetime of cached list counts (CachedCountPaginator), seconds.
+BOOKING_COUNT_CACHE_TIMEOUT = 60
+
+# Ledger entries younger than this (seconds) are left out of balance
+# snapshots, so that entries of still running transactions are not skipped.
+BOOKING_LEDGER_SNAPSHOT_LAG = 5 * 60
+
+# Lifetime of stored responses to POSTs with an Idempotency-Key and of the
+# "in progress" mark of the first request, seconds.
+BOOKING_IDEMPOTENCY_TIMEOUT = 10 * 60
+BOOKING_IDEMPOTENCY_LOCK_TIMEOUT = 30
+
+# Complete bookings through the settlement queue: the request only marks
+# the booking as completing, money is moved by settlement_worker processes
+# in batches of BOOKING_SETTLEMENT_BATCH_SIZE, polling every
+# BOOKING_SETTLEMENT_POLL_INTERVAL seconds when the queue is empty.
+# Only enable it together with a running worker (see README), otherwise
+# completed bookings are never paid out.
+BOOKING_SETTLEMENT_ASYNC = False
+BOOKING_SETTLEMENT_BATCH_SIZE = 100
+BOOKING_SETTLEMENT_POLL_INTERVAL = 1
+
+# Live booking feed: browsers poll for changes of the bookings on the page.
+# A poll with no changes returns at once. With spare workers (several uWSGI
+# processes or gevent) BOOKING_EVENTS_POLL_TIMEOUT > 0 makes it wait up to
+# that many seconds for a change, woken by Postgres NOTIFY on the channel.
+BOOKING_EVENTS_CHANNEL = 'booking_events'
+BOOKING_EVENTS_POLL_TIMEOUT = 0
+
+# Query budgets: the maximum number of SQL statements per view, by URL
+# name. A request over its budget is logged with its query shapes, or
+# raises QueryBudgetExceeded when BOOKING_QUERY_BUDGET_STRICT is set (the
+# test cases turn it on with override_settings). The budgets are the counts
+# measured by the test suite; transitions are measured as AJAX requests with
+# an idempotency key (BookingListQueriesTestCase.test_transition_query_budgets),
+# including the savepoints of the test transaction. Each transition is one
+# conditional statement (plus the hold for approve and the settlement for
+# complete); the rest is authentication, the idempotency key, counters, the
+# feed row and the event. A refused serve costs one more SELECT to tell the
+# reason.
+BOOKING_QUERY_BUDGETS = {
+    'booking-list': 10,
+    'own-booking-list': 10,
+    'booking-detail': 8,
+    'create-booking': 14,
+    'update-booking': 10,
+    'delete-booking': 15,
+    'create-comment': 6,
+    'serve-booking': 15,
+    'approve-booking': 18,
+    'complete-booking': 18,
+    'complete-bookings': 14,
+    'booking-api': 4,
+}
+BOOKING_QUERY_BUDGET_STRICT = False
+
+# N+1 detection (development and tests): SELECT statements of one shape
+# executed at least BOOKING_REPEATED_QUERIES_THRESHOLD times in a request
+# are logged with the project code lines and template tags that issued
+# them, or raise RepeatedQueries when BOOKING_REPEATED_QUERIES_STRICT is
+# set. Walks the stack on every query, so it is off by default.
+BOOKING_REPEATED_QUERIES_DETECTION = False
+BOOKING_REPEATED_QUERIES_THRESHOLD = 3
+BOOKING_REPEATED_QUERIES_STRICT = False
+
+# Benchmark suite (BookingBenchmarkTestCase): configurations to measure as
+# (K customers and K performers, M bookings per customer), measured and
+# warm-up passes over each configuration, a file to write JSON results to,
+# earlier results to compare with and the allowed slowdown of a step's
+# median time against them.
+BOOKING_BENCHMARK_SWEEP = ((5, 1), (10, 2))
+BOOKING_BENCHMARK_REPEAT = 2
+BOOKING_BENCHMARK_WARMUP = 1
+BOOKING_BENCHMARK_OUTPUT = None
+BOOKING_BENCHMARK_BASELINE = None
+BOOKING_BENCHMARK_THRESHOLD = 1.5
+
+# Request metrics in Prometheus text format (/metrics). With several worker
+# processes (uWSGI), each of them saves its metrics into
+# BOOKING_METRICS_DIR at most every BOOKING_METRICS_FLUSH_INTERVAL seconds
+# and /metrics reports the sum over all workers. None - only the metrics of
+# the process serving /metrics. Files of exited workers are removed when a
+# new worker saves its metrics for the first time.
+BOOKING_METRICS_DIR = None
+BOOKING_METRICS_FLUSH_INTERVAL = 5
+# /metrics is only served to these client addresses (REMOTE_ADDR, as passed
+# by nginx) or to requests with "Authorization: Bearer <token>".
+BOOKING_METRICS_ALLOWED_IPS = ('127.0.0.1', '::1')
+BOOKING_METRICS_TOKEN = None
@@ -1,7 +1,29 @@
+// Ключ идемпотентности: повторные нажатия одной кнопки и повторы запроса
+// после обрыва связи отправляются с одним ключом, и сервер выполняет
+// действие один раз
+function idempotencyKey(element) {
+  'use strict';
+  var key = element.data("idempotency-key");
+  if (!key) {
+    key = new Date().getTime().toString(36) + "-" +
+      Math.random().toString(36).substr(2);
+    element.data("idempotency-key", key);
+  }
+  return key;
+}
+
 $(document).ready(function () {
   'use strict';
   var xhr;
 
+  $("td.booking-actions form").on('submit', function () {
+    var form = $(this);
+    if (form.find('input[name="idempotency_key"]').length === 0) {
+      $('<input type="hidden" name="idempotency_key"/>').val(
+        idempotencyKey(form)).appendTo(form);
+    }
+  });
+
   $("button.serve, button.complete").on('click', function (event) {
     event.preventDefault();
     event.stopPropagation();
@@ -27,12 +49,22 @@ $(document).ready(function () {
       type: "POST",
       url: "/booking/" + url_part,
       data: { "id": value, "csrfmiddlewaretoken": csrfmiddlewaretoken },
+      headers: { "Idempotency-Key": idempotencyKey(that) },
       dataType: "json",
       success: function (msg) {
+        if (!msg.success) {
+          // Отказ сервер не сохраняет: повтор - новый запрос с новым ключом
+          that.removeData("idempotency-key");
+        }
         $("div.alert").remove();
         $("div#greeting").after('<div class="alert alert-info">' + msg.request_status + '</div>');
         if (msg.request_status.substr(0, 15) === "Заказ завершен.") {
             that.closest('tr').html('');
+        } else if (msg.status === "completing") {
+            // Суммы расчета придут событием живой ленты
+            that.closest('tr').data("status", "completing");
+            that.closest('tr').find("td.booking-status").text("Завершается");
+            that.closest('form').html('');
         } else {
             that.closest('form').html('');
         }
@@ -44,3 +76,83 @@ $(document).ready(function () {
     });
   });
 });
+
+$(document).ready(function () {
+  'use strict';
+  var table = $("table#booking_list"),
+  // Период опроса изменений заказов, миллисекунды
+  poll_interval = 5000,
+  status_names = {
+    "pending": "Ожидает выполнения",
+    "running": "Исполняется",
+    "completing": "Завершается",
+    "waiting_for_approval": "Ожидает подтверждения",
+    "completed": "Завершен"
+  };
+
+  if (table.length === 0) {
+    return;
+  }
+
+  function update(data) {
+    var row = table.find('tr[data-booking-id="' + data.id + '"]'),
+    old_status = row.data("status");
+
+    if (row.length === 0) {
+      return;
+    }
+    row.data("version", data.version);
+    row.data("status", data.status);
+    if (data.cash_for_system !== undefined && old_status === "completing" &&
+        row.data("relation") === "owner") {
+      // Расчет по заказу, завершенному заказчиком через очередь
+      $("div.alert").remove();
+      $("div#greeting").after($('<div class="alert alert-info"></div>').text(
+        "Заказ завершен. С суммы заказа считана комиссия в размере " +
+        parseFloat(data.cash_for_system) + ". " +
+        parseFloat(data.cash_for_performer) + " переведено исполнителю."));
+    }
+    if (data.removed ||
+        (data.status === "completed" && table.data("page-type") === "all_bookings")) {
+      row.remove();
+      return;
+    }
+    row.find("td.booking-status").text(status_names[data.status] || data.status);
+    if (data.performer !== undefined) {
+      row.find("td.booking-performer").text(data.performer || "Нет");
+    }
+    // Действия, доступные при прежнем статусе, больше не применимы
+    row.find("td.booking-actions").html("");
+    if (data.status === "waiting_for_approval" && row.data("relation") === "owner") {
+      row.find("td.booking-actions").text("Обновите страницу, чтобы подтвердить исполнителя");
+    }
+  }
+
+  // Изменения заказов на странице запрашиваются с сервера, список
+  // обновляется без перезагрузки страницы
+  function poll() {
+    var versions = table.find("tr[data-booking-id]").map(function () {
+      return $(this).data("booking-id") + ":" + $(this).data("version");
+    }).get();
+
+    if (versions.length === 0) {
+      return;
+    }
+    $.ajax({
+      url: "/booking/events/",
+      data: {bookings: versions.join(",")},
+      dataType: "json",
+      cache: false,
+      success: function (msg) {
+        $.each(msg.events, function (i, data) {
+          update(data);
+        });
+      },
+      complete: function () {
+        setTimeout(poll, poll_interval);
+      }
+    });
+  }
+
+  setTimeout(poll, poll_interval);
+});
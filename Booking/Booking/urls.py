@@ -5,6 +5,7 @@ from django.contrib import admin
 from django.contrib.auth import views as auth_views
 
 from .views import HomepageView, user_login, BookingRegistrationView
+from booking.metrics import metrics_view
 
 # Uncomment the next two lines to enable the admin:
 # from django.contrib import admin
@@ -17,6 +18,8 @@ urlpatterns = patterns('',
 
                        url(r'^booking/', include('booking.urls')),
 
+                       url(r'^metrics$', metrics_view, name='metrics'),
+
                        (r'^accounts/login/$', user_login),
                        (r'^accounts/logout/$',
                         'django.contrib.auth.views.logout'),
@@ -16,10 +16,10 @@ from django.contrib import messages
 from django.core.urlresolvers import reverse
 from registration.backends.simple.views import RegistrationView
 from registration.signals import user_registered
-from django.contrib.auth.models import Group
 from django.conf import settings
 
 from booking.models import UserProfile
+from booking.roles import add_role, CUSTOMERS, PERFORMERS
 
 
 class HomepageView(TemplateView):
@@ -97,15 +97,11 @@ def user_registered_callback(sender, user, request, **kwargs):
     user_type = request.POST["user_type"]
 
     if user_type == "customer":
-        customers = Group.objects.get(name="customers")
         # Назначение пользователю группы
-        user.groups.add(customers)
-        user.save()
+        add_role(user, CUSTOMERS)
         UserProfile.objects.create(user=user, cash=settings.INITIAL_CASH)
     else:
-        performers = Group.objects.get(name="performers")
-        user.groups.add(performers)
-        user.save()
+        add_role(user, PERFORMERS)
         UserProfile.objects.create(user=user, cash=settings.INITIAL_CASH)
 
 user_registered.connect(user_registered_callback)
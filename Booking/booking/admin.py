@@ -4,11 +4,101 @@
 Регистрация моделей в админке
 """
 
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
 from .models import UserProfile
 from .models import Booking
 from .models import SystemAccount
+from .models import LedgerEntry
+
+
+class SystemAccountAdmin(admin.ModelAdmin):
+    """
+    Счет системы. Остаток - сумма счета и его частей. Сумма на счету не
+    редактируется: ее меняют только проводки (см. ledger.py).
+    """
+    list_display = ('pk', 'get_balance', 'commission')
+    readonly_fields = ('account', 'get_balance')
+    fields = ('account', 'get_balance', 'commission')
+    actions = ['compact']
+
+    def compact(self, request, queryset):
+        for system_account in queryset:
+            system_account.compact()
+        self.message_user(request, u"Части счетов перенесены на счета")
+    compact.short_description = u"Перенести части счета на счет"
+
+
+class UserProfileForm(forms.ModelForm):
+    """
+    Профиль с исправлением суммы на счету
+    """
+    adjustment = forms.DecimalField(
+        label=u"Исправление суммы", required=False, max_digits=8,
+        decimal_places=2,
+        help_text=u"Зачисляется (или списывается, если меньше нуля) "
+                  u"на счет с записью в журнал операций")
+
+    class Meta:
+        model = UserProfile
+        fields = ('user', 'cash')
+
+    def clean_adjustment(self):
+        adjustment = self.cleaned_data.get('adjustment')
+        if adjustment and self.instance.pk and \
+                self.instance.cash + adjustment < 0:
+            raise forms.ValidationError(u"Недостаточно средств")
+        return adjustment
+
+
+class UserProfileAdmin(admin.ModelAdmin):
+    """
+    Профиль пользователя. Сумма на счету сверяется с журналом операций:
+    задается при создании профиля (начальный остаток), потом меняется
+    только проводками исправления.
+    """
+    form = UserProfileForm
+    list_display = ('user', 'cash', 'held')
+
+    def get_fields(self, request, obj=None):
+        if obj is None:
+            return ('user', 'cash')
+        return ('user', 'cash', 'held', 'adjustment')
+
+    def get_readonly_fields(self, request, obj=None):
+        if obj is None:
+            return ()
+        return ('user', 'cash', 'held')
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            obj.save()
+            return
+        # Строка профиля целиком не сохраняется: сумму на счету и удержания
+        # меняют только проводки
+        adjustment = form.cleaned_data.get('adjustment')
+        if adjustment and obj.post(adjustment,
+                                   LedgerEntry.ADJUSTMENT) is None:
+            self.message_user(request, u"Недостаточно средств",
+                              messages.ERROR)
+
+
+class LedgerEntryAdmin(admin.ModelAdmin):
+    """
+    Журнал операций только для просмотра
+    """
+    list_display = ('id', 'date', 'user', 'kind', 'amount', 'booking')
+    list_filter = ('kind',)
+    readonly_fields = ('user', 'amount', 'kind', 'booking', 'date')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
 
 admin.site.register(Booking)
-admin.site.register(UserProfile)
-admin.site.register(SystemAccount)
+admin.site.register(UserProfile, UserProfileAdmin)
+admin.site.register(SystemAccount, SystemAccountAdmin)
+admin.site.register(LedgerEntry, LedgerEntryAdmin)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+"""
+API ленты заказов.
+
+Заказы отдаются потоком (StreamingHttpResponse) в формате NDJSON - по одному
+JSON-объекту на строку - либо одним JSON-массивом. Строки выбираются из базы
+порциями по ключу (date, id), поэтому выгрузка любого объема идет в
+постоянной памяти, а первые байты ответа уходят клиенту сразу после выборки
+первой порции.
+"""
+
+import json
+
+from django.conf import settings
+from django.contrib.auth.decorators import login_required
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.http import HttpResponse, StreamingHttpResponse
+from django.views.decorators.http import require_GET
+
+from .models import Booking
+from .pagination import UnionKeysetPaginator
+from . import feed
+
+
+# Все незавершенные заказы (как в BookingListView)
+SCOPE_ALL = "all"
+# Заказы, связанные с пользователем (как в OwnBookingListView)
+SCOPE_OWN = "own"
+
+FORMAT_NDJSON = "ndjson"
+FORMAT_JSON = "json"
+
+# Поля выгрузки: имя в ответе - поле values() ленты / таблицы заказов.
+# Заголовок и текст в ленте не хранятся и выбираются из заказа по ключу.
+FEED_FIELDS = (
+    ('id', 'pk'),
+    ('title', 'booking__title'),
+    ('text', 'booking__text'),
+    ('price', 'price'),
+    ('status', 'status'),
+    ('customer', 'customer_username'),
+    ('performer', 'performer_username'),
+    ('date', 'date'),
+)
+BOOKING_FIELDS = (
+    ('id', 'pk'),
+    ('title', 'title'),
+    ('text', 'text'),
+    ('price', 'price'),
+    ('status', 'status'),
+    ('customer', 'customer__username'),
+    ('performer', 'performer__username'),
+    ('date', 'date'),
+)
+
+
+def get_export_queryset(user, scope, statuses):
+    """
+    Выборка заказов для выгрузки, список полей ответа и ветви выборки
+    (см. UnionKeysetPaginator): заказы пользователя - это заказы, где он
+    заказчик, и заказы, где он исполнитель.
+    """
+    if scope == SCOPE_OWN:
+        fields = BOOKING_FIELDS
+        branches = [Q(customer=user), Q(performer=user)]
+        queryset = Booking.objects.all()
+    else:
+        fields = FEED_FIELDS
+        branches = []
+        queryset = feed.get_feed_queryset()
+    if statuses:
+        queryset = queryset.filter(status__in=statuses)
+    return (queryset.values(*[field for name, field in fields]), fields,
+            branches)
+
+
+def iterate_bookings(queryset, fields, chunk_size, branches=()):
+    """
+    Заказы в виде словарей с полями ответа
+    """
+    paginator = UnionKeysetPaginator(queryset, chunk_size, ('date', 'pk'),
+                                     branches)
+    for row in paginator.iterate():
+        yield dict((name, row[field]) for name, field in fields)
+
+
+def ndjson_stream(bookings):
+    for booking in bookings:
+        yield json.dumps(booking, cls=DjangoJSONEncoder) + '\n'
+
+
+def json_stream(bookings):
+    yield '['
+    separator = '\n'
+    for booking in bookings:
+        yield separator + json.dumps(booking, cls=DjangoJSONEncoder)
+        separator = ',\n'
+    yield '\n]\n'
+
+
+def error_response(message):
+    return HttpResponse(json.dumps({'request_status': message}), status=400,
+                        content_type="application/json")
+
+
+@require_GET
+@login_required
+def booking_feed_api_view(request):
+    """
+    Выгрузка заказов.
+
+    GET-параметры:
+    - scope - all (все незавершенные заказы, по умолчанию) либо own
+      (заказы, где пользователь - заказчик или исполнитель);
+    - status - фильтр по статусу, можно указать несколько раз;
+    - format - ndjson (по умолчанию) либо json.
+    """
+    scope = request.GET.get('scope', SCOPE_ALL)
+    if scope not in (SCOPE_ALL, SCOPE_OWN):
+        return error_response(u"Неверный параметр scope")
+
+    output_format = request.GET.get('format', FORMAT_NDJSON)
+    if output_format not in (FORMAT_NDJSON, FORMAT_JSON):
+        return error_response(u"Неверный параметр format")
+
+    statuses = request.GET.getlist('status')
+    known_statuses = [status for status, name in Booking.STATUS_CHOICES]
+    if any(status not in known_statuses for status in statuses):
+        return error_response(u"Неверный статус заказа")
+
+    queryset, fields, branches = get_export_queryset(request.user, scope,
+                                                     statuses)
+    bookings = iterate_bookings(queryset, fields,
+                                settings.BOOKING_API_CHUNK_SIZE, branches)
+    if output_format == FORMAT_JSON:
+        return StreamingHttpResponse(json_stream(bookings),
+                                     content_type="application/json")
+    return StreamingHttpResponse(ndjson_stream(bookings),
+                                 content_type="application/x-ndjson")
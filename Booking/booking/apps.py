@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+
+"""
+Конфигурация приложения заказов
+"""
+
+from django.apps import AppConfig
+
+
+class BookingConfig(AppConfig):
+
+    name = 'booking'
+    verbose_name = u"Заказы"
+
+    def ready(self):
+        # Подключение обработчиков сигналов
+        from . import counters, escrow, events, feed, ledger, roles
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+"""
+Замеры производительности работы с заказами.
+
+Конфигурация замера - K заказчиков и K исполнителей, у каждого заказчика
+M заказов. Каждый заказ проходит шаги STEPS через views (тестовым
+клиентом): просмотр списка заказов исполнителем, создание заказа, взятие
+его исполнителем, подтверждение и завершение заказчиком. Вход пользователей
+и пересчеты, отложенные при их создании (см. escrow.py), выполняются до
+замеров и в них не входят. Переходы заказа выполняются AJAX-запросами: отказ
+в переходе - тоже ответ 200, поэтому шаг проверяет success в ответе JSON, а
+после шагов проверяется статус заказа.
+
+Для каждого шага записываются время (минимум, медиана, 95-й перцентиль,
+максимум, миллисекунды) и число SQL-запросов. Первые warmup проходов не
+учитываются (прогрев кэшей и реестров процесса). Результаты сохраняются в
+JSON, compare() находит шаги, ставшие медленнее сохраненных результатов.
+
+Замеры создают пользователей и заказы, поэтому выполняются только в
+тестовой базе (BookingBenchmarkTestCase).
+"""
+
+import json
+import timeit
+
+from django.contrib.auth.models import User, Group, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .models import Booking, UserProfile
+from . import escrow, roles
+
+
+LIST = "list"
+CREATE = "create"
+SERVE = "serve"
+APPROVE = "approve"
+COMPLETE = "complete"
+
+# Шаги заказа в порядке выполнения
+STEPS = (LIST, CREATE, SERVE, APPROVE, COMPLETE)
+
+PASSWORD = 'benchmark_password'
+
+# Сумма на счету заказчика и цена заказа
+INITIAL_CASH = 1000
+PRICE = '10.00'
+
+
+def percentile(values, fraction):
+    """
+    Перцентиль отсортированного списка values (ближайший ранг)
+    """
+    index = int(round(fraction * (len(values) - 1)))
+    return values[index]
+
+
+def summarize(timings, queries):
+    """
+    Сводка по замерам одного шага: время в миллисекундах и число запросов
+    """
+    timings = sorted(timings)
+    return {
+        'count': len(timings),
+        'min': timings[0] * 1000,
+        'median': percentile(timings, 0.5) * 1000,
+        'p95': percentile(timings, 0.95) * 1000,
+        'max': timings[-1] * 1000,
+        'queries': max(queries),
+    }
+
+
+class Benchmark(object):
+
+    """
+    Замер одной конфигурации: customers заказчиков и столько же
+    исполнителей, по bookings заказов у каждого заказчика, repeat
+    учитываемых проходов после warmup проходов прогрева
+    """
+
+    def __init__(self, customers, bookings, repeat=1, warmup=1):
+        self.customers = customers
+        self.bookings = bookings
+        self.repeat = repeat
+        self.warmup = warmup
+        self.timings = dict((step, []) for step in STEPS)
+        self.queries = dict((step, []) for step in STEPS)
+
+    def create_users(self, prefix, group_name, codenames, cash):
+        content_type = ContentType.objects.get_for_model(Booking)
+        group, created = Group.objects.get_or_create(name=group_name)
+        permissions = [Permission.objects.get_or_create(
+            content_type=content_type, codename=codename)[0]
+            for codename in codenames]
+        group.permissions.add(*permissions)
+        # Имена пользователей не повторяются в замерах разных конфигураций
+        prefix = '%s_%s_%s_' % (prefix, self.customers, self.bookings)
+        users = []
+        for i in range(self.customers):
+            user = User.objects.create_user(
+                '%s%s' % (prefix, i), '%s%s@benchmark.com' % (prefix, i),
+                PASSWORD)
+            user.groups.add(group)
+            user.user_permissions.add(*permissions)
+            UserProfile.objects.create(user=user, cash=cash)
+            users.append(user)
+        return users
+
+    def login(self, user):
+        client = Client()
+        assert client.login(username=user.username, password=PASSWORD)
+        return client
+
+    def setup(self):
+        customers = self.create_users(
+            'bench_customer', roles.CUSTOMERS,
+            ('add_booking', 'change_booking', 'delete_booking'), INITIAL_CASH)
+        performers = self.create_users(
+            'bench_performer', roles.PERFORMERS, ('perform_perm',), 0)
+        self.users = [(customer, self.login(customer), performer,
+                       self.login(performer))
+                      for customer, performer in zip(customers, performers)]
+        escrow.flush()
+        roles.registry.get_names([])
+
+    def measure(self, step, record, request, *args, **kwargs):
+        with CaptureQueriesContext(connection) as queries:
+            started = timeit.default_timer()
+            response = request(*args, **kwargs)
+            elapsed = timeit.default_timer() - started
+        assert response.status_code in (200, 302), (step,
+                                                     response.status_code)
+        if record:
+            self.timings[step].append(elapsed)
+            self.queries[step].append(len(queries))
+        return response
+
+    def transition(self, step, record, client, url_name, data):
+        """
+        Шаг перехода заказа: AJAX-запрос, переход должен быть выполнен
+        """
+        response = self.measure(step, record, client.post, reverse(url_name),
+                                data, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        result = json.loads(response.content)
+        assert result['success'], (step, result['request_status'])
+        return response
+
+    def run_booking(self, customer, customer_client, performer,
+                    performer_client, number, record):
+        """
+        Шаги одного заказа. Возвращает id заказа.
+        """
+        measure = self.measure
+        measure(LIST, record, performer_client.get, reverse('booking-list'))
+        measure(CREATE, record, customer_client.post,
+                reverse('create-booking'), {
+                    'title': 'benchmark %s' % number, 'text': 'text',
+                    'price': PRICE})
+        booking_id = Booking.objects.filter(customer=customer).order_by(
+            '-pk').values_list('pk', flat=True)[0]
+        self.transition(SERVE, record, performer_client, 'serve-booking',
+                        {'id': booking_id})
+        self.transition(APPROVE, record, customer_client, 'approve-booking',
+                        {'booking_id': booking_id,
+                         'possible_performer': performer.pk})
+        self.transition(COMPLETE, record, customer_client, 'complete-booking',
+                        {'id': booking_id})
+        status = Booking.objects.filter(pk=booking_id).values_list(
+            'status', flat=True)[0]
+        assert status == Booking.COMPLETED, (booking_id, status)
+        return booking_id
+
+    def run(self):
+        """
+        Все проходы. Возвращает результат замера (см. result()).
+        """
+        self.setup()
+        self.booking_ids = []
+        for iteration in range(self.warmup + self.repeat):
+            record = iteration >= self.warmup
+            number = 0
+            for users in self.users:
+                for i in range(self.bookings):
+                    self.booking_ids.append(self.run_booking(
+                        *users, number=number, record=record))
+                    number += 1
+        return self.result()
+
+    def result(self):
+        return {
+            'customers': self.customers,
+            'performers': self.customers,
+            'bookings': self.bookings,
+            'repeat': self.repeat,
+            'warmup': self.warmup,
+            'steps': dict((step, summarize(self.timings[step],
+                                           self.queries[step]))
+                          for step in STEPS),
+        }
+
+
+def run_sweep(sweep, repeat=1, warmup=1):
+    """
+    Замеры конфигураций sweep - список пар (K, M). Возвращает результаты
+    всех замеров и список объектов Benchmark.
+    """
+    benchmarks = [Benchmark(customers, bookings, repeat, warmup)
+                  for customers, bookings in sweep]
+    runs = [benchmark.run() for benchmark in benchmarks]
+    return {'date': timezone.now().isoformat(), 'runs': runs}, benchmarks
+
+
+def run_key(run):
+    return run['customers'], run['bookings']
+
+
+def compare(results, baseline, threshold):
+    """
+    Шаги, ставшие медленнее: медиана времени больше медианы baseline более
+    чем в threshold раз либо SQL-запросов больше, чем в baseline. Список
+    (K, M, шаг, описание).
+    """
+    baseline_runs = dict((run_key(run), run) for run in baseline['runs'])
+    regressions = []
+    for run in results['runs']:
+        old_run = baseline_runs.get(run_key(run))
+        if old_run is None:
+            continue
+        for step in STEPS:
+            new, old = run['steps'][step], old_run['steps'].get(step)
+            if old is None:
+                continue
+            if new['median'] > old['median'] * threshold:
+                regressions.append(run_key(run) + (step, (
+                    u"медиана %.1f мс, было %.1f мс" % (
+                        new['median'], old['median']))))
+            if new['queries'] > old['queries']:
+                regressions.append(run_key(run) + (step, (
+                    u"%s SQL-запросов, было %s" % (
+                        new['queries'], old['queries']))))
+    return regressions
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+
+"""
+Счетчики заказов (таблица BookingCounter).
+
+Для каждого статуса, заказчика и исполнителя хранится число его заказов.
+Счетчики изменяются на разницу при каждом сохранении и удалении заказа,
+поэтому число заказов в списке читается по первичному ключу вместо
+COUNT(*) по таблице заказов.
+
+Счетчик статуса изменяет почти каждый запрос, меняющий заказ, поэтому он
+хранится в STRIPES строках (status:<статус>:<часть>), как счет системы
+(SystemAccount). Запрос изменяет часть, выбранную случайно, и параллельные
+транзакции не ждут друг друга на одной строке. Значение счетчика статуса -
+сумма частей (get_total).
+
+Все счетчики одного изменения заказа изменяются одним запросом (apply).
+Для этого счетчики пользователя создаются вместе с ним, а части счетчиков
+статусов - миграцией и rebuild().
+
+Изменения заказов условными запросами UPDATE (см. transitions.py) учитываются
+по сигналу booking_updated. Прочие изменения в обход моделей
+(queryset.update(), bulk_create) счетчики не учитывают, после них счетчики
+перестраиваются функцией rebuild() (команда rebuild_counters).
+"""
+
+import random
+from collections import defaultdict
+
+from django.contrib.auth.models import User
+from django.db import connection, IntegrityError, transaction
+from django.db.models import F
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Booking, BookingCounter
+from .signals import booking_updated, bookings_completed
+
+
+# Число частей счетчика статуса
+STRIPES = 16
+
+# Атрибут заказа со значениями, учтенными в счетчиках: (статус, исполнитель)
+COUNTED_ATTR = '_counted'
+
+# Полное перестроение счетчиков одним запросом
+REBUILD_SQL = """
+INSERT INTO booking_bookingcounter (name, value)
+SELECT 'status:' || status || ':0', COUNT(*) FROM booking_booking GROUP BY status
+UNION ALL
+SELECT 'customer:' || customer_id, COUNT(*) FROM booking_booking
+GROUP BY customer_id
+UNION ALL
+SELECT 'performer:' || performer_id, COUNT(*) FROM booking_booking
+WHERE performer_id IS NOT NULL GROUP BY performer_id
+"""
+
+# Счетчики пользователей и части счетчиков статусов создаются заранее с
+# нулевыми значениями, чтобы изменение счетчиков было одним запросом
+# APPLY_SQL
+CREATE_USER_COUNTERS_SQL = """
+INSERT INTO booking_bookingcounter (name, value)
+SELECT prefix || u.id, 0
+FROM auth_user u, unnest(ARRAY['customer:', 'performer:']) AS prefix
+WHERE NOT EXISTS (SELECT 1 FROM booking_bookingcounter
+                  WHERE name = prefix || u.id)
+"""
+
+CREATE_STRIPES_SQL = """
+INSERT INTO booking_bookingcounter (name, value)
+SELECT 'status:' || status || ':' || stripe, 0
+FROM unnest(%s::varchar[]) AS status, generate_series(0, %s - 1) AS stripe
+WHERE NOT EXISTS (SELECT 1 FROM booking_bookingcounter
+                  WHERE name = 'status:' || status || ':' || stripe)
+"""
+
+# Изменение счетчиков на разницы одним запросом. Строки блокируются в
+# порядке имен, чтобы параллельные транзакции не ждали друг друга взаимно.
+# Возвращаются имена измененных (существующих) счетчиков.
+APPLY_SQL = """
+UPDATE booking_bookingcounter c SET value = c.value + d.value
+FROM unnest(%s::varchar[], %s::integer[]) AS d(name, value)
+WHERE c.name = d.name AND c.name IN (
+    SELECT name FROM booking_bookingcounter WHERE name = ANY(%s)
+    ORDER BY name FOR UPDATE)
+RETURNING c.name
+"""
+
+
+def status_counter(status):
+    return 'status:%s' % status
+
+
+def is_striped(name):
+    return name.startswith('status:')
+
+
+def get_stripes(name):
+    """
+    Имена строк счетчика name
+    """
+    if is_striped(name):
+        return ['%s:%s' % (name, stripe) for stripe in range(STRIPES)]
+    return [name]
+
+
+def customer_counter(user_id):
+    return 'customer:%s' % user_id
+
+
+def performer_counter(user_id):
+    return 'performer:%s' % user_id
+
+
+def open_bookings_counters():
+    """
+    Счетчики незавершенных заказов (лента)
+    """
+    return [status_counter(status) for status, name in Booking.STATUS_CHOICES
+            if status != Booking.COMPLETED]
+
+
+def own_bookings_counters(user_id):
+    """
+    Счетчики заказов пользователя как заказчика и как исполнителя
+    """
+    return [customer_counter(user_id), performer_counter(user_id)]
+
+
+def get_total(names):
+    """
+    Сумма счетчиков names
+    """
+    stored = [stripe for name in names for stripe in get_stripes(name)]
+    values = BookingCounter.objects.filter(name__in=stored).values_list(
+        'value', flat=True)
+    return sum(values)
+
+
+def create(names, deltas):
+    """
+    Создание счетчиков names со значениями deltas. Счетчик, параллельно
+    созданный другим запросом, изменяется на разницу.
+    """
+    try:
+        with transaction.atomic():
+            BookingCounter.objects.bulk_create([
+                BookingCounter(name=name, value=delta)
+                for name, delta in zip(names, deltas)])
+    except IntegrityError:
+        for name, delta in zip(names, deltas):
+            if not BookingCounter.objects.filter(name=name).update(
+                    value=F('value') + delta):
+                BookingCounter.objects.create(name=name, value=delta)
+
+
+def booking_counters(status, customer_id, performer_id):
+    names = [status_counter(status), customer_counter(customer_id)]
+    if performer_id is not None:
+        names.append(performer_counter(performer_id))
+    return names
+
+
+def apply(deltas):
+    """
+    Изменение счетчиков на ненулевые разницы одним запросом (APPLY_SQL).
+    Счетчик статуса изменяется в случайной части. Недостающие счетчики
+    (созданные в обход моделей пользователи, см. create_missing)
+    создаются.
+    """
+    rows = defaultdict(int)
+    for counter, delta in deltas.items():
+        if is_striped(counter):
+            counter = '%s:%s' % (counter, random.randrange(STRIPES))
+        rows[counter] += delta
+    names = sorted(name for name in rows if rows[name])
+    if not names:
+        return
+    cursor = connection.cursor()
+    cursor.execute(APPLY_SQL, [names, [rows[name] for name in names], names])
+    updated = set(name for name, in cursor.fetchall())
+    missing = [name for name in names if name not in updated]
+    if missing:
+        create(missing, [rows[name] for name in missing])
+
+
+def create_missing():
+    """
+    Создание недостающих счетчиков пользователей и частей счетчиков статусов
+    с нулевыми значениями
+    """
+    cursor = connection.cursor()
+    cursor.execute(CREATE_USER_COUNTERS_SQL)
+    cursor.execute(CREATE_STRIPES_SQL, [
+        [status for status, name in Booking.STATUS_CHOICES], STRIPES])
+
+
+def rebuild():
+    """
+    Полное перестроение счетчиков по таблице заказов
+    """
+    with transaction.atomic():
+        BookingCounter.objects.all().delete()
+        connection.cursor().execute(REBUILD_SQL)
+        create_missing()
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created=False, raw=False, **kwargs):
+    if created and not raw:
+        BookingCounter.objects.bulk_create([
+            BookingCounter(name=customer_counter(instance.pk), value=0),
+            BookingCounter(name=performer_counter(instance.pk), value=0)])
+
+
+@receiver(post_init, sender=Booking)
+def booking_loaded(sender, instance, **kwargs):
+    if instance.pk is not None:
+        setattr(instance, COUNTED_ATTR, (instance.__dict__.get('status'),
+                                         instance.__dict__.get('performer_id')))
+
+
+@receiver(post_save, sender=Booking)
+def booking_saved(sender, instance, created=False, raw=False, **kwargs):
+    if raw:
+        return
+    deltas = defaultdict(int)
+    counted = getattr(instance, COUNTED_ATTR, None)
+    if not created:
+        if counted is None:
+            return
+        status, performer_id = counted
+        for name in booking_counters(status, instance.customer_id,
+                                     performer_id):
+            deltas[name] -= 1
+    for name in booking_counters(instance.status, instance.customer_id,
+                                 instance.performer_id):
+        deltas[name] += 1
+    apply(deltas)
+    setattr(instance, COUNTED_ATTR, (instance.status, instance.performer_id))
+
+
+@receiver(booking_updated, sender=Booking)
+def booking_updated_in_place(sender, booking, old_status, old_performer_id,
+                             **kwargs):
+    deltas = defaultdict(int)
+    for name in booking_counters(old_status, booking.customer_id,
+                                 old_performer_id):
+        deltas[name] -= 1
+    for name in booking_counters(booking.status, booking.customer_id,
+                                 booking.performer_id):
+        deltas[name] += 1
+    apply(deltas)
+    setattr(booking, COUNTED_ATTR, (booking.status, booking.performer_id))
+
+
+@receiver(bookings_completed, sender=Booking)
+def bookings_completed_in_place(sender, bookings, old_status, **kwargs):
+    # Заказчик и исполнитель заказов не меняются, меняются только счетчики
+    # статусов
+    apply({status_counter(old_status): -len(bookings),
+           status_counter(Booking.COMPLETED): len(bookings)})
+
+
+@receiver(post_delete, sender=Booking)
+def booking_deleted(sender, instance, **kwargs):
+    counted = getattr(instance, COUNTED_ATTR, None)
+    if counted is None:
+        return
+    status, performer_id = counted
+    apply(dict((name, -1) for name in booking_counters(
+        status, instance.customer_id, performer_id)))
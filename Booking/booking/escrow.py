@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+"""
+Удержания и признак "заказчику хватает средств" (Booking.affordable).
+
+Цена заказа удерживается со счета заказчика при подтверждении исполнителя
+(EscrowHold, UserProfile.held) и снимается после перевода денег
+исполнителю, поэтому UserProfile.cash - сумма, доступная для новых заказов.
+
+Признак affordable заказов заказчика пересчитывается только при изменении
+его счета: после проводок (сигнал balance_changed), сохранения профиля и
+выплат исполнителям. Списки заказов читают готовый признак и не выбирают
+профили заказчиков. Измененные значения рассылаются сигналом
+affordable_changed (их копирует лента, см. feed.py).
+
+Внутри транзакции пересчет откладывается (request_sync): транзакция
+перехода уже заблокировала свой заказ и счета, и блокировка других заказов
+заказчика нарушила бы порядок блокировок transitions.py - два
+подтверждения заказов одного заказчика блокировали бы друг друга. Отложенные
+заказчики пересчитываются после транзакции (flush) отдельной транзакцией,
+которая блокирует только заказы и всегда в порядке id: middleware после
+запроса, обработчик очереди расчетов после порции. Пересчет читает текущую
+сумму на счету, поэтому повторный или лишний (после отката) пересчет ничего
+не портит.
+"""
+
+import threading
+
+from django.db import connection, transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .models import Booking, UserProfile
+from .signals import affordable_changed, balance_changed, bookings_completed
+
+
+# Пересчет признака affordable незавершенных заказов заказчиков одним
+# запросом по текущим суммам на счетах. Изменяются только строки с неверным
+# признаком, блокируются они в порядке id.
+SYNC_CUSTOMERS_SQL = """
+UPDATE booking_booking b SET affordable = (b.price <= p.cash)
+FROM booking_userprofile p
+WHERE b.id IN (
+    SELECT b2.id FROM booking_booking b2
+    JOIN booking_userprofile p2 ON p2.user_id = b2.customer_id
+    WHERE b2.customer_id = ANY(%s) AND b2.status <> %s
+      AND b2.affordable <> (b2.price <= p2.cash)
+    ORDER BY b2.id
+    FOR UPDATE OF b2
+) AND p.user_id = b.customer_id
+RETURNING b.id, b.affordable
+"""
+
+# Заказчики, пересчет которых отложен до конца транзакции (в потоке)
+_pending = threading.local()
+
+
+def get_cash(user_id):
+    """
+    Сумма на счету пользователя либо None, если профиля нет
+    """
+    return UserProfile.objects.filter(user_id=user_id).values_list(
+        'cash', flat=True).first()
+
+
+def send_changes(changes):
+    if changes:
+        affordable_changed.send(sender=Booking, changes=changes)
+
+
+def sync_booking(booking):
+    """
+    Пересчет признака affordable сохраненного заказа. Строка заказа уже
+    заблокирована сохранением, поэтому пересчет выполняется сразу.
+    """
+    cash = get_cash(booking.customer_id)
+    affordable = cash is not None and cash >= booking.price
+    if affordable != booking.affordable:
+        Booking.objects.filter(pk=booking.pk).update(affordable=affordable)
+        booking.affordable = affordable
+        send_changes([(booking.pk, affordable)])
+
+
+def sync_customers(user_ids):
+    """
+    Пересчет признака affordable незавершенных заказов заказчиков user_ids
+    """
+    with transaction.atomic():
+        cursor = connection.cursor()
+        cursor.execute(SYNC_CUSTOMERS_SQL, [sorted(user_ids),
+                                            Booking.COMPLETED])
+        send_changes(cursor.fetchall())
+
+
+def get_pending():
+    if not hasattr(_pending, 'user_ids'):
+        _pending.user_ids = set()
+    return _pending.user_ids
+
+
+def request_sync(user_ids):
+    """
+    Пересчет признака affordable заказов заказчиков user_ids после
+    изменения их счетов: сразу вне транзакции, иначе - после нее (flush)
+    """
+    if connection.in_atomic_block:
+        get_pending().update(user_ids)
+    else:
+        sync_customers(user_ids)
+
+
+def flush():
+    """
+    Пересчет отложенных в транзакциях заказчиков. Вызывается после
+    транзакции.
+    """
+    pending = get_pending()
+    if pending:
+        user_ids = list(pending)
+        pending.clear()
+        sync_customers(user_ids)
+
+
+class AffordableSyncMiddleware(object):
+
+    """
+    Пересчет признака affordable заказчиков, счета которых изменил запрос
+    """
+
+    def process_response(self, request, response):
+        flush()
+        return response
+
+
+@receiver(post_save, sender=Booking)
+def booking_saved(sender, instance, raw=False, **kwargs):
+    if not raw and instance.status != Booking.COMPLETED:
+        sync_booking(instance)
+
+
+@receiver(post_save, sender=UserProfile)
+def profile_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        request_sync([instance.user_id])
+
+
+@receiver(balance_changed, sender=UserProfile)
+def balance_changed_in_place(sender, user_id, **kwargs):
+    request_sync([user_id])
+
+
+@receiver(bookings_completed, sender=Booking)
+def bookings_completed_in_place(sender, balances, **kwargs):
+    if balances:
+        request_sync(balances)
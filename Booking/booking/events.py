@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+
+"""
+Живая лента: изменения заказов, открытых в списке у пользователя (опрос).
+
+Браузер периодически запрашивает booking_events_view с версиями заказов на
+странице и получает текущее состояние тех из них, версия которых
+изменилась. Ответ собирается по таблице заказов для пользователя запроса:
+состояние передается только для заказов, которые пользователь может видеть
+в списках (незавершенные заказы ленты и его собственные заказы), суммы
+расчета - только заказчику и исполнителю заказа. Об остальных заказах
+(завершенных чужих, удаленных, несуществующих) сообщается одинаково: строку
+нужно убрать со страницы.
+
+Запрос не держит процесс сервера: без изменений ответ возвращается сразу.
+Если процессов достаточно (несколько процессов uWSGI, gevent),
+BOOKING_EVENTS_POLL_TIMEOUT > 0 включает короткий long polling: запрос
+ждет изменения до BOOKING_EVENTS_POLL_TIMEOUT секунд. Изменение заказа
+публикуется через NOTIFY PostgreSQL в той же транзакции, что и само
+изменение, в каждом процессе одно выделенное соединение с базой слушает
+канал (LISTEN) и будит ожидающие запросы этого процесса.
+"""
+
+import json
+import logging
+import select
+import threading
+import time
+try:
+    from Queue import Queue, Empty, Full
+except ImportError:
+    from queue import Queue, Empty, Full
+
+import psycopg2
+import psycopg2.extensions
+from django.conf import settings
+from django.contrib.auth.decorators import login_required
+from django.db import connection
+from django.db.models import Q
+from django.dispatch import receiver
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.views.decorators.http import require_GET
+
+from .models import Booking, LedgerEntry
+from .signals import booking_status_changed, bookings_completed
+
+
+logger = logging.getLogger(__name__)
+
+# Максимальное число событий в очереди одного ожидающего запроса. Если
+# запрос не успевает их забирать, новые события для него отбрасываются.
+QUEUE_SIZE = 100
+
+# Максимальное число заказов в одном запросе
+MAX_BOOKINGS = 100
+
+
+def publish(payloads):
+    """
+    Отправка событий в канал одним запросом. События будут доставлены после
+    фиксации текущей транзакции.
+    """
+    cursor = connection.cursor()
+    cursor.execute("SELECT pg_notify(%s, payload) FROM unnest(%s) AS payload",
+                   [settings.BOOKING_EVENTS_CHANNEL,
+                    [json.dumps(payload) for payload in payloads]])
+
+
+@receiver(booking_status_changed, sender=Booking)
+def status_changed(sender, booking, old_status, **kwargs):
+    publish([{'id': booking.pk, 'version': booking.version}])
+
+
+@receiver(bookings_completed, sender=Booking)
+def bookings_completed_in_place(sender, bookings, old_status, **kwargs):
+    publish([{'id': booking['id'], 'version': booking['version']}
+             for booking in bookings])
+
+
+class EventHub(object):
+
+    """
+    Слушатель канала событий, общий для процесса.
+
+    Поток-слушатель запускается при первой подписке и держит одно соединение
+    с базой. Каждый подписчик (ожидающий запрос) получает свою очередь событий.
+    """
+
+    # Пауза перед повторным подключением после ошибки соединения, секунды
+    RECONNECT_DELAY = 1
+    # Период проверки соединения при отсутствии событий, секунды
+    POLL_TIMEOUT = 5
+
+    def __init__(self, channel):
+        self.channel = channel
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._listening = threading.Event()
+        self._stopped = threading.Event()
+
+    def subscribe(self):
+        """
+        Новая очередь событий. Возвращается, когда слушатель уже подписан
+        на канал.
+        """
+        queue = Queue(QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.add(queue)
+            if self._thread is None or not self._thread.is_alive():
+                self._stopped.clear()
+                self._thread = threading.Thread(target=self._run,
+                                                name='booking-events')
+                self._thread.daemon = True
+                self._thread.start()
+        self._listening.wait(self.POLL_TIMEOUT)
+        return queue
+
+    def unsubscribe(self, queue):
+        with self._lock:
+            self._subscribers.discard(queue)
+
+    def stop(self):
+        """
+        Остановка слушателя и закрытие его соединения с базой
+        """
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        self._stopped.set()
+        if thread is not None:
+            thread.join()
+        self._listening.clear()
+
+    def dispatch(self, payload):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for queue in subscribers:
+            try:
+                queue.put_nowait(payload)
+            except Full:
+                pass
+
+    def _connect(self):
+        params = connection.get_connection_params()
+        listener = psycopg2.connect(**params)
+        listener.set_isolation_level(
+            psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        listener.cursor().execute('LISTEN "%s"' % self.channel)
+        return listener
+
+    def _run(self):
+        listener = None
+        while not self._stopped.is_set():
+            try:
+                if listener is None:
+                    listener = self._connect()
+                    self._listening.set()
+                readable, writable, failed = select.select(
+                    [listener], [], [], self.POLL_TIMEOUT)
+                listener.poll()
+                while listener.notifies:
+                    notify = listener.notifies.pop(0)
+                    self.dispatch(notify.payload)
+            except (psycopg2.Error, select.error):
+                logger.exception(u"Ошибка соединения слушателя событий")
+                self._listening.clear()
+                try:
+                    if listener is not None:
+                        listener.close()
+                except psycopg2.Error:
+                    pass
+                listener = None
+                self._stopped.wait(self.RECONNECT_DELAY)
+        if listener is not None:
+            listener.close()
+
+
+hub = EventHub(settings.BOOKING_EVENTS_CHANNEL)
+
+
+def parse_versions(value):
+    """
+    Версии заказов из параметра "id:версия,id:версия,...": словарь
+    {id: версия}. ValueError при неверном значении.
+    """
+    versions = {}
+    for item in value.split(','):
+        if item:
+            booking_id, version = item.split(':')
+            versions[int(booking_id)] = int(version)
+    if len(versions) > MAX_BOOKINGS:
+        raise ValueError(u"Слишком много заказов")
+    return versions
+
+
+def get_events(user, versions):
+    """
+    Текущее состояние заказов, версия которых отличается от versions
+    ({id: версия}). Выбираются только заказы ленты и заказы пользователя,
+    для прочих заказов versions событие - только удаление строки. Суммы
+    расчета передаются только заказчику и исполнителю заказа.
+    """
+    visible = list(Booking.objects.filter(pk__in=list(versions)).filter(
+        Q(feed_entry__isnull=False) | Q(customer=user) | Q(performer=user)
+    ).values('id', 'status', 'version', 'customer_id', 'performer_id',
+             'performer__username'))
+    bookings = [booking for booking in visible
+                if booking['version'] != versions[booking['id']]]
+    own = set(booking['id'] for booking in bookings
+              if user.pk in (booking['customer_id'], booking['performer_id']))
+    split = {}
+    completed = [booking['id'] for booking in bookings
+                 if booking['id'] in own and booking['status'] in (
+                     Booking.COMPLETING, Booking.COMPLETED)]
+    if completed:
+        for booking_id, kind, amount in LedgerEntry.objects.filter(
+                booking_id__in=completed,
+                kind__in=(LedgerEntry.PAYOUT, LedgerEntry.COMMISSION)
+        ).values_list('booking_id', 'kind', 'amount'):
+            split.setdefault(booking_id, {})[kind] = amount
+
+    events = []
+    for booking in bookings:
+        event = {
+            'id': booking['id'],
+            'status': booking['status'],
+            'version': booking['version'],
+            'performer': booking['performer__username'],
+        }
+        amounts = split.get(booking['id'], {})
+        if len(amounts) == 2:
+            event['cash_for_system'] = str(amounts[LedgerEntry.COMMISSION])
+            event['cash_for_performer'] = str(amounts[LedgerEntry.PAYOUT])
+        events.append(event)
+    hidden = set(versions) - set(booking['id'] for booking in visible)
+    events.extend({'id': booking_id, 'removed': True}
+                  for booking_id in sorted(hidden))
+    return events
+
+
+def wait_for_events(user, versions, timeout):
+    """
+    События заказов versions (см. get_events). Если их нет, ожидание
+    изменения одного из заказов до timeout секунд.
+    """
+    events = get_events(user, versions)
+    if events or timeout <= 0:
+        return events
+    queue = hub.subscribe()
+    try:
+        # Изменение между первой проверкой и подпиской не теряется
+        events = get_events(user, versions)
+        deadline = time.time() + timeout
+        while not events:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                payload = json.loads(queue.get(timeout=remaining))
+            except Empty:
+                break
+            if payload['id'] in versions:
+                events = get_events(user, versions)
+    finally:
+        hub.unsubscribe(queue)
+    return events
+
+
+@require_GET
+@login_required
+def booking_events_view(request):
+    """
+    Изменения заказов: параметр bookings - "id:версия,..." заказов на
+    странице, ответ - JSON {"events": [...]}
+    """
+    try:
+        versions = parse_versions(request.GET.get('bookings', ''))
+    except ValueError:
+        return HttpResponseBadRequest(u"Неверный список заказов")
+    events = wait_for_events(request.user, versions,
+                             settings.BOOKING_EVENTS_POLL_TIMEOUT)
+    response = HttpResponse(json.dumps({'events': events}),
+                            content_type="application/json")
+    response['Cache-Control'] = 'no-cache'
+    return response
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+"""
+Лента незавершенных заказов (таблица FeedEntry).
+
+Строки ленты обновляются при каждом изменении заказа, списка претендентов
+на заказ, признака "заказчику хватает средств" (копия Booking.affordable,
+сигнал affordable_changed) и имени пользователя. Поэтому выборка ленты -
+это чтение одной узкой таблицы без соединений с booking_booking и
+auth_user, без выборки претендентов и без запросов профилей заказчиков.
+Заголовок и текст заказа в ленте не копируются: их для выведенной страницы
+одним запросом по первичному ключу читает load_texts.
+"""
+
+from django.contrib.auth.models import User
+from django.db import connection, IntegrityError, transaction
+from django.db.models import F, Q
+from django.db.models.signals import post_save, m2m_changed
+from django.dispatch import receiver
+
+from .models import Booking, FeedEntry
+from .signals import affordable_changed, booking_updated, bookings_completed
+
+
+# Полное перестроение ленты одним запросом
+REBUILD_SQL = """
+INSERT INTO booking_feedentry (
+    booking_id, customer_id, customer_username, performer_id,
+    performer_username, price, status, applicants_count,
+    customer_can_afford, date, version)
+SELECT b.id, b.customer_id, c.username, b.performer_id, p.username,
+       b.price, b.status,
+       (SELECT COUNT(*) FROM booking_booking_possible_performers pp
+        WHERE pp.booking_id = b.id),
+       b.affordable, b.date, b.version
+FROM booking_booking b
+JOIN auth_user c ON c.id = b.customer_id
+LEFT JOIN auth_user p ON p.id = b.performer_id
+WHERE b.status <> 'completed'
+"""
+
+# Пересчет числа претендентов на заказ
+SYNC_APPLICANTS_SQL = """
+UPDATE booking_feedentry SET applicants_count = (
+    SELECT COUNT(*) FROM booking_booking_possible_performers
+    WHERE booking_id = %s)
+WHERE booking_id = %s
+"""
+
+# Статус, исполнитель, версия и число претендентов после перехода заказа -
+# один запрос
+SYNC_STATUS_SQL = """
+UPDATE booking_feedentry SET status = %s, performer_id = %s,
+    performer_username = %s, version = %s, applicants_count = (
+        SELECT COUNT(*) FROM booking_booking_possible_performers
+        WHERE booking_id = %s)
+WHERE booking_id = %s
+"""
+
+# Копирование измененных признаков Booking.affordable в строки ленты
+SYNC_AFFORDABLE_SQL = """
+UPDATE booking_feedentry f SET customer_can_afford = c.affordable
+FROM unnest(%s::integer[], %s::boolean[]) AS c(booking_id, affordable)
+WHERE f.booking_id = c.booking_id
+"""
+
+
+def get_feed_queryset():
+    """
+    Лента незавершенных заказов
+    """
+    return FeedEntry.objects.all()
+
+
+def load_texts(entries):
+    """
+    Заголовки и тексты заказов строк ленты entries (выведенной страницы)
+    одним запросом по первичному ключу. Строки с уже выбранным текстом
+    (результаты поиска, см. search.py) пропускаются.
+    """
+    entries = [entry for entry in entries if not hasattr(entry, 'text')]
+    if not entries:
+        return
+    texts = dict((pk, (title, text)) for pk, title, text in
+                 Booking.objects.filter(
+                     pk__in=[entry.pk for entry in entries]).values_list(
+                         'pk', 'title', 'text'))
+    for entry in entries:
+        entry.title, entry.text = texts.get(entry.pk, (u'', u''))
+
+
+def sync_booking(booking):
+    """
+    Обновление строки ленты заказа. Завершенный заказ из ленты удаляется.
+    """
+    if booking.status == Booking.COMPLETED:
+        FeedEntry.objects.filter(booking_id=booking.pk).delete()
+        return
+
+    values = {
+        'customer_id': booking.customer_id,
+        'customer_username': booking.customer.username,
+        'performer_id': booking.performer_id,
+        'performer_username': booking.performer_username,
+        'price': booking.price,
+        'status': booking.status,
+        'applicants_count': booking.possible_performers.count(),
+        'customer_can_afford': booking.affordable,
+        'date': booking.date,
+        'version': booking.version,
+    }
+    if FeedEntry.objects.filter(booking_id=booking.pk).update(**values):
+        return
+    try:
+        with transaction.atomic():
+            FeedEntry.objects.create(booking_id=booking.pk, **values)
+    except IntegrityError:
+        # Строку параллельно создал другой запрос
+        FeedEntry.objects.filter(booking_id=booking.pk).update(**values)
+
+
+def sync_status(booking):
+    """
+    Обновление строки ленты после смены статуса заказа (см. transitions.py).
+    Меняются статус, исполнитель, версия и число претендентов (переходы
+    изменяют заявки запросом в обход booking.possible_performers), признак
+    "заказчику хватает средств" поддерживается своим сигналом. Если строки
+    нет, она создается полностью.
+    """
+    if booking.status == Booking.COMPLETED:
+        FeedEntry.objects.filter(booking_id=booking.pk).delete()
+        return
+    cursor = connection.cursor()
+    cursor.execute(SYNC_STATUS_SQL, [
+        booking.status, booking.performer_id, booking.performer_username,
+        booking.version, booking.pk, booking.pk])
+    if not cursor.rowcount:
+        sync_booking(booking)
+
+
+def sync_applicants(booking_id):
+    """
+    Обновление числа претендентов на заказ одним запросом
+    """
+    connection.cursor().execute(SYNC_APPLICANTS_SQL, [booking_id, booking_id])
+
+
+def sync_affordable(changes):
+    """
+    Копирование признака "заказчику хватает средств" из заказов (changes -
+    пары (id заказа, Booking.affordable))
+    """
+    changes = sorted(changes)
+    connection.cursor().execute(SYNC_AFFORDABLE_SQL, [
+        [booking_id for booking_id, affordable in changes],
+        [affordable for booking_id, affordable in changes]])
+
+
+def sync_username(user):
+    """
+    Обновление имени пользователя в строках ленты. Версии заказов
+    пользователя увеличиваются, чтобы сбросить кэш их строк в списке заказов.
+    """
+    renamed = FeedEntry.objects.filter(
+        Q(customer_id=user.pk) & ~Q(customer_username=user.username) |
+        Q(performer_id=user.pk) & ~Q(performer_username=user.username))
+    if not renamed.exists():
+        return
+    with transaction.atomic():
+        Booking.objects.filter(Q(customer_id=user.pk) | Q(
+            performer_id=user.pk)).update(version=F('version') + 1)
+        FeedEntry.objects.filter(customer_id=user.pk).update(
+            customer_username=user.username, version=F('version') + 1)
+        FeedEntry.objects.filter(performer_id=user.pk).update(
+            performer_username=user.username, version=F('version') + 1)
+
+
+def rebuild():
+    """
+    Полное перестроение ленты по таблице заказов
+    """
+    with transaction.atomic():
+        FeedEntry.objects.all().delete()
+        connection.cursor().execute(REBUILD_SQL)
+
+
+@receiver(post_save, sender=Booking)
+def booking_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        sync_booking(instance)
+
+
+@receiver(booking_updated, sender=Booking)
+def booking_updated_in_place(sender, booking, **kwargs):
+    sync_status(booking)
+
+
+@receiver(bookings_completed, sender=Booking)
+def bookings_completed_in_place(sender, bookings, **kwargs):
+    FeedEntry.objects.filter(
+        booking_id__in=[booking['id'] for booking in bookings]).delete()
+
+
+@receiver(affordable_changed, sender=Booking)
+def affordable_changed_in_place(sender, changes, **kwargs):
+    sync_affordable(changes)
+
+
+@receiver(m2m_changed, sender=Booking.possible_performers.through)
+def applicants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        sync_applicants(instance.pk)
+    elif pk_set:
+        # Изменение со стороны пользователя: user.booking_set.add(...)
+        for booking_id in pk_set:
+            sync_applicants(booking_id)
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created=False, raw=False,
+               update_fields=None, **kwargs):
+    if raw or created:
+        return
+    # При входе пользователя сохраняется только last_login
+    if update_fields and 'username' not in update_fields:
+        return
+    sync_username(instance)
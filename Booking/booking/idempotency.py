@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+"""
+Ключи идемпотентности POST-запросов.
+
+Клиент передает ключ в заголовке Idempotency-Key (или в параметре
+idempotency_key формы) и повторяет запрос с тем же ключом, если не дождался
+ответа. Успешный ответ на первый запрос хранится в таблице IdempotencyKey
+BOOKING_IDEMPOTENCY_TIMEOUT секунд по паре (пользователь, ключ), повторный
+запрос получает сохраненный ответ, и view не вызывается - заказы и счета
+повторно не читаются и не изменяются. Запросы без ключа выполняются как
+обычно.
+
+Таблица общая для всех процессов сервера, поэтому повтор, попавший в другой
+процесс, тоже получает сохраненный ответ. Отказы (ответы с ошибкой, см.
+not_stored) не сохраняются: клиент может повторить запрос с тем же ключом,
+например, после пополнения счета. Отметка выполняющегося запроса живет
+BOOKING_IDEMPOTENCY_LOCK_TIMEOUT секунд: ключ запроса прерванного процесса
+освобождается быстро. Истекшие ключи удаляет команда
+purge_idempotency_keys.
+"""
+
+import hashlib
+import json
+from datetime import timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse
+from django.utils import timezone
+
+from .models import IdempotencyKey
+
+
+# Заголовок и параметр формы с ключом
+HEADER = 'HTTP_IDEMPOTENCY_KEY'
+PARAMETER = 'idempotency_key'
+
+# Первый запрос с ключом еще выполняется
+IN_PROGRESS = 'in_progress'
+
+# Заголовки ответа, которые сохраняются вместе с ним
+STORED_HEADERS = ('Location',)
+
+# Атрибут ответа, который не сохраняется (см. not_stored)
+NOT_STORED_ATTR = 'idempotency_not_stored'
+
+
+def get_key(request):
+    """
+    Ключ идемпотентности запроса либо None
+    """
+    if request.method != 'POST':
+        return None
+    return request.META.get(HEADER) or request.POST.get(PARAMETER) or None
+
+
+def get_stored_key(view_name, user_id, key):
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return '%s:%s:%s' % (view_name, user_id, digest)
+
+
+def not_stored(response):
+    """
+    Отметка ответа-отказа: он не сохраняется для повторов. Возвращает
+    response.
+    """
+    setattr(response, NOT_STORED_ATTR, True)
+    return response
+
+
+def is_stored(response):
+    """
+    Сохраняется ли ответ для повторов: только успешные ответы (2xx и
+    перенаправления форм), кроме потоковых и отмеченных not_stored
+    """
+    return (200 <= response.status_code < 400 and not response.streaming and
+            not getattr(response, NOT_STORED_ATTR, False))
+
+
+def store(response):
+    return json.dumps({
+        'status': response.status_code,
+        'content': response.content.decode('utf-8'),
+        'content_type': response['Content-Type'],
+        'headers': [(name, response[name]) for name in STORED_HEADERS
+                    if response.has_header(name)],
+    })
+
+
+def replay(stored):
+    stored = json.loads(stored)
+    response = HttpResponse(stored['content'], status=stored['status'],
+                            content_type=stored['content_type'])
+    for name, value in stored['headers']:
+        response[name] = value
+    response['Idempotent-Replay'] = 'true'
+    return response
+
+
+def acquire(key):
+    """
+    Занять ключ для выполнения запроса. Возвращает None, если ключ занят
+    этим запросом, иначе IN_PROGRESS либо сохраненный ответ.
+    """
+    while True:
+        now = timezone.now()
+        expires = now + timedelta(
+            seconds=settings.BOOKING_IDEMPOTENCY_LOCK_TIMEOUT)
+        try:
+            with transaction.atomic():
+                IdempotencyKey.objects.create(key=key, expires=expires)
+            return None
+        except IntegrityError:
+            pass
+        # Истекший ключ (ответ или отметка прерванного запроса) занимается
+        # заново
+        if IdempotencyKey.objects.filter(key=key, expires__lte=now).update(
+                response=None, expires=expires):
+            return None
+        stored = IdempotencyKey.objects.filter(key=key).values_list(
+            'response', flat=True)
+        if stored:
+            return stored[0] or IN_PROGRESS
+        # Ключ освобожден между запросами - еще одна попытка
+
+
+def idempotent(view):
+    """
+    Декоратор view: повторный POST-запрос пользователя с тем же ключом
+    идемпотентности получает ответ на первый запрос. Если первый запрос еще
+    выполняется, повторный получает ответ 409. Несохраняемый ответ
+    (см. is_stored) освобождает ключ.
+    """
+    view_name = '%s.%s' % (view.__module__, view.__name__)
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = get_key(request)
+        if key is None:
+            return view(request, *args, **kwargs)
+
+        stored_key = get_stored_key(view_name, request.user.pk, key)
+        stored = acquire(stored_key)
+        if stored == IN_PROGRESS:
+            return HttpResponse(u"Запрос уже выполняется", status=409)
+        if stored is not None:
+            return replay(stored)
+        keys = IdempotencyKey.objects.filter(key=stored_key)
+        try:
+            response = view(request, *args, **kwargs)
+        except Exception:
+            keys.delete()
+            raise
+        if is_stored(response):
+            keys.update(response=store(response), expires=timezone.now() +
+                        timedelta(seconds=settings.BOOKING_IDEMPOTENCY_TIMEOUT))
+        else:
+            # Отказ или ошибку сервера клиент может повторить
+            keys.delete()
+        return response
+    return wrapper
+
+
+def purge():
+    """
+    Удаление истекших ключей. Возвращает число удаленных ключей.
+    """
+    keys = IdempotencyKey.objects.filter(expires__lte=timezone.now())
+    count = keys.count()
+    keys.delete()
+    return count
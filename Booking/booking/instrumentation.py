@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+
+"""
+Учет SQL-запросов views и бюджеты запросов.
+
+QueryLog собирает запросы к базе (текст и время) в пределах блока with
+либо обработки запроса к сайту, DEBUG для этого не нужен. Запросы считает
+легкая обертка курсора (CountingCursorWrapper): в отличие от отладочного
+курсора Django (use_debug_cursor) она не подставляет параметры в текст
+запроса, не пишет в лог и не копит connection.queries. Запросы сводятся к
+форме (query_shape): значения параметров заменяются на ?, поэтому запросы,
+отличающиеся только параметрами, имеют одну форму.
+
+QueryBudgetMiddleware сравнивает число запросов view с бюджетом, заданным
+для имени URL в BOOKING_QUERY_BUDGETS. При BOOKING_QUERY_BUDGET_STRICT
+превышение бюджета - ошибка QueryBudgetExceeded (тесты), иначе оно
+записывается в лог вместе с формами запросов. Запросы собираются только
+для views, у которых есть бюджет.
+
+RepeatedQueriesDetector находит N+1: SELECT одной формы, выполненные в
+пределах блока with или запроса к сайту не меньше threshold раз, и для
+каждого - места вызова: последнюю строку кода проекта в стеке и тег шаблона
+(имя и строку шаблона при TEMPLATE_DEBUG, иначе только имя). Получение стека
+на каждый запрос к базе дорого, поэтому RepeatedQueriesMiddleware работает
+только при BOOKING_REPEATED_QUERIES_DETECTION (разработка, тесты).
+"""
+
+import logging
+import os
+import re
+import sys
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.backends.utils import CursorDebugWrapper, CursorWrapper
+from django.template.base import Node, Template
+
+
+logger = logging.getLogger(__name__)
+
+# Атрибут запроса к сайту с его QueryLog
+QUERY_LOG_ATTR = '_booking_query_log'
+
+# Атрибут соединения с базой со списком его активных QueryLog
+QUERY_LOGS_ATTR = '_booking_query_logs'
+
+# Атрибут запроса к сайту с его RepeatedQueriesDetector
+DETECTOR_ATTR = '_booking_repeated_queries'
+
+# Число форм запросов в сообщении о превышении бюджета
+REPORTED_SHAPES = 10
+
+# Число мест вызова одной формы запроса в сообщении о повторах
+REPORTED_SITES = 5
+
+# Каталог проекта: места вызова запросов ищутся в его файлах
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Замены при сведении запроса к форме: строки, числа, списки значений,
+# имена точек сохранения
+SHAPE_PATTERNS = (
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'"s\d+_x\d+"'), '?'),
+    (re.compile(r'(?<![\w"])-?\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(...)'),
+    (re.compile(r'ARRAY\[[^\]]*\]'), 'ARRAY[...]'),
+    (re.compile(r'\s+'), ' '),
+)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class RepeatedQueries(AssertionError):
+    pass
+
+
+def query_shape(sql):
+    """
+    Форма запроса: текст без значений параметров
+    """
+    for pattern, replacement in SHAPE_PATTERNS:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+
+class CountingCursorWrapper(CursorWrapper):
+
+    """
+    Курсор, сообщающий активным QueryLog соединения текст и время каждого
+    выполненного запроса
+    """
+
+    def __init__(self, cursor, db, logs):
+        super(CountingCursorWrapper, self).__init__(cursor, db)
+        self.logs = logs
+
+    def execute(self, sql, params=None):
+        started = time.time()
+        try:
+            return super(CountingCursorWrapper, self).execute(sql, params)
+        finally:
+            self.record(sql, time.time() - started)
+
+    def executemany(self, sql, param_list):
+        started = time.time()
+        try:
+            return super(CountingCursorWrapper, self).executemany(sql,
+                                                                  param_list)
+        finally:
+            self.record(sql, time.time() - started)
+
+    def record(self, sql, duration):
+        # Текст с параметрами psycopg2 уже собрал для выполнения
+        sql = getattr(self.cursor, 'query', None) or sql
+        for log in self.logs:
+            log.record(sql, duration)
+
+
+def get_query_logs(db):
+    """
+    Список активных QueryLog соединения db. При первом вызове для
+    соединения его курсоры получают обертку CountingCursorWrapper, пока
+    список не пуст.
+    """
+    logs = vars(db).get(QUERY_LOGS_ATTR)
+    if logs is None:
+        logs = []
+        setattr(db, QUERY_LOGS_ATTR, logs)
+        make_cursor = db.cursor
+
+        def cursor():
+            if not logs:
+                return make_cursor()
+            return CountingCursorWrapper(make_cursor(), db, logs)
+        db.cursor = cursor
+    return logs
+
+
+class QueryLog(object):
+
+    """
+    Запросы к базе (словари sql, time как в connection.queries),
+    выполненные между start() и stop()
+    """
+
+    def __init__(self):
+        self.started = None
+        self.duration = None
+        self._records = []
+        self._logs = None
+
+    def start(self):
+        self._logs = get_query_logs(connections[DEFAULT_DB_ALIAS])
+        self._logs.append(self)
+        self.started = time.time()
+        return self
+
+    def stop(self):
+        self.duration = time.time() - self.started
+        if self in self._logs:
+            self._logs.remove(self)
+        return self
+
+    def record(self, sql, duration):
+        self._records.append((sql, duration))
+
+    @property
+    def queries(self):
+        return [{'sql': sql.decode('utf-8', 'replace')
+                 if isinstance(sql, bytes) else sql,
+                 'time': '%.3f' % duration}
+                for sql, duration in self._records]
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def count(self):
+        return len(self._records)
+
+    @property
+    def sql_time(self):
+        """
+        Время выполнения запросов, секунды
+        """
+        return sum(duration for sql, duration in self._records)
+
+    def shapes(self):
+        """
+        Формы запросов и число запросов каждой формы
+        """
+        return Counter(query_shape(query['sql']) for query in self.queries)
+
+
+def get_url_name(request):
+    """
+    Имя URL, на который пришел запрос, либо None
+    """
+    match = getattr(request, 'resolver_match', None)
+    return match.url_name if match is not None else None
+
+
+def get_budget(url_name):
+    """
+    Бюджет запросов view по имени URL либо None, если бюджета нет
+    """
+    return settings.BOOKING_QUERY_BUDGETS.get(url_name)
+
+
+def describe(url_name, budget, log):
+    lines = [u"%s: %s SQL-запросов при бюджете %s (%.1f мс SQL, %.1f мс "
+             u"всего)" % (url_name, log.count, budget, log.sql_time * 1000,
+                          log.duration * 1000)]
+    for shape, count in log.shapes().most_common(REPORTED_SHAPES):
+        lines.append(u"%5d x %s" % (count, shape))
+    return u"\n".join(lines)
+
+
+def check_budget(url_name, log, budget=None, strict=None):
+    """
+    Сравнение числа запросов log с бюджетом (по умолчанию - бюджетом
+    url_name). Превышение - ошибка QueryBudgetExceeded при strict
+    (по умолчанию BOOKING_QUERY_BUDGET_STRICT), иначе запись в лог.
+    """
+    if budget is None:
+        budget = get_budget(url_name)
+    if budget is None or log.count <= budget:
+        return
+    message = describe(url_name, budget, log)
+    if strict is None:
+        strict = settings.BOOKING_QUERY_BUDGET_STRICT
+    if strict:
+        raise QueryBudgetExceeded(message.encode('utf-8'))
+    logger.warning(message)
+
+
+class QueryBudgetMiddleware(object):
+
+    """
+    Проверка бюджета запросов views из BOOKING_QUERY_BUDGETS
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if get_budget(get_url_name(request)) is not None:
+            setattr(request, QUERY_LOG_ATTR, QueryLog().start())
+
+    def process_response(self, request, response):
+        log = getattr(request, QUERY_LOG_ATTR, None)
+        if log is not None:
+            delattr(request, QUERY_LOG_ATTR)
+            check_budget(get_url_name(request), log.stop())
+        return response
+
+
+class StackCursorWrapper(CursorDebugWrapper):
+
+    """
+    Курсор, сообщающий детектору о каждом запросе до его выполнения
+    """
+
+    def __init__(self, cursor, db, detector):
+        super(StackCursorWrapper, self).__init__(cursor, db)
+        self.detector = detector
+
+    def execute(self, sql, params=None):
+        self.detector.record(sql)
+        return super(StackCursorWrapper, self).execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.detector.record(sql)
+        return super(StackCursorWrapper, self).executemany(sql, param_list)
+
+
+class RepeatedQueriesDetector(object):
+
+    """
+    Повторяющиеся SELECT (N+1) между start() и stop() и места их вызова
+    """
+
+    def __init__(self, threshold=None):
+        if threshold is None:
+            threshold = settings.BOOKING_REPEATED_QUERIES_THRESHOLD
+        self.threshold = threshold
+        # Форма запроса - список мест вызова (строка кода, тег шаблона)
+        self.sites = {}
+        self._db = None
+        self._saved = None
+        self._use_debug_cursor = None
+        self._paths = {}
+        self._template_lines = {}
+
+    def start(self):
+        db = self._db = connections[DEFAULT_DB_ALIAS]
+        self._saved = vars(db).get('make_debug_cursor')
+        self._use_debug_cursor = db.use_debug_cursor
+        db.make_debug_cursor = lambda cursor: StackCursorWrapper(
+            cursor, db, self)
+        db.use_debug_cursor = True
+        return self
+
+    def stop(self):
+        db = self._db
+        if self._saved is None:
+            del db.make_debug_cursor
+        else:
+            db.make_debug_cursor = self._saved
+        db.use_debug_cursor = self._use_debug_cursor
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def record(self, sql):
+        shape = query_shape(sql)
+        if not shape.startswith('SELECT'):
+            return
+        # Кадры record() и execute() курсора пропускаются
+        self.sites.setdefault(shape, []).append(
+            self.call_site(sys._getframe(2)))
+
+    def project_path(self, filename):
+        """
+        Путь файла относительно каталога проекта либо None для файлов вне
+        проекта и этого модуля
+        """
+        path = self._paths.get(filename, False)
+        if path is False:
+            path = os.path.abspath(filename)
+            if (os.path.splitext(path)[0] ==
+                    os.path.splitext(os.path.abspath(__file__))[0] or
+                    not path.startswith(PROJECT_ROOT + os.sep)):
+                path = None
+            else:
+                path = path[len(PROJECT_ROOT) + 1:]
+            self._paths[filename] = path
+        return path
+
+    def call_site(self, frame):
+        """
+        Место вызова запроса: (файл, строка, функция) последнего кадра кода
+        проекта и источник (origin, (начало, конец)) последнего тега шаблона
+        """
+        code_site = template_site = None
+        while frame is not None and (code_site is None or
+                                     template_site is None):
+            code = frame.f_code
+            if code_site is None:
+                path = self.project_path(code.co_filename)
+                if path is not None:
+                    code_site = (path, frame.f_lineno, code.co_name)
+            if template_site is None:
+                # type(), а не isinstance(): isinstance() вычисляет ленивые
+                # объекты (request.user), то есть выполняет запросы
+                owner_type = type(frame.f_locals.get('self'))
+                if issubclass(owner_type, Node):
+                    # source есть у узлов только при TEMPLATE_DEBUG
+                    template_site = getattr(frame.f_locals['self'], 'source',
+                                            None)
+                elif issubclass(owner_type, Template):
+                    template_site = (frame.f_locals['self'].name, None)
+            frame = frame.f_back
+        return code_site, template_site
+
+    def template_location(self, source):
+        origin, position = source
+        name = getattr(origin, 'name', origin) or u'<template>'
+        if name.startswith(PROJECT_ROOT + os.sep):
+            name = name[len(PROJECT_ROOT) + 1:]
+        if position is None:
+            return name
+        key = (name, position[0])
+        if key not in self._template_lines:
+            try:
+                text = origin.reload()
+            except Exception:
+                self._template_lines[key] = None
+            else:
+                self._template_lines[key] = text[:position[0]].count('\n') + 1
+        line = self._template_lines[key]
+        return name if line is None else u'%s:%s' % (name, line)
+
+    def describe_site(self, site):
+        code_site, template_site = site
+        parts = []
+        if code_site is not None:
+            parts.append(u'%s:%s in %s' % code_site)
+        if template_site is not None:
+            parts.append(u'template %s' % self.template_location(
+                template_site))
+        return u', '.join(parts) or u'<unknown>'
+
+    def repeats(self):
+        """
+        Формы запросов, выполненных не меньше threshold раз, по убыванию
+        числа: список (форма, число, Counter описаний мест вызова)
+        """
+        repeated = [(shape, len(sites)) for shape, sites in self.sites.items()
+                    if len(sites) >= self.threshold]
+        repeated.sort(key=lambda item: (-item[1], item[0]))
+        return [(shape, count, Counter(
+            self.describe_site(site) for site in self.sites[shape]))
+                for shape, count in repeated]
+
+    def describe(self, label):
+        repeats = self.repeats()
+        lines = [u"%s: повторяющиеся запросы (%s форм)" % (label,
+                                                           len(repeats))]
+        for shape, count, sites in repeats:
+            lines.append(u"%5d x %s" % (count, shape))
+            for site, site_count in sites.most_common(REPORTED_SITES):
+                lines.append(u"        %5d x %s" % (site_count, site))
+        return u"\n".join(lines)
+
+    def check(self, label, strict=None):
+        """
+        Повторяющиеся запросы - ошибка RepeatedQueries при strict (по
+        умолчанию BOOKING_REPEATED_QUERIES_STRICT), иначе запись в лог
+        """
+        if not self.repeats():
+            return
+        message = self.describe(label)
+        if strict is None:
+            strict = settings.BOOKING_REPEATED_QUERIES_STRICT
+        if strict:
+            raise RepeatedQueries(message.encode('utf-8'))
+        logger.warning(message)
+
+
+class RepeatedQueriesMiddleware(object):
+
+    """
+    Поиск N+1 в views и шаблонах при BOOKING_REPEATED_QUERIES_DETECTION
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if settings.BOOKING_REPEATED_QUERIES_DETECTION:
+            setattr(request, DETECTOR_ATTR, RepeatedQueriesDetector().start())
+
+    def process_response(self, request, response):
+        detector = getattr(request, DETECTOR_ATTR, None)
+        if detector is not None:
+            delattr(request, DETECTOR_ATTR)
+            detector.stop().check(get_url_name(request) or request.path)
+        return response
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+"""
+Журнал движения денег (LedgerEntry) и снимки остатков (BalanceSnapshot).
+
+Журнал - журнал аудита: каждое изменение денег на счету - новая строка
+журнала, строки журнала не изменяются. Остаток счета пользователя хранится
+в UserProfile.cash, его изменяют и проверяют запросы (хватает ли заказчику
+средств, остаток в шапке сайта). Сумма на счету и журнал изменяются одним
+запросом (UserProfile.post_cash), поэтому журнал не добавляет запросов к
+переводу денег, но и не снимает конкуренции за строку профиля.
+
+Остаток счета по журналу - последний снимок остатка плюс сумма операций
+после него, поэтому для его вычисления не нужно суммировать весь журнал.
+Снимки создаются периодически (команда snapshot_ledger), verify() находит
+счета пользователей и счет системы, остаток которых не совпадает с остатком
+по журналу.
+"""
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Sum
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import BalanceSnapshot, LedgerEntry, SystemAccount, \
+    SystemAccountStripe, UserProfile
+
+
+# Снимки остатков всех счетов с операциями после их последних снимков.
+# В снимок входят только операции старше BOOKING_LEDGER_SNAPSHOT_LAG: более
+# поздние операции могут принадлежать еще не зафиксированным транзакциям,
+# и операция с меньшим id, зафиксированная после снимка, в остаток не попала
+# бы.
+SNAPSHOT_SQL = """
+INSERT INTO booking_balancesnapshot (user_id, balance, last_entry_id, date)
+SELECT e.user_id, COALESCE(s.balance, 0) + SUM(e.amount), MAX(e.id), now()
+FROM booking_ledgerentry e
+LEFT JOIN (
+    SELECT DISTINCT ON (user_id) user_id, balance, last_entry_id
+    FROM booking_balancesnapshot
+    ORDER BY user_id, last_entry_id DESC
+) s ON s.user_id IS NOT DISTINCT FROM e.user_id
+WHERE e.id > COALESCE(s.last_entry_id, 0) AND e.date < %s
+GROUP BY e.user_id, s.balance
+"""
+
+# Остатки счетов пользователей: UserProfile.cash и остаток по журналу
+BALANCES_SQL = """
+SELECT p.user_id, p.cash, COALESCE(s.balance, 0) + COALESCE((
+    SELECT SUM(e.amount) FROM booking_ledgerentry e
+    WHERE e.user_id = p.user_id AND e.id > COALESCE(s.last_entry_id, 0)), 0)
+FROM booking_userprofile p
+LEFT JOIN (
+    SELECT DISTINCT ON (user_id) user_id, balance, last_entry_id
+    FROM booking_balancesnapshot
+    WHERE user_id IS NOT NULL
+    ORDER BY user_id, last_entry_id DESC
+) s ON s.user_id = p.user_id
+"""
+
+
+def account_filter(user_id):
+    """
+    Условие отбора строк счета пользователя user_id (None - счет системы)
+    """
+    if user_id is None:
+        return {'user__isnull': True}
+    return {'user_id': user_id}
+
+
+def get_balance(user_id=None):
+    """
+    Остаток счета по журналу: последний снимок плюс операции после него
+    """
+    snapshot = BalanceSnapshot.objects.filter(
+        **account_filter(user_id)).order_by('-last_entry_id').values_list(
+            'balance', 'last_entry_id').first()
+    balance, last_entry_id = snapshot or (0, 0)
+    tail = LedgerEntry.objects.filter(
+        id__gt=last_entry_id, **account_filter(user_id)).aggregate(
+            total=Sum('amount'))['total']
+    return balance + (tail or 0)
+
+
+def take_snapshots(lag=None):
+    """
+    Снимки остатков счетов. Возвращает число созданных снимков.
+    """
+    if lag is None:
+        lag = settings.BOOKING_LEDGER_SNAPSHOT_LAG
+    cutoff = timezone.now() - timedelta(seconds=lag)
+    with transaction.atomic():
+        cursor = connection.cursor()
+        cursor.execute(SNAPSHOT_SQL, [cutoff])
+        return cursor.rowcount
+
+
+def get_system_balance():
+    """
+    Остаток счета системы: суммы счетов и их частей
+    """
+    account = SystemAccount.objects.aggregate(total=Sum('account'))['total']
+    stripes = SystemAccountStripe.objects.aggregate(
+        total=Sum('amount'))['total']
+    return (account or 0) + (stripes or 0)
+
+
+def verify():
+    """
+    Счета, остаток которых не совпадает с остатком по журналу. Список
+    (id пользователя, остаток, остаток по журналу); счет системы - с id
+    None.
+    """
+    cursor = connection.cursor()
+    cursor.execute(BALANCES_SQL)
+    mismatches = [(user_id, cash, balance) for user_id, cash, balance
+                  in cursor.fetchall() if cash != balance]
+    system_balance, balance = get_system_balance(), get_balance()
+    if system_balance != balance:
+        mismatches.append((None, system_balance, balance))
+    return mismatches
+
+
+def refresh_cached_balance(user_id):
+    """
+    Исправление остатка пользователя: замена UserProfile.cash остатком по
+    журналу
+    """
+    with transaction.atomic():
+        profile = UserProfile.objects.select_for_update().get(user_id=user_id)
+        profile.cash = get_balance(user_id)
+        profile.save(update_fields=['cash'])
+    return profile.cash
+
+
+@receiver(post_save, sender=UserProfile)
+def profile_created(sender, instance, created=False, raw=False, **kwargs):
+    if created and not raw and instance.cash:
+        LedgerEntry.objects.create(user_id=instance.user_id,
+                                   amount=instance.cash,
+                                   kind=LedgerEntry.OPENING)
+
+
+@receiver(post_save, sender=SystemAccount)
+def system_account_created(sender, instance, created=False, raw=False,
+                           **kwargs):
+    if created and not raw and instance.account:
+        LedgerEntry.objects.create(user=None, amount=instance.account,
+                                   kind=LedgerEntry.OPENING)
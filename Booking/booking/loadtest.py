@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+
+"""
+Нагрузочный тест: одновременные сессии заказчиков и исполнителей.
+
+Запросы выполняются WSGI-приложением проекта (Booking/wsgi.py) в этом же
+процессе, без сети, из пула потоков. Каждый поток берет случайного
+виртуального пользователя и выполняет его следующее действие:
+
+- заказчик создает заказы (по bookings на заказчика), подтверждает одного
+  из претендентов и завершает выполняющиеся заказы;
+- исполнитель смотрит список заказов и подает заявку на случайный
+  незавершенный заказ, поэтому несколько исполнителей соревнуются за один
+  заказ.
+
+Действия одного пользователя выполняются последовательно, разные
+пользователи - параллельно. Для каждого имени URL записываются задержки
+и исходы запросов: успех, отказ (например, повторная заявка), конфликт
+(статус заказа уже изменен параллельным запросом, либо ответ 409 на запрос
+с тем же ключом идемпотентности) и ошибка (ответ 5xx или исключение).
+
+После теста очередь расчетов обрабатывается до конца и проверяется, что
+деньги не появились и не пропали: сумма на счетах и в удержаниях
+участников плюс комиссия системы равна начальной сумме, удержания
+совпадают с EscrowHold, журнал совпадает с кэшем остатков.
+
+Тест создает пользователей с префиксом имени и не удаляет их, поэтому
+запускается только на тестовой или отдельной базе.
+"""
+
+import json
+import random
+import threading
+import timeit
+import uuid
+from decimal import Decimal
+from importlib import import_module
+from StringIO import StringIO
+from urllib import urlencode
+
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY, BACKEND_SESSION_KEY, \
+    HASH_SESSION_KEY
+from django.contrib.auth.models import User, Group, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.db.models import Sum
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+
+from .benchmark import percentile
+from .models import Booking, EscrowHold, FeedEntry, SystemAccount, \
+    UserProfile
+from .transitions import WRONG_STATUS
+from . import idempotency, ledger, roles, settlement
+
+
+OK = "ok"
+REJECTED = "rejected"
+CONFLICT = "conflict"
+ERROR = "error"
+
+OUTCOMES = (OK, REJECTED, CONFLICT, ERROR)
+
+# Сумма на счету заказчика в начале теста
+INITIAL_CASH = Decimal('1000.00')
+
+# Число заказов, из которых исполнитель выбирает заказ для заявки
+CANDIDATES = 20
+
+
+def get_wsgi_application():
+    from Booking.wsgi import application
+    return application
+
+
+def get_group(name, codenames):
+    """
+    Группа name с правами codenames на заказы
+    """
+    group, created = Group.objects.get_or_create(name=name)
+    group.permissions.add(*Permission.objects.filter(
+        content_type=ContentType.objects.get_for_model(Booking),
+        codename__in=codenames))
+    return group
+
+
+def open_session(user):
+    """
+    Сессия вошедшего пользователя (как после входа по паролю). Возвращает
+    ключ сессии.
+    """
+    engine = import_module(settings.SESSION_ENGINE)
+    session = engine.SessionStore()
+    session[SESSION_KEY] = user.pk
+    session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.save()
+    return session.session_key
+
+
+class VirtualUser(object):
+
+    """
+    Пользователь со своей сессией и CSRF-токеном
+    """
+
+    def __init__(self, user, is_customer):
+        self.user = user
+        self.is_customer = is_customer
+        self.session_key = open_session(user)
+        self.csrf_token = get_random_string(32)
+        self.lock = threading.Lock()
+        # Число созданных заказов (для заказчика)
+        self.created = 0
+        self.done = False
+
+    def get_cookie(self):
+        return '%s=%s; %s=%s' % (
+            settings.SESSION_COOKIE_NAME, self.session_key,
+            settings.CSRF_COOKIE_NAME, self.csrf_token)
+
+
+class LoadTest(object):
+
+    """
+    Нагрузочный тест: customers заказчиков, performers исполнителей, по
+    bookings заказов у каждого заказчика, threads потоков. Тест
+    заканчивается, когда все заказы завершены, либо через duration секунд.
+    """
+
+    def __init__(self, customers=100, performers=100, bookings=5, threads=16,
+                 duration=300, seed=None, prefix=None):
+        self.customers = customers
+        self.performers = performers
+        self.bookings = bookings
+        self.threads = threads
+        self.duration = duration
+        self.seed = seed
+        self.prefix = prefix or 'loadtest_%s_' % get_random_string(
+            6, 'abcdefghijklmnopqrstuvwxyz0123456789')
+        self.application = get_wsgi_application()
+        self.latencies = {}
+        self.outcomes = {}
+        self._stats_lock = threading.Lock()
+        self.elapsed = None
+
+    # Подготовка
+
+    def create_users(self, role, count, codenames, cash):
+        group = get_group(role, codenames)
+        users = []
+        for i in range(count):
+            user = User.objects.create_user(
+                '%s%s%s' % (self.prefix, role, i), password=None)
+            user.groups.add(group)
+            UserProfile.objects.create(user=user, cash=cash)
+            users.append(user)
+        return users
+
+    def setup(self):
+        customers = self.create_users(
+            roles.CUSTOMERS, self.customers, ('add_booking',), INITIAL_CASH)
+        performers = self.create_users(
+            roles.PERFORMERS, self.performers, ('perform_perm',), 0)
+        self.customer_users = [VirtualUser(user, True) for user in customers]
+        self.performer_users = [VirtualUser(user, False)
+                                for user in performers]
+        self.system_balance = SystemAccount.objects.get().get_balance()
+        # Цены заказов таковы, что заказчику хватает средств на все заказы
+        self.max_price = int(INITIAL_CASH / self.bookings)
+
+    # Запросы
+
+    def record(self, url_name, elapsed, outcome):
+        with self._stats_lock:
+            self.latencies.setdefault(url_name, []).append(elapsed)
+            outcomes = self.outcomes.setdefault(
+                url_name, dict((name, 0) for name in OUTCOMES))
+            outcomes[outcome] += 1
+
+    def request(self, vuser, method, url_name, data=None, ajax=False):
+        """
+        Запрос пользователя vuser к WSGI-приложению. Возвращает исход.
+        """
+        body = urlencode(data or {}, doseq=True)
+        environ = {
+            'REQUEST_METHOD': method,
+            'PATH_INFO': reverse(url_name),
+            'SCRIPT_NAME': '',
+            'QUERY_STRING': '',
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '80',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'HTTP_HOST': 'localhost',
+            'HTTP_COOKIE': vuser.get_cookie(),
+            'HTTP_X_CSRFTOKEN': vuser.csrf_token,
+            'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': StringIO(body),
+            'wsgi.errors': StringIO(),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        if ajax:
+            environ['HTTP_X_REQUESTED_WITH'] = 'XMLHttpRequest'
+        if method == 'POST':
+            environ[idempotency.HEADER] = uuid.uuid4().hex
+        statuses = []
+
+        def start_response(status, headers, exc_info=None):
+            statuses.append(int(status.split()[0]))
+
+        started = timeit.default_timer()
+        try:
+            result = self.application(environ, start_response)
+            try:
+                content = ''.join(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except Exception:
+            outcome = ERROR
+        else:
+            outcome = self.get_outcome(statuses[0], content, ajax)
+        self.record(url_name, timeit.default_timer() - started, outcome)
+        return outcome
+
+    def get_outcome(self, status, content, ajax):
+        if status >= 500:
+            return ERROR
+        if status == 409:
+            return CONFLICT
+        if status >= 400:
+            return REJECTED
+        if ajax:
+            data = json.loads(content)
+            if not data.get('success'):
+                if data.get('request_status') == WRONG_STATUS:
+                    return CONFLICT
+                return REJECTED
+        return OK
+
+    # Сценарии
+
+    def customer_step(self, vuser, rnd):
+        if vuser.created < self.bookings:
+            if self.request(vuser, 'POST', 'create-booking', {
+                    'title': 'load %s' % vuser.created, 'text': 'text',
+                    'price': rnd.randint(1, self.max_price)}) == OK:
+                vuser.created += 1
+            return
+        bookings = Booking.objects.filter(customer=vuser.user).exclude(
+            status__in=(Booking.COMPLETED, Booking.COMPLETING))
+        running = bookings.filter(status=Booking.RUNNING).values_list(
+            'pk', flat=True).first()
+        if running is not None:
+            self.request(vuser, 'POST', 'complete-booking', {'id': running},
+                         ajax=True)
+            return
+        waiting = bookings.filter(
+            status=Booking.WAITING_FOR_APPROVAL).values_list(
+                'pk', flat=True).first()
+        if waiting is not None:
+            applicants = list(Booking.possible_performers.through.objects.filter(
+                booking_id=waiting).values_list('user_id', flat=True))
+            if applicants:
+                self.request(vuser, 'POST', 'approve-booking', {
+                    'booking_id': waiting,
+                    'possible_performer': rnd.choice(applicants)}, ajax=True)
+            return
+        if not bookings.exists():
+            vuser.done = True
+
+    def performer_step(self, vuser, rnd):
+        self.request(vuser, 'GET', 'booking-list')
+        candidates = list(FeedEntry.objects.filter(
+            status__in=(Booking.PENDING, Booking.WAITING_FOR_APPROVAL),
+            customer_username__startswith=self.prefix).exclude(
+                booking__possible_performers=vuser.user).values_list(
+                    'booking_id', flat=True)[:CANDIDATES])
+        if candidates:
+            self.request(vuser, 'POST', 'serve-booking',
+                         {'id': rnd.choice(candidates)}, ajax=True)
+
+    def finished(self):
+        return (timeit.default_timer() > self.deadline or
+                all(vuser.done for vuser in self.customer_users))
+
+    def worker(self, number):
+        rnd = random.Random(None if self.seed is None else self.seed + number)
+        users = self.customer_users + self.performer_users
+        try:
+            while not self.finished():
+                vuser = rnd.choice(users)
+                if vuser.done or not vuser.lock.acquire(False):
+                    continue
+                try:
+                    if vuser.is_customer:
+                        self.customer_step(vuser, rnd)
+                    else:
+                        self.performer_step(vuser, rnd)
+                finally:
+                    vuser.lock.release()
+        finally:
+            connection.close()
+
+    def run(self):
+        """
+        Подготовка, тест и проверка денег. Возвращает отчет (см. report()).
+        """
+        self.setup()
+        started = timeit.default_timer()
+        self.deadline = started + self.duration
+        threads = [threading.Thread(target=self.worker, args=(number,),
+                                    name='loadtest-%s' % number)
+                   for number in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = timeit.default_timer() - started
+        while settlement.process_batch()[0]:
+            pass
+        return self.report()
+
+    # Результаты
+
+    def check_invariants(self):
+        """
+        Нарушения сохранения денег: список сообщений
+        """
+        problems = []
+        profiles = UserProfile.objects.filter(
+            user__username__startswith=self.prefix)
+        totals = profiles.aggregate(cash=Sum('cash'), held=Sum('held'))
+        commission = (SystemAccount.objects.get().get_balance() -
+                      self.system_balance)
+        initial = INITIAL_CASH * self.customers
+        total = totals['cash'] + totals['held'] + commission
+        if total != initial:
+            problems.append(u"Сумма на счетах %s, в начале теста %s" % (
+                total, initial))
+        if profiles.filter(cash__lt=0).exists():
+            problems.append(u"Отрицательный остаток на счету")
+        holds = EscrowHold.objects.filter(
+            customer__username__startswith=self.prefix).aggregate(
+                total=Sum('amount'))['total'] or 0
+        if holds != totals['held']:
+            problems.append(u"Удержания %s, в профилях %s" % (
+                holds, totals['held']))
+        if EscrowHold.objects.filter(
+                customer__username__startswith=self.prefix,
+                booking__status=Booking.COMPLETED).exists():
+            problems.append(u"Удержание по завершенному заказу")
+        user_ids = set(profiles.values_list('user_id', flat=True))
+        for user_id, cash, balance in ledger.verify():
+            if user_id in user_ids:
+                problems.append(u"Остаток пользователя %s: %s, по журналу %s"
+                                % (user_id, cash, balance))
+        return problems
+
+    def report(self):
+        """
+        Пропускная способность, задержки (миллисекунды) и исходы запросов
+        по именам URL, нарушения сохранения денег
+        """
+        urls = {}
+        total = 0
+        for url_name, latencies in self.latencies.items():
+            latencies = sorted(latencies)
+            total += len(latencies)
+            urls[url_name] = dict(
+                count=len(latencies),
+                p50=percentile(latencies, 0.5) * 1000,
+                p95=percentile(latencies, 0.95) * 1000,
+                p99=percentile(latencies, 0.99) * 1000,
+                **self.outcomes[url_name])
+        completed = Booking.objects.filter(
+            customer__username__startswith=self.prefix,
+            status=Booking.COMPLETED).count()
+        return {
+            'date': timezone.now().isoformat(),
+            'customers': self.customers,
+            'performers': self.performers,
+            'threads': self.threads,
+            'elapsed': self.elapsed,
+            'requests': total,
+            'throughput': total / self.elapsed if self.elapsed else 0,
+            'bookings': self.customers * self.bookings,
+            'completed': completed,
+            'urls': urls,
+            'problems': self.check_invariants(),
+        }
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+
+"""
+Перенос частей счета системы на счет. Запускается периодически (cron).
+"""
+
+from django.core.management.base import BaseCommand
+
+from booking.models import SystemAccount
+
+
+class Command(BaseCommand):
+
+    help = u"Переносит суммы частей счета системы на счет"
+
+    def handle(self, *args, **options):
+        for system_account in SystemAccount.objects.all():
+            total = system_account.compact()
+            self.stdout.write(u"Счет %s: перенесено %s, остаток %s" % (
+                system_account.pk, total, system_account.account))
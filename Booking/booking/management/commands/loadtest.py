@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+"""
+Нагрузочный тест работы с заказами (см. loadtest.py). Создает
+пользователей, поэтому запускается только на тестовой или отдельной базе.
+"""
+
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from booking import loadtest
+
+
+class Command(BaseCommand):
+
+    help = u"Нагрузочный тест: одновременные сессии заказчиков и исполнителей"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--customers', type='int', default=100,
+                    help=u"Число заказчиков"),
+        make_option('--performers', type='int', default=100,
+                    help=u"Число исполнителей"),
+        make_option('--bookings', type='int', default=5,
+                    help=u"Число заказов одного заказчика"),
+        make_option('--threads', type='int', default=16,
+                    help=u"Число потоков"),
+        make_option('--duration', type='float', default=300,
+                    help=u"Наибольшая длительность теста, секунды"),
+        make_option('--seed', type='int', default=None,
+                    help=u"Начальное значение генератора случайных чисел"),
+        make_option('--prefix', default=None,
+                    help=u"Префикс имен создаваемых пользователей"),
+        make_option('--json', action='store_true', default=False,
+                    help=u"Вывести отчет в JSON"),
+    )
+
+    def handle(self, *args, **options):
+        report = loadtest.LoadTest(
+            options['customers'], options['performers'], options['bookings'],
+            options['threads'], options['duration'], options['seed'],
+            options['prefix']).run()
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
+        else:
+            self.write_report(report)
+        if report['problems']:
+            raise CommandError(u"Нарушено сохранение денег:\n" + u"\n".join(
+                report['problems']))
+
+    def write_report(self, report):
+        self.stdout.write(
+            u"Запросов: %(requests)s за %(elapsed).1f с, %(throughput).1f в "
+            u"секунду. Завершено заказов: %(completed)s из %(bookings)s."
+            % report)
+        self.stdout.write(u"%-20s %7s %8s %8s %8s %8s %8s %8s" % (
+            u"URL", u"count", u"p50, мс", u"p95, мс", u"p99, мс",
+            u"rejected", u"conflict", u"error"))
+        for url_name in sorted(report['urls']):
+            stats = report['urls'][url_name]
+            self.stdout.write(
+                u"%-20s %7d %8.1f %8.1f %8.1f %7.1f%% %7.1f%% %7.1f%%" % (
+                    url_name, stats['count'], stats['p50'], stats['p95'],
+                    stats['p99'],
+                    100.0 * stats[loadtest.REJECTED] / stats['count'],
+                    100.0 * stats[loadtest.CONFLICT] / stats['count'],
+                    100.0 * stats[loadtest.ERROR] / stats['count']))
+        if not report['problems']:
+            self.stdout.write(u"Сохранение денег не нарушено.")
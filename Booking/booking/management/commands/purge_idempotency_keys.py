@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+
+"""
+Удаление истекших ключей идемпотентности. Запускается периодически (cron).
+"""
+
+from django.core.management.base import BaseCommand
+
+from booking import idempotency
+
+
+class Command(BaseCommand):
+
+    help = u"Удаляет истекшие ключи идемпотентности"
+
+    def handle(self, *args, **options):
+        self.stdout.write(u"Удалено ключей: %s" % idempotency.purge())
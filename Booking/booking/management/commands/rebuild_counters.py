@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+"""
+Перестроение счетчиков заказов
+"""
+
+from django.core.management.base import BaseCommand
+
+from booking import counters
+from booking.models import BookingCounter
+
+
+class Command(BaseCommand):
+
+    help = u"Перестраивает счетчики заказов по таблице заказов"
+
+    def handle(self, *args, **options):
+        counters.rebuild()
+        self.stdout.write(u"Счетчиков: %s" % BookingCounter.objects.count())
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+"""
+Перестроение ленты незавершенных заказов
+"""
+
+from django.core.management.base import BaseCommand
+
+from booking import feed
+from booking.models import FeedEntry
+
+
+class Command(BaseCommand):
+
+    help = u"Перестраивает ленту незавершенных заказов по таблице заказов"
+
+    def handle(self, *args, **options):
+        feed.rebuild()
+        self.stdout.write(u"Строк в ленте: %s" % FeedEntry.objects.count())
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+"""
+Генерация синтетических данных (см. seed.py). Создает пользователей и
+заказы, поэтому запускается только на отдельной базе.
+"""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from booking import seed
+
+
+class Command(BaseCommand):
+
+    help = u"Создает синтетических пользователей, заказы и комментарии"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--customers', type='int', default=1000,
+                    help=u"Число заказчиков"),
+        make_option('--performers', type='int', default=1000,
+                    help=u"Число исполнителей"),
+        make_option('--bookings', type='int', default=10000,
+                    help=u"Число заказов"),
+        make_option('--statuses', default=None,
+                    help=u"Доли статусов заказов, например "
+                         u"pending=30,waiting_for_approval=15,running=10,"
+                         u"completing=5,completed=40"),
+        make_option('--price-median', type='float', default=50,
+                    help=u"Медиана цены заказа"),
+        make_option('--price-sigma', type='float', default=0.8,
+                    help=u"Разброс цен (sigma логнормального распределения)"),
+        make_option('--cash-max', type='float', default=2000,
+                    help=u"Наибольшая сумма на счету пользователя"),
+        make_option('--applicants', type='int', default=5,
+                    help=u"Наибольшее число претендентов на заказ"),
+        make_option('--comments', type='int', default=3,
+                    help=u"Наибольшее число комментариев к заказу"),
+        make_option('--days', type='int', default=365,
+                    help=u"За сколько последних дней созданы заказы"),
+        make_option('--seed', type='int', default=0,
+                    help=u"Начальное значение генератора случайных чисел"),
+        make_option('--prefix', default='seed',
+                    help=u"Префикс имен создаваемых пользователей"),
+        make_option('--password', default='password',
+                    help=u"Пароль создаваемых пользователей"),
+        make_option('--chunk-size', type='int', default=50000,
+                    help=u"Число строк в одной команде COPY"),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            statuses = (seed.parse_statuses(options['statuses'])
+                        if options['statuses'] else seed.STATUS_MIX)
+            seeder = seed.Seeder(
+                options['customers'], options['performers'],
+                options['bookings'], statuses, options['price_median'],
+                options['price_sigma'], options['cash_max'],
+                options['applicants'], options['comments'], options['days'],
+                options['seed'], options['prefix'], options['password'],
+                options['chunk_size'])
+            report = seeder.run()
+        except ValueError as error:
+            raise CommandError(error.message)
+        for table in sorted(report):
+            if table != 'elapsed':
+                self.stdout.write(u"%-40s %10d" % (table, report[table]))
+        self.stdout.write(u"Время: %.1f с" % report['elapsed'])
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+"""
+Завершение выполняющихся заказов с переводом денег исполнителям, порциями
+(см. transitions.complete_many).
+"""
+
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from booking.models import Booking
+from booking.transitions import TransitionError
+from booking import escrow, transitions
+
+
+class Command(BaseCommand):
+
+    args = u"[id заказа ...]"
+    help = u"Завершает выполняющиеся заказы и переводит деньги исполнителям"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--customer',
+                    help=u"Завершить выполняющиеся заказы заказчика "
+                         u"(имя пользователя)"),
+        make_option('--batch-size', type='int', default=500,
+                    help=u"Число заказов в одной транзакции"),
+    )
+
+    def handle(self, *args, **options):
+        customer = None
+        if options['customer']:
+            try:
+                customer = User.objects.get(username=options['customer'])
+            except User.DoesNotExist:
+                raise CommandError(u"Пользователь %s не найден" %
+                                   options['customer'])
+        if args:
+            booking_ids = list(args)
+        elif customer is not None:
+            booking_ids = list(Booking.objects.filter(
+                customer=customer, status=Booking.RUNNING).order_by(
+                    'pk').values_list('pk', flat=True))
+        else:
+            raise CommandError(u"Укажите id заказов или заказчика")
+
+        batch_size = options['batch_size']
+        total_system = total_performers = 0
+        count = 0
+        for start in range(0, len(booking_ids), batch_size):
+            try:
+                with transaction.atomic():
+                    split = transitions.complete_many(
+                        booking_ids[start:start + batch_size], customer)
+            except TransitionError as e:
+                raise CommandError(e.message)
+            finally:
+                escrow.flush()
+            for booking_id, cash_for_system, cash_for_performer in split:
+                self.stdout.write(u"Заказ %s: комиссия %s, исполнителю %s" % (
+                    booking_id, cash_for_system, cash_for_performer))
+                total_system += cash_for_system
+                total_performers += cash_for_performer
+            count += len(split)
+        self.stdout.write(u"Завершено заказов: %s, комиссия %s, исполнителям "
+                          u"%s" % (count, total_system, total_performers))
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+"""
+Обработчик очереди расчетов (см. settlement.py). Запускается в нескольких
+процессах под супервизором.
+"""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from booking import settlement
+
+
+class Command(BaseCommand):
+
+    help = u"Переводит деньги по заказам из очереди расчетов"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=None,
+                    help=u"Число заданий в одной транзакции"),
+        make_option('--interval', type='float', default=None,
+                    help=u"Период проверки пустой очереди, секунды"),
+        make_option('--once', action='store_true', default=False,
+                    help=u"Обработать очередь и завершиться"),
+        make_option('--stats', action='store_true', default=False,
+                    help=u"Вывести состояние очереди и завершиться"),
+    )
+
+    def handle(self, *args, **options):
+        if not options['stats']:
+            settlement.run(options['batch_size'], options['interval'],
+                           options['once'])
+        stats = settlement.queue_stats()
+        self.stdout.write(u"В очереди: %(depth)s, с ошибкой: %(failed)s, "
+                          u"ожидание: %(lag).1f с" % stats)
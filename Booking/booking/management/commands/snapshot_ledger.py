@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+"""
+Снимки остатков счетов по журналу операций. Запускается периодически (cron).
+"""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from booking import ledger
+
+
+class Command(BaseCommand):
+
+    help = u"Создает снимки остатков счетов по журналу операций"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--verify', action='store_true', default=False,
+                    help=u"Сверить остатки счетов с журналом"),
+    )
+
+    def handle(self, *args, **options):
+        count = ledger.take_snapshots()
+        self.stdout.write(u"Снимков остатков: %s" % count)
+        if options['verify']:
+            for user_id, cash, balance in ledger.verify():
+                if user_id is None:
+                    account = u"Счет системы"
+                else:
+                    account = u"Пользователь %s" % user_id
+                self.stdout.write(u"%s: на счету %s, по журналу %s" % (
+                    account, cash, balance))
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+
+"""
+Метрики запросов к сайту в текстовом формате Prometheus (/metrics).
+
+MetricsMiddleware записывает для каждого запроса его время, число
+SQL-запросов и их время с меткой view - именем URL (booking-list,
+serve-booking и т. д.; для URL без имени - путь к функции view). Метрики
+накапливаются в памяти процесса (Registry), запись - несколько операций со
+словарями под блокировкой.
+
+Все метрики - счетчики и гистограммы, то есть суммы, поэтому метрики
+нескольких процессов (воркеров uWSGI) складываются. Если указан
+BOOKING_METRICS_DIR, каждый процесс после запросов, но не чаще раза в
+BOOKING_METRICS_FLUSH_INTERVAL секунд, сохраняет свои метрики в файл
+<pid>.json этого каталога, а /metrics любого процесса отдает сумму метрик
+всех процессов. Файлы завершившихся процессов удаляются при первом
+сохранении метрик нового процесса (после перезапуска воркеров). Метрики
+очереди расчетов читаются из базы при каждом запросе /metrics.
+
+/metrics доступен только с адресов BOOKING_METRICS_ALLOWED_IPS либо с
+токеном BOOKING_METRICS_TOKEN в заголовке Authorization: Bearer <токен>.
+
+Для потоковых ответов (API, события) учитывается время до начала ответа.
+"""
+
+import errno
+import json
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponse
+from django.utils.crypto import constant_time_compare
+
+from .instrumentation import QueryLog
+from . import settlement
+
+
+# Границы корзин гистограмм: время запроса (секунды) и число SQL-запросов
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERIES_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+# Метрики: имя - (тип, описание, имена меток, границы корзин гистограммы)
+METRICS = (
+    ('booking_requests_total', 'counter', 'Requests served',
+     ('view', 'method', 'status'), None),
+    ('booking_request_duration_seconds', 'histogram',
+     'Request processing time', ('view', 'method'), DURATION_BUCKETS),
+    ('booking_request_sql_queries', 'histogram', 'SQL queries per request',
+     ('view', 'method'), QUERIES_BUCKETS),
+    ('booking_sql_queries_total', 'counter', 'SQL queries',
+     ('view', 'method'), None),
+    ('booking_sql_seconds_total', 'counter', 'SQL query time',
+     ('view', 'method'), None),
+)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Атрибут запроса к сайту с его QueryLog
+QUERY_LOG_ATTR = '_booking_metrics_log'
+
+
+class Registry(object):
+
+    """
+    Метрики процесса. Значение счетчика - число, значение гистограммы -
+    список: число значений в каждой корзине, сумма значений, число
+    значений.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flushed = 0
+        self._started = False
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.values = dict((name, {}) for name, kind, help_text, labels,
+                               buckets in METRICS)
+
+    def inc(self, name, labels, amount=1):
+        with self._lock:
+            values = self.values[name]
+            values[labels] = values.get(labels, 0) + amount
+
+    def observe(self, name, labels, value, buckets):
+        with self._lock:
+            values = self.values[name]
+            histogram = values.get(labels)
+            if histogram is None:
+                histogram = values[labels] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def snapshot(self):
+        """
+        Копия метрик, пригодная для JSON: имя - список пар (метки, значение)
+        """
+        with self._lock:
+            return dict((name, [
+                [list(labels), list(value) if isinstance(value, list)
+                 else value] for labels, value in values.items()])
+                        for name, values in self.values.items())
+
+    def flush(self, force=False):
+        """
+        Сохранение метрик процесса в BOOKING_METRICS_DIR, если с прошлого
+        сохранения прошло BOOKING_METRICS_FLUSH_INTERVAL секунд
+        """
+        directory = settings.BOOKING_METRICS_DIR
+        now = time.time()
+        if not directory or (
+                not force and
+                now - self._flushed < settings.BOOKING_METRICS_FLUSH_INTERVAL):
+            return
+        self._flushed = now
+        if not self._started:
+            self._started = True
+            remove_stale_files(directory)
+        path = os.path.join(directory, '%s.json' % os.getpid())
+        # Запись во временный файл и переименование, чтобы читающий процесс
+        # не увидел файл записанным наполовину
+        temporary = '%s.%s.tmp' % (path, threading.current_thread().ident)
+        with open(temporary, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.rename(temporary, path)
+
+
+registry = Registry()
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # EPERM - процесс есть, но принадлежит другому пользователю
+        return e.errno == errno.EPERM
+    return True
+
+
+def remove_stale_files(directory):
+    """
+    Удаление файлов метрик (и недописанных временных файлов) завершившихся
+    процессов, чтобы их счетчики не входили в сумму. Возвращает число
+    удаленных файлов.
+    """
+    removed = 0
+    for filename in os.listdir(directory):
+        pid = filename.split('.', 1)[0]
+        if not filename.endswith(('.json', '.tmp')) or not pid.isdigit() or \
+                is_running(int(pid)):
+            continue
+        try:
+            os.remove(os.path.join(directory, filename))
+        except OSError:
+            # Удален другим процессом
+            continue
+        removed += 1
+    return removed
+
+
+def merge(snapshots):
+    """
+    Сумма метрик нескольких процессов: имя - {метки: значение}
+    """
+    merged = dict((name, {}) for name, kind, help_text, labels, buckets
+                  in METRICS)
+    for snapshot in snapshots:
+        for name, values in snapshot.items():
+            if name not in merged:
+                continue
+            target = merged[name]
+            for labels, value in values:
+                labels = tuple(labels)
+                old = target.get(labels)
+                if old is None:
+                    target[labels] = value
+                elif isinstance(value, list):
+                    target[labels] = [a + b for a, b in zip(old, value)]
+                else:
+                    target[labels] = old + value
+    return merged
+
+
+def collect():
+    """
+    Метрики всех процессов: этого процесса из памяти, остальных - из файлов
+    BOOKING_METRICS_DIR
+    """
+    snapshots = [registry.snapshot()]
+    directory = settings.BOOKING_METRICS_DIR
+    if directory:
+        own = '%s.json' % os.getpid()
+        for filename in os.listdir(directory):
+            if not filename.endswith('.json') or filename == own:
+                continue
+            try:
+                with open(os.path.join(directory, filename)) as f:
+                    snapshots.append(json.load(f))
+            except (IOError, ValueError):
+                # Файл удален между чтением каталога и открытием
+                continue
+    return merge(snapshots)
+
+
+def escape(value):
+    return unicode(value).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n')
+
+
+def format_labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    return u'{%s}' % u','.join(u'%s="%s"' % (name, escape(value))
+                               for name, value in pairs)
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return unicode(value)
+
+
+def render(merged):
+    """
+    Метрики в текстовом формате Prometheus
+    """
+    lines = []
+    for name, kind, help_text, label_names, buckets in METRICS:
+        lines.append(u'# HELP %s %s' % (name, help_text))
+        lines.append(u'# TYPE %s %s' % (name, kind))
+        for labels, value in sorted(merged[name].items()):
+            if kind == 'counter':
+                lines.append(u'%s%s %s' % (
+                    name, format_labels(label_names, labels),
+                    format_value(value)))
+                continue
+            for bound, count in zip(buckets + ('+Inf',), value[:-2] + [
+                    value[-1]]):
+                lines.append(u'%s_bucket%s %s' % (
+                    name, format_labels(label_names, labels,
+                                        [('le', bound)]), count))
+            lines.append(u'%s_sum%s %s' % (
+                name, format_labels(label_names, labels),
+                format_value(value[-2])))
+            lines.append(u'%s_count%s %s' % (
+                name, format_labels(label_names, labels), value[-1]))
+    stats = settlement.queue_stats()
+    for name, key, help_text in (
+            ('booking_settlement_queue_depth', 'depth',
+             'Bookings waiting for settlement'),
+            ('booking_settlement_queue_failed', 'failed',
+             'Settlements that failed'),
+            ('booking_settlement_queue_lag_seconds', 'lag',
+             'Age of the oldest waiting settlement')):
+        lines.append(u'# HELP %s %s' % (name, help_text))
+        lines.append(u'# TYPE %s gauge' % name)
+        lines.append(u'%s %s' % (name, format_value(stats[key])))
+    return u'\n'.join(lines) + u'\n'
+
+
+def get_view_label(request):
+    """
+    Метка view: имя URL, для URL без имени - путь к функции view
+    """
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved'
+    return match.url_name or match.view_name
+
+
+class MetricsMiddleware(object):
+
+    """
+    Запись метрик запросов. Должен быть первым в MIDDLEWARE_CLASSES, чтобы
+    учитывались запросы к базе всех остальных middleware.
+    """
+
+    def process_request(self, request):
+        setattr(request, QUERY_LOG_ATTR, QueryLog().start())
+
+    def process_response(self, request, response):
+        log = getattr(request, QUERY_LOG_ATTR, None)
+        if log is None:
+            return response
+        delattr(request, QUERY_LOG_ATTR)
+        log.stop()
+        labels = (get_view_label(request), request.method)
+        registry.inc('booking_requests_total',
+                     labels + (str(response.status_code),))
+        registry.observe('booking_request_duration_seconds', labels,
+                         log.duration, DURATION_BUCKETS)
+        registry.observe('booking_request_sql_queries', labels, log.count,
+                         QUERIES_BUCKETS)
+        registry.inc('booking_sql_queries_total', labels, log.count)
+        registry.inc('booking_sql_seconds_total', labels, log.sql_time)
+        registry.flush()
+        return response
+
+
+def is_allowed(request):
+    """
+    Доступ к /metrics: адрес из BOOKING_METRICS_ALLOWED_IPS либо токен
+    BOOKING_METRICS_TOKEN
+    """
+    token = settings.BOOKING_METRICS_TOKEN
+    if token and constant_time_compare(
+            request.META.get('HTTP_AUTHORIZATION', ''), 'Bearer %s' % token):
+        return True
+    return request.META.get('REMOTE_ADDR') in \
+        settings.BOOKING_METRICS_ALLOWED_IPS
+
+
+def metrics_view(request):
+    """
+    Метрики всех процессов в текстовом формате Prometheus
+    """
+    if not is_allowed(request):
+        raise PermissionDenied
+    registry.flush(force=True)
+    return HttpResponse(render(collect()), content_type=CONTENT_TYPE)
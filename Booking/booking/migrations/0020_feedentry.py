@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('booking', '0019_booking_possible_performers'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeedEntry',
+            fields=[
+                ('booking', models.OneToOneField(related_name='feed_entry', primary_key=True, serialize=False, to='booking.Booking')),
+                ('customer_username', models.CharField(max_length=30)),
+                ('performer_username', models.CharField(max_length=30, null=True, blank=True)),
+                ('price', models.DecimalField(max_digits=8, decimal_places=2)),
+                ('status', models.CharField(max_length=30, choices=[(b'pending', '\u041e\u0436\u0438\u0434\u0430\u0435\u0442 \u0438\u0441\u043f\u043e\u043b\u043d\u0438\u0442\u0435\u043b\u044f'), (b'waiting_for_approval', '\u041e\u0436\u0438\u0434\u0430\u0435\u0442 \u043f\u043e\u0434\u0442\u0432\u0435\u0440\u0436\u0434\u0435\u043d\u0438\u044f \u0437\u0430\u043a\u0430\u0437\u0447\u0438\u043a\u043e\u043c'), (b'running', '\u0412\u0437\u044f\u0442 \u043d\u0430 \u0438\u0441\u043f\u043e\u043b\u043d\u0435\u043d\u0438\u0435'), (b'completed', '\u0417\u0430\u0432\u0435\u0440\u0448\u0435\u043d')])),
+                ('applicants_count', models.PositiveIntegerField(default=0)),
+                ('customer_can_afford', models.BooleanField(default=False)),
+                ('date', models.DateTimeField()),
+                ('customer', models.ForeignKey(related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('performer', models.ForeignKey(related_name='+', blank=True, to=settings.AUTH_USER_MODEL, null=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='feedentry',
+            index_together=set([('date', 'booking')]),
+        ),
+        migrations.RunSQL(
+            """
+            INSERT INTO booking_feedentry (
+                booking_id, customer_id, customer_username, performer_id,
+                performer_username, price, status, applicants_count,
+                customer_can_afford, date)
+            SELECT b.id, b.customer_id, c.username, b.performer_id,
+                   p.username, b.price, b.status,
+                   (SELECT COUNT(*) FROM booking_booking_possible_performers pp
+                    WHERE pp.booking_id = b.id),
+                   COALESCE(up.cash >= b.price, FALSE), b.date
+            FROM booking_booking b
+            JOIN auth_user c ON c.id = b.customer_id
+            LEFT JOIN auth_user p ON p.id = b.performer_id
+            LEFT JOIN booking_userprofile up ON up.user_id = b.customer_id
+            WHERE b.status <> 'completed'
+            """,
+            "DELETE FROM booking_feedentry"
+        ),
+    ]
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+# Поисковый вектор заказа: заголовок (вес A) и текст (вес B). Колонка
+# поддерживается триггером и в модели не описывается.
+FORWARD_SQL = """
+ALTER TABLE booking_booking ADD COLUMN search_vector tsvector;
+
+CREATE FUNCTION booking_search_vector(title text, body text)
+RETURNS tsvector AS $$
+    SELECT setweight(to_tsvector('pg_catalog.russian', coalesce(title, '')), 'A') ||
+           setweight(to_tsvector('pg_catalog.russian', coalesce(body, '')), 'B')
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE FUNCTION booking_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector := booking_search_vector(NEW.title, NEW.text);
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER booking_search_vector_update
+    BEFORE INSERT OR UPDATE OF title, text ON booking_booking
+    FOR EACH ROW EXECUTE PROCEDURE booking_search_vector_update();
+
+UPDATE booking_booking SET search_vector = booking_search_vector(title, text);
+
+CREATE INDEX booking_booking_search_vector
+    ON booking_booking USING gin (search_vector);
+"""
+
+REVERSE_SQL = """
+DROP TRIGGER booking_search_vector_update ON booking_booking;
+DROP FUNCTION booking_search_vector_update();
+DROP FUNCTION booking_search_vector(text, text);
+ALTER TABLE booking_booking DROP COLUMN search_vector;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0021_booking_version'),
+    ]
+
+    operations = [
+        migrations.RunSQL(FORWARD_SQL, REVERSE_SQL),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+# Индексы под выборки списков заказов (ключ упорядочивания - (date, id)):
+# - незавершенные заказы (частичный индекс);
+# - заказы заказчика и заказы исполнителя (ветви UNION списка своих
+#   заказов, см. OwnBookingListView).
+FORWARD_SQL = """
+CREATE INDEX booking_booking_open_date ON booking_booking (date, id)
+    WHERE status <> 'completed';
+CREATE INDEX booking_booking_customer_date
+    ON booking_booking (customer_id, date, id);
+CREATE INDEX booking_booking_performer_date
+    ON booking_booking (performer_id, date, id);
+"""
+
+REVERSE_SQL = """
+DROP INDEX booking_booking_open_date;
+DROP INDEX booking_booking_customer_date;
+DROP INDEX booking_booking_performer_date;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0022_booking_search_vector'),
+    ]
+
+    operations = [
+        migrations.RunSQL(FORWARD_SQL, REVERSE_SQL),
+    ]
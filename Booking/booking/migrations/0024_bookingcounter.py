@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+# Начальные значения счетчиков по существующим заказам
+FILL_SQL = """
+INSERT INTO booking_bookingcounter (name, value)
+SELECT 'status:' || status, COUNT(*) FROM booking_booking GROUP BY status
+UNION ALL
+SELECT 'customer:' || customer_id, COUNT(*) FROM booking_booking
+GROUP BY customer_id
+UNION ALL
+SELECT 'performer:' || performer_id, COUNT(*) FROM booking_booking
+WHERE performer_id IS NOT NULL GROUP BY performer_id
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0023_booking_list_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookingCounter',
+            fields=[
+                ('name', models.CharField(max_length=64, serialize=False, primary_key=True)),
+                ('value', models.IntegerField(default=0)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.RunSQL(FILL_SQL, "DELETE FROM booking_bookingcounter"),
+    ]
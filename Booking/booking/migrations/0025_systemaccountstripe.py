@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from decimal import Decimal
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0024_bookingcounter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SystemAccountStripe',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('stripe', models.PositiveSmallIntegerField()),
+                ('amount', models.DecimalField(default=Decimal('0.00'), max_digits=6, decimal_places=2)),
+                ('account', models.ForeignKey(related_name='stripes', to='booking.SystemAccount')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='systemaccountstripe',
+            unique_together=set([('account', 'stripe')]),
+        ),
+    ]
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+from django.conf import settings
+
+
+# Начальные остатки счетов пользователей и счета системы в журнале операций
+OPENING_SQL = """
+INSERT INTO booking_ledgerentry (user_id, amount, kind, booking_id, date)
+SELECT user_id, cash, 'opening', NULL, now() FROM booking_userprofile
+WHERE cash <> 0;
+INSERT INTO booking_ledgerentry (user_id, amount, kind, booking_id, date)
+SELECT NULL, a.account + COALESCE((
+    SELECT SUM(amount) FROM booking_systemaccountstripe s
+    WHERE s.account_id = a.id), 0), 'opening', NULL, now()
+FROM booking_systemaccount a;
+DELETE FROM booking_ledgerentry WHERE user_id IS NULL AND amount = 0;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('booking', '0025_systemaccountstripe'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceSnapshot',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('balance', models.DecimalField(max_digits=14, decimal_places=2)),
+                ('last_entry_id', models.IntegerField()),
+                ('date', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(related_name='balance_snapshots', blank=True, to=settings.AUTH_USER_MODEL, null=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='LedgerEntry',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('amount', models.DecimalField(max_digits=12, decimal_places=2)),
+                ('kind', models.CharField(max_length=20, choices=[(b'opening', '\u041d\u0430\u0447\u0430\u043b\u044c\u043d\u044b\u0439 \u043e\u0441\u0442\u0430\u0442\u043e\u043a'), (b'hold', '\u041e\u043f\u043b\u0430\u0442\u0430 \u0437\u0430\u043a\u0430\u0437\u0430'), (b'payout', '\u0412\u044b\u043f\u043b\u0430\u0442\u0430 \u0438\u0441\u043f\u043e\u043b\u043d\u0438\u0442\u0435\u043b\u044e'), (b'commission', '\u041a\u043e\u043c\u0438\u0441\u0441\u0438\u044f \u0441\u0438\u0441\u0442\u0435\u043c\u044b'), (b'adjustment', '\u0418\u0441\u043f\u0440\u0430\u0432\u043b\u0435\u043d\u0438\u0435')])),
+                ('date', models.DateTimeField(auto_now_add=True)),
+                ('booking', models.ForeignKey(related_name='ledger_entries', on_delete=django.db.models.deletion.SET_NULL, blank=True, to='booking.Booking', null=True)),
+                ('user', models.ForeignKey(related_name='ledger_entries', on_delete=django.db.models.deletion.PROTECT, blank=True, to=settings.AUTH_USER_MODEL, null=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='ledgerentry',
+            index_together=set([('user', 'id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='balancesnapshot',
+            index_together=set([('user', 'last_entry_id')]),
+        ),
+        migrations.RunSQL(OPENING_SQL, "DELETE FROM booking_ledgerentry"),
+    ]
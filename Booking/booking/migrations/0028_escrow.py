@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+from decimal import Decimal
+
+
+# Удержания выполняющихся заказов, суммы удержаний заказчиков и признак
+# "заказчику хватает средств" существующих заказов. Значения по умолчанию
+# новых столбцов задаются и в базе - для строк, вставляемых в обход моделей.
+FILL_SQL = """
+ALTER TABLE booking_booking ALTER COLUMN affordable SET DEFAULT FALSE;
+ALTER TABLE booking_userprofile ALTER COLUMN held SET DEFAULT 0;
+INSERT INTO booking_escrowhold (customer_id, booking_id, amount, date)
+SELECT customer_id, id, price, now() FROM booking_booking
+WHERE status IN ('running', 'completing');
+UPDATE booking_userprofile p SET held = h.amount
+FROM (SELECT customer_id, SUM(amount) AS amount FROM booking_escrowhold
+      GROUP BY customer_id) h
+WHERE p.user_id = h.customer_id;
+UPDATE booking_booking b SET affordable = TRUE
+FROM booking_userprofile p
+WHERE p.user_id = b.customer_id AND p.cash >= b.price
+  AND b.status <> 'completed';
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('booking', '0027_settlement'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EscrowHold',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('amount', models.DecimalField(max_digits=8, decimal_places=2)),
+                ('date', models.DateTimeField(auto_now_add=True)),
+                ('booking', models.OneToOneField(related_name='hold', to='booking.Booking')),
+                ('customer', models.ForeignKey(related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AddField(
+            model_name='booking',
+            name='affordable',
+            field=models.BooleanField(default=False),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='held',
+            field=models.DecimalField(default=Decimal('0.0'), max_digits=12, decimal_places=2),
+            preserve_default=True,
+        ),
+        migrations.RunSQL(FILL_SQL, "DELETE FROM booking_escrowhold"),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+# Лента незавершенных заказов читается из booking_feedentry (индекс
+# (date, booking_id)), выборок незавершенных заказов из booking_booking нет:
+# частичный индекс только замедляет запись.
+FORWARD_SQL = """
+DROP INDEX booking_booking_open_date;
+"""
+
+REVERSE_SQL = """
+CREATE INDEX booking_booking_open_date ON booking_booking (date, id)
+    WHERE status <> 'completed';
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0028_escrow'),
+    ]
+
+    operations = [
+        migrations.RunSQL(FORWARD_SQL, REVERSE_SQL),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+# Заголовок и текст заказов в ленте: лента читается без соединения с
+# booking_booking
+FILL_SQL = """
+UPDATE booking_feedentry f SET title = b.title, text = b.text
+FROM booking_booking b
+WHERE b.id = f.booking_id;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0030_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feedentry',
+            name='title',
+            field=models.CharField(default='', max_length=100),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='feedentry',
+            name='text',
+            field=models.TextField(default='', max_length=4000),
+            preserve_default=True,
+        ),
+        migrations.RunSQL(FILL_SQL,
+                          "UPDATE booking_feedentry SET title = '', text = ''"),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+# Счетчики статусов переносятся в часть 0 (см. counters.STRIPES)
+STRIPE_SQL = """
+UPDATE booking_bookingcounter SET name = name || ':0'
+WHERE name LIKE 'status:%'
+"""
+
+# Части счетчиков статусов складываются обратно в один счетчик
+MERGE_SQL = """
+INSERT INTO booking_bookingcounter (name, value)
+SELECT 'status:' || split_part(name, ':', 2), SUM(value)
+FROM booking_bookingcounter WHERE name LIKE 'status:%:%'
+GROUP BY split_part(name, ':', 2);
+DELETE FROM booking_bookingcounter WHERE name LIKE 'status:%:%'
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0031_feedentry_title_text'),
+    ]
+
+    operations = [
+        migrations.RunSQL(STRIPE_SQL, MERGE_SQL),
+    ]
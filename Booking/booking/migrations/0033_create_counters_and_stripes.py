@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+# Счетчики пользователей и части счетчиков статусов с нулевыми значениями
+# (см. counters.create_missing)
+CREATE_COUNTERS_SQL = """
+INSERT INTO booking_bookingcounter (name, value)
+SELECT prefix || u.id, 0
+FROM auth_user u, unnest(ARRAY['customer:', 'performer:']) AS prefix
+WHERE NOT EXISTS (SELECT 1 FROM booking_bookingcounter
+                  WHERE name = prefix || u.id);
+INSERT INTO booking_bookingcounter (name, value)
+SELECT 'status:' || status || ':' || stripe, 0
+FROM unnest(ARRAY['pending', 'waiting_for_approval', 'running',
+                  'completing', 'completed']) AS status,
+     generate_series(0, 15) AS stripe
+WHERE NOT EXISTS (SELECT 1 FROM booking_bookingcounter
+                  WHERE name = 'status:' || status || ':' || stripe)
+"""
+
+# Части счетов системы (см. SystemAccount.STRIPES)
+CREATE_ACCOUNT_STRIPES_SQL = """
+INSERT INTO booking_systemaccountstripe (account_id, stripe, amount)
+SELECT a.id, g.stripe, 0
+FROM booking_systemaccount a, generate_series(0, 15) AS g(stripe)
+WHERE NOT EXISTS (SELECT 1 FROM booking_systemaccountstripe s
+                  WHERE s.account_id = a.id AND s.stripe = g.stripe)
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0032_status_counter_stripes'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_COUNTERS_SQL,
+                          "DELETE FROM booking_bookingcounter WHERE value = 0"),
+        migrations.RunSQL(
+            CREATE_ACCOUNT_STRIPES_SQL,
+            "DELETE FROM booking_systemaccountstripe WHERE amount = 0"),
+    ]
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+# Заголовок и текст заказа в ленте больше не копируются: строка ленты узкая,
+# тексты выведенной страницы читаются из заказов по ключу (feed.load_texts).
+# При откате колонки заполняются из заказов.
+FILL_SQL = """
+UPDATE booking_feedentry f SET title = b.title, text = b.text
+FROM booking_booking b
+WHERE b.id = f.booking_id;
+"""
+
+
+def keep_texts(apps, schema_editor):
+    pass
+
+
+def fill_texts(apps, schema_editor):
+    schema_editor.execute(FILL_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0033_create_counters_and_stripes'),
+    ]
+
+    operations = [
+        migrations.RunPython(keep_texts, fill_texts),
+        migrations.RemoveField(
+            model_name='feedentry',
+            name='title',
+        ),
+        migrations.RemoveField(
+            model_name='feedentry',
+            name='text',
+        ),
+    ]
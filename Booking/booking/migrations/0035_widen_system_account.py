@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from decimal import Decimal
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0034_remove_feedentry_title_text'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='systemaccount',
+            name='account',
+            field=models.DecimalField(default=Decimal('0.00'), max_digits=12, decimal_places=2),
+            preserve_default=True,
+        ),
+        migrations.AlterField(
+            model_name='systemaccountstripe',
+            name='amount',
+            field=models.DecimalField(default=Decimal('0.00'), max_digits=12, decimal_places=2),
+            preserve_default=True,
+        ),
+    ]
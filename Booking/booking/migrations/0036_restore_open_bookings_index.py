@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+# Частичный индекс незавершенных заказов (см. 0023_booking_list_indexes),
+# удаленный в 0029: лента читается из booking_feedentry, но незавершенные
+# заказы выбираются из booking_booking при перестроении ленты
+# (feed.rebuild) и выборках заказов по статусу. Индекс покрывает только
+# незавершенные заказы, поэтому мал и дешев для записи.
+FORWARD_SQL = """
+CREATE INDEX booking_booking_open_date ON booking_booking (date, id)
+    WHERE status <> 'completed';
+"""
+
+REVERSE_SQL = """
+DROP INDEX booking_booking_open_date;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0035_widen_system_account'),
+    ]
+
+    operations = [
+        migrations.RunSQL(FORWARD_SQL, REVERSE_SQL),
+    ]
@@ -4,10 +4,68 @@
 Модели
 """
 
-from django.db import models
+from django.db import connection, models, transaction, IntegrityError
 from django.contrib.auth.models import User
 
 from decimal import Decimal
+import random
+
+from .signals import balance_changed, booking_status_changed
+
+
+# Изменение суммы на счету пользователя одним запросом. Списание (amount < 0)
+# выполняется, только если на счету достаточно средств.
+CHANGE_CASH_SQL = """
+UPDATE booking_userprofile SET cash = cash + %s
+WHERE user_id = %s AND (%s >= 0 OR cash >= -%s)
+RETURNING cash
+"""
+
+# Проводка по счету пользователя: изменение суммы на счету (как
+# CHANGE_CASH_SQL) и запись в журнал операций - один запрос. Операция
+# записывается, только если сумма изменена.
+POST_CASH_SQL = """
+WITH changed AS (
+    UPDATE booking_userprofile SET cash = cash + %s
+    WHERE user_id = %s AND (%s >= 0 OR cash >= -%s)
+    RETURNING user_id, cash
+), entry AS (
+    INSERT INTO booking_ledgerentry (user_id, amount, kind, booking_id, date)
+    SELECT user_id, %s, %s, %s, now() FROM changed
+)
+SELECT cash FROM changed
+"""
+
+# Удержание цены заказа: сумма переносится из cash в held, если на счету
+# достаточно средств, записывается в журнал операций и создается удержание
+# заказа - один запрос
+HOLD_CASH_SQL = """
+WITH changed AS (
+    UPDATE booking_userprofile SET cash = cash - %s, held = held + %s
+    WHERE user_id = %s AND cash >= %s
+    RETURNING user_id, cash
+), entry AS (
+    INSERT INTO booking_ledgerentry (user_id, amount, kind, booking_id, date)
+    SELECT user_id, -%s, %s, %s, now() FROM changed
+), hold AS (
+    INSERT INTO booking_escrowhold (customer_id, booking_id, amount, date)
+    SELECT user_id, %s, %s, now() FROM changed
+)
+SELECT cash FROM changed
+"""
+
+# Пополнение счета системы и запись в журнал операций одним запросом
+TRANSFER_CASH_SQL = """
+WITH changed AS (
+    UPDATE booking_systemaccount SET account = account + %s
+    WHERE id = %s
+    RETURNING account
+), entry AS (
+    INSERT INTO booking_ledgerentry (user_id, amount, kind, booking_id, date)
+    SELECT NULL, %s, %s, NULL, now() FROM changed
+)
+SELECT account FROM changed
+"""
 
 
 # Create your models here.
@@ -28,12 +86,15 @@ class Booking(models.Model):
     PENDING = "pending"
     WAITING_FOR_APPROVAL = "waiting_for_approval"
     RUNNING = "running"
+    # Заказчик завершил заказ, деньги переводятся (см. settlement.py)
+    COMPLETING = "completing"
     COMPLETED = "completed"
 
     STATUS_CHOICES = (
         (PENDING, u"Ожидает исполнителя"),
         (WAITING_FOR_APPROVAL, u"Ожидает подтверждения заказчиком"),
         (RUNNING, u"Взят на исполнение"),
+        (COMPLETING, u"Завершается"),
         (COMPLETED, u"Завершен"),
     )
 
@@ -53,6 +114,24 @@ class Booking(models.Model):
 
     date = models.DateTimeField(db_index=True, auto_now_add=True)
 
+    # Версия заказа, увеличивается при каждом сохранении. Входит в ключ кэша
+    # строки заказа в списке заказов.
+    version = models.PositiveIntegerField(default=0)
+
+    # Хватает ли заказчику средств на заказ. Пересчитывается при изменении
+    # счета заказчика (см. escrow.py), списки заказов читают готовый признак.
+    affordable = models.BooleanField(default=False)
+
+    def save(self, *args, **kwargs):
+        """
+        Сохранение заказа с увеличением его версии
+        """
+        self.version += 1
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'version' not in update_fields:
+            kwargs['update_fields'] = list(update_fields) + ['version']
+        super(Booking, self).save(*args, **kwargs)
+
     def set_performer(self, performer):
         """
         Установка исполнителя для заказа. Установка выполняющегося статуса
@@ -80,22 +159,35 @@ class Booking(models.Model):
         """
         return self.performer
 
+    @property
+    def customer_username(self):
+        """
+        Имя заказчика для вывода в списке заказов
+        """
+        return self.customer.username
+
+    @property
+    def performer_username(self):
+        """
+        Имя исполнителя для вывода в списке заказов
+        """
+        return self.performer.username if self.performer_id else None
+
     def complete(self):
         """
         Перевод средств со счета заказчика на счет исполнителя.
-        Установка завершающего статуса для заказа.
-        """
-        system_account = SystemAccount.objects.all()[0]
-        comission = system_account.get_comission()
-        cash_for_system = self.price * comission
-        cash_for_performer = self.price * (1 - comission)
-        system_account.transfer_cash(cash_for_system)
-        system_account.save()
-        self.performer.profile.increase_cash(cash_for_performer)
-        self.performer.profile.save()
-        self.status = self.COMPLETED
-        self.save()
-        return cash_for_system, cash_for_performer
+        Установка завершающего статуса для заказа (см. transitions.complete).
+        Возвращает (комиссия, сумма исполнителю).
+        """
+        from .transitions import complete
+        with transaction.atomic():
+            split = complete(self.pk, self.customer)
+        # Статус и версию заказа изменил запрос перехода: объект
+        # перечитывается из базы
+        state = self._state
+        self.__dict__.update(Booking.objects.get(pk=self.pk).__dict__)
+        self._state = state
+        return split
 
     def get_status(self):
         """
@@ -107,8 +199,12 @@ class Booking(models.Model):
         """
         Установка статуса для заказа.
         """
+        old_status = self.status
         self.status = status
         self.save()
+        if old_status != status:
+            booking_status_changed.send(sender=Booking, booking=self,
+                                        old_status=old_status)
 
 
 class UserProfile(models.Model):
@@ -118,21 +214,82 @@ class UserProfile(models.Model):
     user = models.OneToOneField(User, related_name='profile')
     cash = models.DecimalField(
         max_digits=6, decimal_places=2, default=Decimal('0.0'))
+    # Сумма удержаний (EscrowHold) - цены выполняющихся заказов, списанные
+    # со счета и еще не переведенные исполнителям
+    held = models.DecimalField(
+        max_digits=12, decimal_places=2, default=Decimal('0.0'))
 
     def __unicode__(self):
         return self.user.username
 
+    @classmethod
+    def hold_cash(cls, user_id, booking):
+        """
+        Удержание цены заказа booking со счета заказчика user_id: проверка
+        остатка, перенос суммы в held, операция журнала и удержание заказа -
+        один запрос. Возвращает новую сумму на счету либо None, если профиля
+        нет или средств не хватает.
+        """
+        cursor = connection.cursor()
+        cursor.execute(HOLD_CASH_SQL, [
+            booking.price, booking.price, user_id, booking.price,
+            booking.price, LedgerEntry.HOLD, booking.pk,
+            booking.pk, booking.price])
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        balance_changed.send(sender=cls, user_id=user_id, cash=row[0])
+        return row[0]
+
+    @classmethod
+    def change_cash(cls, user_id, amount):
+        """
+        Изменение суммы на счету пользователя user_id на amount одним
+        запросом UPDATE ... RETURNING: проверка остатка и списание выполняются
+        в базе вместе, без чтения профиля. Возвращает новую сумму на счету
+        либо None, если профиля нет или для списания не хватает средств.
+        Журнал операций не изменяется (см. post_cash).
+        """
+        cursor = connection.cursor()
+        cursor.execute(CHANGE_CASH_SQL, [amount, user_id, amount, amount])
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        balance_changed.send(sender=cls, user_id=user_id, cash=row[0])
+        return row[0]
+
+    @classmethod
+    def post_cash(cls, user_id, amount, kind, booking=None):
+        """
+        Проводка по счету пользователя user_id: изменение суммы на счету
+        (как change_cash) и запись в журнал операций одним запросом.
+        Возвращает новую сумму на счету либо None, если профиля нет или для
+        списания не хватает средств.
+        """
+        cursor = connection.cursor()
+        cursor.execute(POST_CASH_SQL, [
+            amount, user_id, amount, amount, amount, kind,
+            booking.pk if booking is not None else None])
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        balance_changed.send(sender=cls, user_id=user_id, cash=row[0])
+        return row[0]
+
     def increase_cash(self, _cash):
         """
-        Увеличение денег на счету пользователя.
+        Увеличение денег на счету пользователя (проводка исправления).
+        Возвращает новую сумму.
         """
-        self.cash += _cash
+        return self.post(_cash, LedgerEntry.ADJUSTMENT)
 
     def decrease_cash(self, _cash):
         """
-        Уменьшение денег на счету пользователя.
+        Уменьшение денег на счету пользователя, если их достаточно
+        (проводка исправления). Возвращает новую сумму либо None, если
+        средств не хватает.
         """
-        self.cash -= _cash
+        return self.post(-_cash, LedgerEntry.ADJUSTMENT)
 
     def has_enough_cash_for_booking(self, price):
         """
@@ -145,23 +302,61 @@ class UserProfile(models.Model):
         else:
             return False
 
+    def post(self, amount, kind, booking=None):
+        """
+        Проводка по счету пользователя: изменение остатка cash и запись в
+        журнал операций (см. post_cash). Возвращает новую сумму либо None,
+        если для списания не хватает средств.
+        """
+        cash = self.post_cash(self.user_id, amount, kind, booking)
+        if cash is not None:
+            self.cash = cash
+        return cash
+
 
 class SystemAccount(models.Model):
 
     """
     Счет системы, на который происходит перевод процента-комиссии цены заказа
     со счета заказа после его завершения.
+
+    Комиссии зачисляются не на сам счет, а в одну из STRIPES частей счета
+    (SystemAccountStripe), выбранную случайно. Параллельные завершения
+    заказов изменяют разные строки и не ждут друг друга. Остаток счета -
+    account плюс сумма частей. compact() переносит суммы частей в account.
     """
-    account = models.DecimalField(max_digits=6, decimal_places=2,
+
+    # Число частей счета
+    STRIPES = 16
+
+    account = models.DecimalField(max_digits=12, decimal_places=2,
                                   default=Decimal('0.00'))
     commission = models.DecimalField(max_digits=3, decimal_places=2,
                                      default=Decimal('0.03'))
 
+    def __unicode__(self):
+        return u"%s (%s)" % (self.pk, self.get_balance())
+
+    def save(self, *args, **kwargs):
+        created = self.pk is None
+        super(SystemAccount, self).save(*args, **kwargs)
+        if created:
+            # Части создаются вместе со счетом, зачисление в часть - один
+            # запрос (см. add_to_stripe)
+            SystemAccountStripe.objects.bulk_create([
+                SystemAccountStripe(account=self, stripe=stripe)
+                for stripe in range(self.STRIPES)])
+
     def transfer_cash(self, _cash):
         """
-        Пополнение средств на счету
+        Пополнение средств на счету (проводка исправления) одним запросом.
+        Возвращает новую сумму.
         """
-        self.account += _cash
+        cursor = connection.cursor()
+        cursor.execute(TRANSFER_CASH_SQL, [_cash, self.pk, _cash,
+                                           LedgerEntry.ADJUSTMENT])
+        self.account = cursor.fetchone()[0]
+        return self.account
 
     def get_comission(self):
         """
@@ -169,6 +364,234 @@ class SystemAccount(models.Model):
         """
         return self.commission
 
+    def add_to_stripe(self, _cash):
+        """
+        Зачисление суммы в случайно выбранную часть счета одним запросом
+        UPDATE ... SET amount = amount + ... Недостающая часть (счет создан
+        до появления частей) создается.
+        """
+        stripe = random.randrange(self.STRIPES)
+        stripes = SystemAccountStripe.objects.filter(account=self,
+                                                     stripe=stripe)
+        if stripes.update(amount=models.F('amount') + _cash):
+            return
+        try:
+            with transaction.atomic():
+                SystemAccountStripe.objects.create(account=self, stripe=stripe,
+                                                   amount=_cash)
+        except IntegrityError:
+            # Часть счета параллельно создал другой запрос
+            stripes.update(amount=models.F('amount') + _cash)
+
+    def post_commission(self, amount, booking=None):
+        """
+        Зачисление комиссии: запись в журнал операций и в часть счета
+        """
+        self.add_to_stripe(amount)
+        LedgerEntry.objects.create(user=None, amount=amount,
+                                   kind=LedgerEntry.COMMISSION,
+                                   booking=booking)
+
+    def get_balance(self):
+        """
+        Остаток на счету с учетом частей счета
+        """
+        stripes = self.stripes.aggregate(total=models.Sum('amount'))['total']
+        return self.account + (stripes or 0)
+    get_balance.short_description = u"Остаток"
+
+    def compact(self):
+        """
+        Перенос сумм частей счета в account. Части и счет блокируются на
+        время переноса.
+        """
+        with transaction.atomic():
+            account = SystemAccount.objects.select_for_update().get(pk=self.pk)
+            stripes = list(self.stripes.select_for_update().order_by('stripe'))
+            total = sum(stripe.amount for stripe in stripes)
+            if total:
+                account.account += total
+                account.save(update_fields=['account'])
+                self.stripes.filter(
+                    pk__in=[stripe.pk for stripe in stripes]).update(
+                        amount=Decimal('0.00'))
+            self.account = account.account
+        return total
+
+
+class EscrowHold(models.Model):
+
+    """
+    Удержание: цена выполняющегося заказа, списанная со счета заказчика при
+    подтверждении исполнителя (UserProfile.hold_cash). Удержание снимается,
+    когда деньги переведены исполнителю.
+    """
+
+    customer = models.ForeignKey(User, related_name='+')
+    booking = models.OneToOneField(Booking, related_name='hold')
+    amount = models.DecimalField(max_digits=8, decimal_places=2)
+    date = models.DateTimeField(auto_now_add=True)
+
+
+class SystemAccountStripe(models.Model):
+
+    """
+    Часть счета системы (см. SystemAccount)
+    """
+
+    class Meta:
+        unique_together = (
+            ('account', 'stripe'),
+        )
+
+    account = models.ForeignKey(SystemAccount, related_name='stripes')
+    stripe = models.PositiveSmallIntegerField()
+    amount = models.DecimalField(max_digits=12, decimal_places=2,
+                                 default=Decimal('0.00'))
+
+
+class LedgerEntry(models.Model):
+
+    """
+    Операция в журнале движения денег (журнал аудита, см. ledger.py). Журнал
+    только дополняется: каждое списание, зачисление и комиссия - новая
+    строка, строки не изменяются и не удаляются. Операции по счету системы -
+    строки без пользователя.
+    """
+
+    class Meta:
+        index_together = (
+            ('user', 'id'),
+        )
+
+    # Начальный остаток счета
+    OPENING = "opening"
+    # Списание цены заказа со счета заказчика при подтверждении исполнителя
+    HOLD = "hold"
+    # Выплата исполнителю при завершении заказа
+    PAYOUT = "payout"
+    # Комиссия системы при завершении заказа
+    COMMISSION = "commission"
+    # Исправление остатка вручную
+    ADJUSTMENT = "adjustment"
+
+    KIND_CHOICES = (
+        (OPENING, u"Начальный остаток"),
+        (HOLD, u"Оплата заказа"),
+        (PAYOUT, u"Выплата исполнителю"),
+        (COMMISSION, u"Комиссия системы"),
+        (ADJUSTMENT, u"Исправление"),
+    )
+
+    user = models.ForeignKey(User, null=True, blank=True,
+                             related_name='ledger_entries',
+                             on_delete=models.PROTECT)
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    kind = models.CharField(choices=KIND_CHOICES, max_length=20)
+    booking = models.ForeignKey(Booking, null=True, blank=True,
+                                related_name='ledger_entries',
+                                on_delete=models.SET_NULL)
+    date = models.DateTimeField(auto_now_add=True)
+
+
+class BalanceSnapshot(models.Model):
+
+    """
+    Остаток счета по журналу операций с id не больше last_entry_id. Остаток
+    по журналу на текущий момент - последний снимок плюс сумма операций
+    после него; по нему сверяются остатки счетов (см. ledger.py). Снимки без
+    пользователя - снимки счета системы.
+    """
+
+    class Meta:
+        index_together = (
+            ('user', 'last_entry_id'),
+        )
+
+    user = models.ForeignKey(User, null=True, blank=True,
+                             related_name='balance_snapshots')
+    balance = models.DecimalField(max_digits=14, decimal_places=2)
+    last_entry_id = models.IntegerField()
+    date = models.DateTimeField(auto_now_add=True)
+
+
+class FeedEntry(models.Model):
+
+    """
+    Строка ленты незавершенных заказов.
+
+    Денормализованная копия ключей и колонок сортировки и фильтрации ленты
+    вместе с копией признака "заказчику хватает средств на заказ"
+    (Booking.affordable, его пересчитывает модуль escrow). Заголовок и текст
+    заказа в строке не хранятся, их для выведенной страницы читает
+    feed.load_texts. Строка есть у каждого незавершенного заказа, завершенные
+    заказы из ленты удаляются. Поддерживается в актуальном состоянии модулем
+    feed.
+    """
+
+    class Meta:
+        index_together = (
+            ('date', 'booking'),
+        )
+
+    booking = models.OneToOneField(Booking, primary_key=True,
+                                   related_name='feed_entry')
+    customer = models.ForeignKey(User, related_name='+')
+    customer_username = models.CharField(max_length=30)
+    performer = models.ForeignKey(User, null=True, blank=True,
+                                  related_name='+')
+    performer_username = models.CharField(max_length=30, null=True,
+                                          blank=True)
+    price = models.DecimalField(max_digits=8, decimal_places=2)
+    status = models.CharField(choices=Booking.STATUS_CHOICES, max_length=30)
+    applicants_count = models.PositiveIntegerField(default=0)
+    customer_can_afford = models.BooleanField(default=False)
+    date = models.DateTimeField()
+    version = models.PositiveIntegerField(default=0)
+
+    @property
+    def possible_performers(self):
+        return self.booking.possible_performers
+
+
+class BookingCounter(models.Model):
+
+    """
+    Счетчик заказов: число заказов с заданным статусом, заказчиком или
+    исполнителем. Счетчики изменяются при каждом сохранении и удалении
+    заказа (модуль counters) и заменяют COUNT(*) при постраничном выводе.
+    """
+
+    name = models.CharField(max_length=64, primary_key=True)
+    value = models.IntegerField(default=0)
+
+
+class Settlement(models.Model):
+
+    """
+    Задание очереди расчетов: заказ в статусе "Завершается", деньги за
+    который еще не переведены исполнителю и системе. Задание удаляется после
+    перевода денег. Если перевод невозможен, задание остается в очереди с
+    текстом ошибки и больше не обрабатывается.
+    """
+
+    booking = models.OneToOneField(Booking, related_name='settlement')
+    date = models.DateTimeField(auto_now_add=True)
+    error = models.TextField(blank=True)
+
+
+class IdempotencyKey(models.Model):
+
+    """
+    Ключ идемпотентности POST-запроса (модуль idempotency): ответ на первый
+    запрос с ключом либо NULL, пока запрос выполняется. Истекшая строка
+    занимается заново.
+    """
+
+    key = models.CharField(max_length=200, primary_key=True)
+    response = models.TextField(null=True)
+    expires = models.DateTimeField(db_index=True)
+
 
 class Comment(models.Model):
     booking = models.ForeignKey(Booking, related_name='booking_comments')
@@ -0,0 +1,500 @@
+# -*- coding: utf-8 -*-
+
+"""
+Постраничный вывод заказов по ключу (keyset/cursor pagination).
+
+Вместо OFFSET и COUNT(*) страница выбирается условием по ключу
+упорядочивания: "следующие per_page строк после (date, id) последней строки
+предыдущей страницы". Стоимость выборки любой страницы одинакова и не зависит
+от размера таблицы. Курсоры - непрозрачные строки, которые передаются
+в GET-параметрах after/before.
+
+Для постраничного вывода по номеру страницы есть классы без COUNT(*)
+на каждый запрос: с кэшированным числом строк, со счетчиками заказов и
+с оценкой числа строк планировщиком.
+"""
+
+import base64
+import binascii
+import hashlib
+import json
+import math
+import numbers
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.paginator import InvalidPage, EmptyPage, Page, Paginator
+from django.db import connections
+from django.db.models import Q, DateTimeField
+from django.db.models.fields import FieldDoesNotExist
+from django.http import Http404
+from django.utils import timezone
+
+
+EPOCH = datetime(1970, 1, 1)
+EPOCH_UTC = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class InvalidCursor(InvalidPage):
+    """
+    Курсор поврежден или сформирован не для этого списка.
+    """
+    pass
+
+
+class KeysetPage(object):
+
+    """
+    Страница, выбранная по ключу. Повторяет интерфейс django.core.paginator.Page
+    там, где это возможно (номера страницы и числа страниц здесь нет).
+    """
+
+    def __init__(self, object_list, paginator, has_next, has_previous):
+        self.object_list = object_list
+        self.paginator = paginator
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __repr__(self):
+        return '<KeysetPage of %s objects>' % len(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    @property
+    def next_cursor(self):
+        """
+        Курсор следующей страницы (после последней строки этой страницы)
+        """
+        if not self._has_next or not self.object_list:
+            return None
+        return self.paginator.cursor_for(self.object_list[-1])
+
+    @property
+    def previous_cursor(self):
+        """
+        Курсор предыдущей страницы (перед первой строкой этой страницы)
+        """
+        if not self._has_previous or not self.object_list:
+            return None
+        return self.paginator.cursor_for(self.object_list[0])
+
+
+class KeysetPaginator(object):
+
+    """
+    Постраничный вывод по ключу.
+
+    keys - поля, по убыванию которых упорядочен список. Последнее поле должно
+    быть уникальным (обычно первичный ключ), иначе строки с одинаковым
+    ключом могут потеряться на границе страниц.
+    """
+
+    def __init__(self, queryset, per_page, keys=('date', 'pk')):
+        self.queryset = queryset
+        self.per_page = int(per_page)
+        self.keys = tuple(keys)
+
+    def _get_field(self, name):
+        opts = self.queryset.model._meta
+        if name == 'pk':
+            return opts.pk
+        try:
+            return opts.get_field(name)
+        except FieldDoesNotExist:
+            return None
+
+    def _encode_value(self, name, value):
+        if isinstance(value, datetime):
+            epoch = EPOCH if timezone.is_naive(value) else EPOCH_UTC
+            delta = value - epoch
+            return (delta.days * 86400 + delta.seconds) * 10 ** 6 + \
+                delta.microseconds
+        return value
+
+    def _decode_value(self, name, value):
+        """
+        Значение ключа из курсора. Значения, которые не может принять поле
+        ключа (в том числе вне допустимого диапазона), - InvalidCursor.
+        """
+        if isinstance(value, (bool, list, dict)) or value is None or (
+                isinstance(value, float) and (math.isinf(value) or
+                                              math.isnan(value))):
+            raise InvalidCursor(u"Неверный курсор")
+        field = self._get_field(name)
+        try:
+            if isinstance(field, DateTimeField):
+                if not isinstance(value, numbers.Integral):
+                    raise InvalidCursor(u"Неверный курсор")
+                epoch = EPOCH_UTC if settings.USE_TZ else EPOCH
+                return epoch + timedelta(microseconds=value)
+            if field is None:
+                return value
+            # Первичный ключ-связь (FeedEntry.booking) - значение поля, на
+            # которое она ссылается
+            while field.rel is not None:
+                field = field.rel.get_related_field()
+            return field.to_python(value)
+        except (ValidationError, ValueError, TypeError, OverflowError):
+            raise InvalidCursor(u"Неверный курсор")
+
+    def get_key_values(self, obj):
+        """
+        Значения ключа упорядочивания для объекта страницы (либо словаря,
+        если список выбирается через values())
+        """
+        if isinstance(obj, dict):
+            return [obj[name] for name in self.keys]
+        return [getattr(obj, name) for name in self.keys]
+
+    def cursor_for(self, obj):
+        """
+        Курсор, указывающий на объект
+        """
+        values = [self._encode_value(name, value) for name, value in
+                  zip(self.keys, self.get_key_values(obj))]
+        return base64.urlsafe_b64encode(
+            json.dumps(values, separators=(',', ':'))).rstrip('=')
+
+    def decode_cursor(self, cursor):
+        """
+        Значения ключа, закодированные в курсоре
+        """
+        try:
+            cursor = str(cursor)
+            padding = '=' * (-len(cursor) % 4)
+            values = json.loads(base64.urlsafe_b64decode(cursor + padding))
+        except (TypeError, ValueError, UnicodeError, binascii.Error):
+            raise InvalidCursor(u"Неверный курсор")
+        if not isinstance(values, list) or len(values) != len(self.keys):
+            raise InvalidCursor(u"Неверный курсор")
+        return [self._decode_value(name, value)
+                for name, value in zip(self.keys, values)]
+
+    def get_seek_filter(self, values, reverse=False):
+        """
+        Условие "строго после ключа values" при убывающем упорядочивании
+        (при reverse - "строго до").
+
+        Для ключа (date, id): date < d OR (date = d AND id < i). Условие
+        date <= d добавляется отдельно, чтобы планировщик мог использовать
+        индекс по первому полю ключа как диапазон.
+        """
+        lookup = 'gt' if reverse else 'lt'
+        seek = Q()
+        for i, name in enumerate(self.keys):
+            condition = dict(zip(self.keys[:i], values[:i]))
+            condition['%s__%s' % (name, lookup)] = values[i]
+            seek |= Q(**condition)
+        first = {'%s__%se' % (self.keys[0], lookup): values[0]}
+        return Q(**first) & seek
+
+    def get_ordering(self, reverse=False):
+        if reverse:
+            return list(self.keys)
+        return ['-%s' % name for name in self.keys]
+
+    def fetch(self, queryset, values, reverse, limit):
+        """
+        Выборка limit строк после (до) ключа values.
+        """
+        if values is not None:
+            queryset = queryset.filter(self.get_seek_filter(values, reverse))
+        return list(queryset.order_by(*self.get_ordering(reverse))[:limit])
+
+    def iterate(self):
+        """
+        Все строки списка. Строки выбираются порциями по per_page, каждая
+        порция - отдельный запрос по ключу, поэтому в памяти одновременно
+        находится не больше одной порции.
+        """
+        values = None
+        while True:
+            rows = self.fetch(self.queryset, values, False, self.per_page)
+            for row in rows:
+                yield row
+            if len(rows) < self.per_page:
+                return
+            values = self.get_key_values(rows[-1])
+
+    def page(self, after=None, before=None):
+        """
+        Страница после курсора after либо перед курсором before.
+        Без курсоров - первая страница.
+        """
+        if before:
+            values = self.decode_cursor(before)
+            rows = self.fetch(self.queryset, values, True, self.per_page + 1)
+            if not rows:
+                # Перед курсором строк нет - это первая страница
+                return self.page()
+            has_previous = len(rows) > self.per_page
+            object_list = list(reversed(rows[:self.per_page]))
+            return KeysetPage(object_list, self, True, has_previous)
+
+        values = self.decode_cursor(after) if after else None
+        rows = self.fetch(self.queryset, values, False, self.per_page + 1)
+        has_next = len(rows) > self.per_page
+        return KeysetPage(rows[:self.per_page], self, has_next,
+                          values is not None)
+
+
+class UnionKeysetPaginator(KeysetPaginator):
+
+    """
+    Постраничный вывод по ключу для списка, заданного условием
+    "ветвь 1 OR ветвь 2 OR ...".
+
+    Условие OR по разным колонкам не позволяет использовать индексы. Вместо
+    него каждая ветвь выбирает не больше limit id по своему индексу,
+    объединение ветвей (UNION) ограничивает выборку строк списка:
+
+        WHERE id IN ((SELECT id ... WHERE ветвь 1 ... LIMIT n)
+                     UNION (SELECT id ... WHERE ветвь 2 ... LIMIT n))
+        ORDER BY date DESC, id DESC LIMIT n
+
+    branches - условия ветвей (Q), queryset - выборка без условий ветвей.
+    Список - строки queryset, удовлетворяющие хотя бы одной ветви.
+    """
+
+    def __init__(self, queryset, per_page, keys=('date', 'pk'), branches=()):
+        super(UnionKeysetPaginator, self).__init__(queryset, per_page, keys)
+        self.branches = list(branches)
+
+    def get_branch_sql(self, queryset, branch, values, reverse, limit):
+        branch = queryset.filter(branch)
+        if values is not None:
+            branch = branch.filter(self.get_seek_filter(values, reverse))
+        branch = branch.order_by(*self.get_ordering(reverse)).values('pk')
+        return branch[:limit].query.sql_with_params()
+
+    def fetch(self, queryset, values, reverse, limit):
+        if not self.branches:
+            return super(UnionKeysetPaginator, self).fetch(
+                queryset, values, reverse, limit)
+        parts, params = [], []
+        for branch in self.branches:
+            sql, branch_params = self.get_branch_sql(
+                queryset, branch, values, reverse, limit)
+            parts.append('(%s)' % sql)
+            params.extend(branch_params)
+        opts = queryset.model._meta
+        where = '%s.%s IN (%s)' % (opts.db_table, opts.pk.column,
+                                   ' UNION '.join(parts))
+        queryset = queryset.extra(where=[where], params=params)
+        return list(queryset.order_by(*self.get_ordering(reverse))[:limit])
+
+
+def estimate_count(queryset):
+    """
+    Оценка числа строк выборки планировщиком PostgreSQL без ее выполнения.
+    Для всей таблицы - pg_class.reltuples (None, если таблица еще
+    не анализировалась), для выборки с условиями - оценка числа строк
+    из EXPLAIN.
+    """
+    connection = connections[queryset.db]
+    cursor = connection.cursor()
+    if not queryset.query.where and not queryset.query.extra:
+        cursor.execute("SELECT reltuples FROM pg_class WHERE oid = %s::regclass",
+                       [queryset.model._meta.db_table])
+        row = cursor.fetchone()
+        if row is None or row[0] < 0:
+            return None
+        return int(row[0])
+    sql, params = queryset.query.sql_with_params()
+    cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+    plan = cursor.fetchone()[0]
+    if not isinstance(plan, list):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class ApproximatePage(Page):
+
+    """
+    Страница списка с приблизительным числом строк. Наличие следующей
+    страницы определяется по самим строкам, а не по числу страниц.
+    """
+
+    def __init__(self, object_list, number, paginator, has_next):
+        super(ApproximatePage, self).__init__(object_list, number, paginator)
+        self._has_next = has_next
+
+    def has_next(self):
+        return self._has_next
+
+
+class ApproximateCountPaginator(Paginator):
+
+    """
+    Постраничный вывод по номеру страницы без COUNT(*) на каждый запрос.
+
+    Число строк (get_count) используется только для вывода числа страниц и
+    может отличаться от точного. Страница выбирается с одной лишней строкой,
+    по которой определяется наличие следующей страницы, поэтому строки
+    не теряются и при устаревшем числе строк.
+
+    Базовый класс: число строк возвращает метод get_count() подкласса.
+    """
+
+    def _get_count(self):
+        if self._count is None:
+            self._count = max(self.get_count(), 0)
+        return self._count
+    count = property(_get_count)
+
+    def validate_number(self, number):
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise InvalidPage(u"Номер страницы должен быть числом")
+        if number < 1:
+            raise EmptyPage(u"Номер страницы меньше 1")
+        return number
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        rows = list(self.object_list[bottom:bottom + self.per_page + 1])
+        if not rows and number > 1:
+            raise EmptyPage(u"Страница пуста")
+        has_next = len(rows) > self.per_page
+        if has_next:
+            # Число страниц не меньше фактического
+            self._count = max(self.count, bottom + len(rows))
+        else:
+            # Последняя страница: число строк известно точно
+            self._count = bottom + len(rows)
+        return ApproximatePage(rows[:self.per_page], number, self, has_next)
+
+
+class CachedCountPaginator(ApproximateCountPaginator):
+
+    """
+    Число строк считается COUNT(*) и кэшируется на timeout секунд
+    (BOOKING_COUNT_CACHE_TIMEOUT) по тексту запроса выборки.
+    """
+
+    def __init__(self, object_list, per_page, orphans=0,
+                 allow_empty_first_page=True, timeout=None):
+        super(CachedCountPaginator, self).__init__(
+            object_list, per_page, orphans, allow_empty_first_page)
+        if timeout is None:
+            timeout = settings.BOOKING_COUNT_CACHE_TIMEOUT
+        self.timeout = timeout
+
+    def get_cache_key(self):
+        sql, params = self.object_list.query.sql_with_params()
+        query = repr((sql, params)).encode('utf-8')
+        return 'booking_count:%s' % hashlib.md5(query).hexdigest()
+
+    def get_count(self):
+        key = self.get_cache_key()
+        count = cache.get(key)
+        if count is None:
+            count = self.object_list.count()
+            cache.set(key, count, self.timeout)
+        return count
+
+
+class CounterPaginator(ApproximateCountPaginator):
+
+    """
+    Число строк - сумма счетчиков заказов counters (см. counters.py).
+    """
+
+    def __init__(self, object_list, per_page, orphans=0,
+                 allow_empty_first_page=True, counters=()):
+        super(CounterPaginator, self).__init__(
+            object_list, per_page, orphans, allow_empty_first_page)
+        self.counters = list(counters)
+
+    def get_count(self):
+        from .counters import get_total
+        return get_total(self.counters)
+
+
+class EstimatedCountPaginator(ApproximateCountPaginator):
+
+    """
+    Число строк - оценка планировщика (см. estimate_count). Если по оценке
+    строк меньше exact_threshold, они считаются точно.
+    """
+
+    exact_threshold = 10000
+
+    def get_count(self):
+        estimate = estimate_count(self.object_list)
+        if estimate is None or estimate < self.exact_threshold:
+            return self.object_list.count()
+        return estimate
+
+
+class KeysetPaginationMixin(object):
+
+    """
+    Постраничный вывод ListView по ключу.
+
+    При keyset_pagination = False используется постраничный вывод по номеру
+    страницы с paginator_class. Для CounterPaginator счетчики списка задает
+    get_count_counters(). Если для выборки счетчиков нет (например,
+    результаты поиска), число строк кэшируется (CachedCountPaginator).
+    """
+
+    keyset_pagination = True
+    keyset_keys = ('date', 'pk')
+    keyset_paginator_class = KeysetPaginator
+
+    def get_keyset_paginator(self, queryset, page_size):
+        return self.keyset_paginator_class(queryset, page_size,
+                                           self.keyset_keys)
+
+    def get_count_counters(self):
+        """
+        Счетчики заказов, сумма которых равна числу строк списка.
+        None - таких счетчиков нет.
+        """
+        return None
+
+    def get_paginator(self, queryset, per_page, orphans=0,
+                      allow_empty_first_page=True, **kwargs):
+        paginator_class = self.paginator_class
+        if issubclass(paginator_class, CounterPaginator):
+            counters = self.get_count_counters()
+            if counters is None:
+                paginator_class = CachedCountPaginator
+            else:
+                kwargs['counters'] = counters
+        return paginator_class(queryset, per_page, orphans=orphans,
+                               allow_empty_first_page=allow_empty_first_page,
+                               **kwargs)
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.keyset_pagination:
+            return super(KeysetPaginationMixin, self).paginate_queryset(
+                queryset, page_size)
+
+        paginator = self.get_keyset_paginator(queryset, page_size)
+        try:
+            page = paginator.page(after=self.request.GET.get('after'),
+                                  before=self.request.GET.get('before'))
+        except InvalidCursor:
+            raise Http404(u"Неверный курсор")
+        return (paginator, page, page.object_list, page.has_other_pages())
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+"""
+Действия пользователя над заказами страницы списка заказов.
+"""
+
+from .models import Booking
+
+
+# Заказчик может завершить заказ
+CAN_COMPLETE = "can_complete"
+# Исполнитель может взять заказ
+CAN_TAKE = "can_take"
+# Возможность смотреть заказ
+CAN_VIEW = "can_view"
+# Кнопка взятия заказа неактивна
+NOT_ACTIVE = "not_active"
+# Заказчик может подтверждать/отклонять заказ
+CAN_APPROVE = "can_approve"
+
+# Отношение пользователя к заказу: создатель заказа, исполнитель, другой
+# пользователь
+OWNER = "owner"
+PERFORMER = "performer"
+OTHER = "other"
+
+# Страница всех заказов
+ALL_BOOKINGS = "all_bookings"
+# Страница заказов, связанных с пользователем
+OWN_BOOKINGS = "own_bookings"
+
+
+class BookingPermissionResolver(object):
+
+    """
+    Вычисление действий пользователя сразу для всех заказов страницы.
+
+    Число запросов не зависит от числа заказов на странице:
+    - права пользователя проверяются один раз (has_perm кэширует их
+      в объекте пользователя);
+    - признак "заказчику хватает средств" уже вычислен (Booking.affordable,
+      FeedEntry.customer_can_afford), счета заказчиков не выбираются;
+    - заявки пользователя на заказы страницы выбираются одним запросом.
+    """
+
+    def __init__(self, user, page_type=ALL_BOOKINGS):
+        self.user = user
+        self.page_type = page_type
+        self.is_customer = user.has_perm("booking.add_booking")
+
+    def get_applications(self, bookings):
+        """
+        Множество id заказов страницы, на которые пользователь уже подавал
+        заявку.
+        """
+        if self.is_customer or self.page_type != ALL_BOOKINGS:
+            return set()
+        booking_ids = [o.pk for o in bookings
+                       if o.status == Booking.WAITING_FOR_APPROVAL]
+        if not booking_ids:
+            return set()
+        applications = Booking.possible_performers.through.objects.filter(
+            booking_id__in=booking_ids, user_id=self.user.id)
+        return set(applications.values_list('booking_id', flat=True))
+
+    def resolve(self, bookings):
+        """
+        Список действий пользователя над заказами bookings (в том же порядке)
+        """
+        bookings = list(bookings)
+        applications = self.get_applications(bookings)
+        return [self.resolve_one(o, applications) for o in bookings]
+
+    def relation(self, booking):
+        """
+        Отношение пользователя к заказу
+        """
+        if booking.customer_id == self.user.id:
+            return OWNER
+        if booking.performer_id == self.user.id:
+            return PERFORMER
+        return OTHER
+
+    def can_afford(self, booking):
+        """
+        Хватает ли заказчику средств на заказ
+        """
+        if hasattr(booking, 'customer_can_afford'):
+            return booking.customer_can_afford
+        return booking.affordable
+
+    def resolve_one(self, booking, applications):
+        """
+        Действие пользователя над заказом
+        """
+        # Заказ ждет выполнения
+        if booking.status == Booking.PENDING:
+            if not self.can_afford(booking):
+                # Заказчику не хватает средств - кнопка взятия неактивна
+                return NOT_ACTIVE
+            # Исполнители могут брать заказ, остальные - просматривать
+            return CAN_VIEW if self.is_customer else CAN_TAKE
+
+        # Заказ кем-то исполняется. Создатель заказа может его завершить.
+        if booking.status == Booking.RUNNING:
+            if booking.customer_id == self.user.id:
+                return CAN_COMPLETE
+            return CAN_VIEW
+
+        # Заказ ждет подтверждения заказчиком после попытки исполнителя
+        # его взять
+        if booking.status == Booking.WAITING_FOR_APPROVAL:
+            if self.is_customer:
+                # Заказчик может подтверждать, если создавал этот заказ
+                if booking.customer_id == self.user.id:
+                    return CAN_APPROVE
+                return CAN_VIEW
+            if self.page_type != ALL_BOOKINGS:
+                # В списке своих заказов кнопка исполнителя неактивна
+                return NOT_ACTIVE
+            # Другие исполнители тоже могут пытаться взять этот заказ,
+            # если они еще не делали таких попыток
+            if booking.pk in applications:
+                return CAN_VIEW
+            return CAN_TAKE
+
+        # Завершенный заказ можно только просматривать
+        return CAN_VIEW
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+"""
+Роли пользователей (группы customers/performers).
+
+Соответствие имен групп их id загружается один раз на процесс и сбрасывается
+при изменении групп. Множество ролей пользователя вычисляется одним запросом
+и запоминается в объекте пользователя, то есть на время запроса. Повторные
+проверки ролей в шаблонах и views запросов к базе не делают.
+"""
+
+import threading
+
+from django.contrib.auth.models import Group, User
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+
+# Заказчики
+CUSTOMERS = "customers"
+# Исполнители
+PERFORMERS = "performers"
+
+# Атрибут объекта пользователя, в котором запоминаются его роли
+USER_ROLES_ATTR = '_booking_roles'
+
+
+class RoleRegistry(object):
+
+    """
+    Соответствие имен групп и их id, общее для процесса.
+
+    Изменения групп в этом процессе сбрасывают реестр через сигналы.
+    Группа, созданная в другом процессе, подгружается при первом обращении
+    к ней по имени или id: реестр перезагружается один раз. Переименование
+    или удаление группы в другом процессе становится видно после
+    перезапуска процесса.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (имя - id, id - имя). Пара заменяется целиком и читается под
+        # блокировкой в локальную переменную: сброс реестра другим потоком
+        # не влияет на уже прочитанную пару.
+        self._maps = None
+
+    def _get_maps(self, reload=False):
+        with self._lock:
+            if self._maps is None or reload:
+                ids = dict(Group.objects.values_list('name', 'id'))
+                self._maps = (ids, dict((v, k) for k, v in ids.items()))
+            return self._maps
+
+    def invalidate(self):
+        with self._lock:
+            self._maps = None
+
+    def get_id(self, name):
+        """
+        id группы по имени. Group.DoesNotExist, если группы нет.
+        """
+        ids, names = self._get_maps()
+        if name not in ids:
+            # Группа создана в другом процессе
+            ids, names = self._get_maps(reload=True)
+        try:
+            return ids[name]
+        except KeyError:
+            raise Group.DoesNotExist(u"Группа %s не найдена" % name)
+
+    def get_names(self, group_ids):
+        """
+        Имена групп по их id
+        """
+        group_ids = set(group_ids)
+        ids, names = self._get_maps()
+        if not group_ids.issubset(names):
+            # Группа создана в другом процессе
+            ids, names = self._get_maps(reload=True)
+        return frozenset(names[group_id] for group_id in group_ids
+                         if group_id in names)
+
+
+registry = RoleRegistry()
+
+
+def get_user_roles(user):
+    """
+    Множество имен групп пользователя
+    """
+    if not user.is_authenticated():
+        return frozenset()
+    roles = getattr(user, USER_ROLES_ATTR, None)
+    if roles is None:
+        group_ids = User.groups.through.objects.filter(
+            user_id=user.pk).values_list('group_id', flat=True)
+        roles = registry.get_names(group_ids)
+        setattr(user, USER_ROLES_ATTR, roles)
+    return roles
+
+
+def has_role(user, name):
+    """
+    Состоит ли пользователь в группе name
+    """
+    return name in get_user_roles(user)
+
+
+def add_role(user, name):
+    """
+    Добавление пользователя в группу name
+    """
+    user.groups.add(registry.get_id(name))
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def groups_changed(sender, **kwargs):
+    registry.invalidate()
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def user_groups_changed(sender, instance, action, reverse, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear') and not reverse:
+        instance.__dict__.pop(USER_ROLES_ATTR, None)
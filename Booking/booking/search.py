@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+"""
+Полнотекстовый поиск по заказам.
+
+Заголовок и текст заказа индексируются в колонке booking_booking.search_vector
+(tsvector, конфигурация russian), которую поддерживает триггер базы (см.
+миграцию 0022_booking_search_vector). По колонке построен GIN-индекс, поэтому
+подходящие заказы находятся по индексу, а ранжируются только найденные.
+Совпадения в заголовке весят больше совпадений в тексте.
+
+Результаты поиска упорядочены по убыванию (rank, id) и выводятся постранично
+по этому ключу.
+"""
+
+from collections import OrderedDict
+import numbers
+
+from .pagination import InvalidCursor, KeysetPaginator
+
+
+# Конфигурация полнотекстового поиска (должна совпадать с конфигурацией
+# триггера search_vector)
+SEARCH_CONFIG = 'pg_catalog.russian'
+
+# Максимальная длина поискового запроса
+MAX_QUERY_LENGTH = 200
+
+MATCH_SQL = "booking_booking.search_vector @@ plainto_tsquery('%s', %%s)" % (
+    SEARCH_CONFIG)
+# Соединение строк ленты с заказами, в которых хранится search_vector
+JOIN_SQL = "booking_booking.id = booking_feedentry.booking_id"
+# Ранг приводится к double precision, чтобы значение в курсоре точно
+# совпадало со значением в базе
+RANK_SQL = ("ts_rank(booking_booking.search_vector, "
+            "plainto_tsquery('%s', %%s))::float8" % SEARCH_CONFIG)
+
+
+def clean_query(query):
+    """
+    Поисковый запрос без лишних пробелов. Пустая строка - поиска нет.
+    """
+    return u" ".join((query or u"").split())[:MAX_QUERY_LENGTH]
+
+
+def search_feed(queryset, query):
+    """
+    Заказы ленты, подходящие под запрос, с рангом в атрибуте rank. Таблица
+    заказов присоединяется только для поиска, заголовок и текст выбираются
+    из нее тем же запросом.
+    """
+    select = OrderedDict([('rank', RANK_SQL),
+                          ('title', 'booking_booking.title'),
+                          ('text', 'booking_booking.text')])
+    return queryset.extra(select=select, select_params=[query],
+                          tables=['booking_booking'],
+                          where=[JOIN_SQL, MATCH_SQL], params=[query])
+
+
+class SearchKeysetPaginator(KeysetPaginator):
+
+    """
+    Постраничный вывод результатов поиска по ключу (rank, pk).
+
+    Ранг - вычисляемое значение (extra select), поэтому условие "после ключа"
+    строится SQL-выражением, а не фильтром по полю.
+    """
+
+    def __init__(self, queryset, per_page, query, keys=('rank', 'pk')):
+        super(SearchKeysetPaginator, self).__init__(queryset, per_page, keys)
+        self.query = query
+
+    def _decode_value(self, name, value):
+        if not isinstance(value, numbers.Real) or isinstance(value, bool):
+            raise InvalidCursor(u"Неверный курсор")
+        return super(SearchKeysetPaginator, self)._decode_value(name, value)
+
+    def fetch(self, queryset, values, reverse, limit):
+        if values is not None:
+            rank, pk = values
+            operator = '>' if reverse else '<'
+            pk_column = '%s.%s' % (queryset.model._meta.db_table,
+                                   queryset.model._meta.pk.column)
+            seek = "({rank} {op} %s OR ({rank} = %s AND {pk} {op} %s))".format(
+                rank=RANK_SQL, op=operator, pk=pk_column)
+            queryset = queryset.extra(
+                where=[seek], params=[self.query, rank, self.query, rank, pk])
+        return list(queryset.order_by(*self.get_ordering(reverse))[:limit])
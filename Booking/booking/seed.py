@@ -0,0 +1,430 @@
+# -*- coding: utf-8 -*-
+
+"""
+Синтетические данные для замеров и проверки индексов (команда seed).
+
+Seeder создает заказчиков, исполнителей и их заказы с заданными долями
+статусов, распределением цен (логнормальным), числом претендентов на заказ и
+числом комментариев. Строки записываются в таблицы командой COPY частями по
+chunk_size строк, без моделей и сигналов, поэтому миллионы заказов
+создаются за минуты. Хэш пароля вычисляется один раз для всех
+пользователей. Случайные значения берутся из генератора с начальным
+значением seed: одинаковые параметры дают одинаковые данные (кроме дат,
+которые отсчитываются от текущего момента).
+
+Данные согласованы так же, как после работы через сайт:
+
+- ожидающие исполнителя заказы не имеют претендентов, ожидающие
+  подтверждения - от одного до applicants претендентов; у выполняющихся,
+  завершаемых и завершенных заказов есть исполнитель, претендентов нет;
+- цены выполняющихся и завершаемых заказов удержаны (EscrowHold,
+  UserProfile.held), у завершаемых заказов есть задание очереди расчетов;
+- журнал операций совпадает с остатками: начальный остаток заказчика равен
+  остатку плюс оплаченные заказы, выплаты исполнителям и комиссии записаны
+  по каждому завершенному заказу. Остатки счетов ограничены размером поля
+  cash, поэтому заработок исполнителей сверх остатка и все комиссии
+  выводятся операциями "Исправление";
+- признак affordable вычислен по остатку заказчика, лента и счетчики
+  перестраиваются (feed.rebuild, counters.rebuild).
+
+Все выполняется в одной транзакции. Таблицы пользователей и заказов
+блокируются от параллельных вставок, id новых строк назначаются подряд после
+существующих, последовательности id затем сдвигаются.
+"""
+
+import bisect
+import io
+import math
+import random
+import time
+from datetime import datetime, timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+
+from .loadtest import get_group
+from .models import Booking, LedgerEntry, SystemAccount
+from . import counters, feed, roles
+
+
+# Доли статусов заказов по умолчанию
+STATUS_MIX = (
+    (Booking.PENDING, 30),
+    (Booking.WAITING_FOR_APPROVAL, 15),
+    (Booking.RUNNING, 10),
+    (Booking.COMPLETING, 5),
+    (Booking.COMPLETED, 40),
+)
+
+# Версия заказа после переходов до статуса
+VERSIONS = {
+    Booking.PENDING: 1,
+    Booking.WAITING_FOR_APPROVAL: 2,
+    Booking.RUNNING: 3,
+    Booking.COMPLETING: 4,
+    Booking.COMPLETED: 4,
+}
+
+# Статусы, в которых цена заказа удержана со счета заказчика
+HELD_STATUSES = (Booking.RUNNING, Booking.COMPLETING)
+
+# Наибольшие сумма на счету (UserProfile.cash) и цена заказа, копейки
+MAX_CASH = 999999
+MAX_PRICE = 99999999
+
+# Слова заголовков и текстов
+WORDS = (
+    u"ремонт", u"квартира", u"доставка", u"перевод", u"текст", u"сайт",
+    u"дизайн", u"логотип", u"уборка", u"офис", u"мебель", u"сборка",
+    u"установка", u"настройка", u"компьютер", u"сеть", u"обучение",
+    u"английский", u"математика", u"курьер", u"документы", u"фото",
+    u"видео", u"монтаж", u"статья", u"перевозка", u"переезд", u"сантехника",
+    u"электрика", u"покраска", u"стены", u"окна", u"сад", u"газон",
+    u"срочно", u"недорого", u"качественно", u"быстро", u"помощь",
+)
+
+# Число заранее составленных заголовков и текстов, из которых они
+# выбираются для заказов и комментариев
+TEXT_POOL = 1000
+
+# Блокировка таблиц, в которые строки вставляются с назначенными id
+LOCK_SQL = "LOCK TABLE auth_user, booking_booking IN SHARE ROW EXCLUSIVE MODE"
+
+# Сдвиг последовательности id таблицы на наибольший id
+SETVAL_SQL = """
+SELECT setval(pg_get_serial_sequence('%s', 'id'),
+              (SELECT MAX(id) FROM %s))
+"""
+
+NULL = u"\\N"
+
+
+def parse_statuses(value):
+    """
+    Доли статусов из строки вида "pending=30,completed=70"
+    """
+    statuses = dict(Booking.STATUS_CHOICES)
+    mix = []
+    for item in value.split(','):
+        status, sep, weight = item.strip().partition('=')
+        if status not in statuses or not sep:
+            raise ValueError(u"Неверная доля статуса: %s" % item)
+        try:
+            mix.append((status, float(weight)))
+        except ValueError:
+            raise ValueError(u"Неверная доля статуса: %s" % item)
+    return tuple(mix)
+
+
+def format_cents(cents):
+    """
+    Сумма в копейках в виде числа с двумя знаками после точки
+    """
+    sign = u"-" if cents < 0 else u""
+    return u"%s%d.%02d" % (sign, abs(cents) // 100, abs(cents) % 100)
+
+
+def format_date(date):
+    """
+    Дата и время (UTC) для COPY
+    """
+    return u"%s+00" % date.isoformat(' ')
+
+
+class CopyWriter(object):
+
+    """
+    Строки таблицы, записываемые командой COPY по chunk_size строк. Перед
+    записью записываются накопленные строки таблиц parents, на строки
+    которых ссылаются строки этой таблицы.
+    """
+
+    def __init__(self, cursor, table, columns, chunk_size, parents=()):
+        self.cursor = cursor
+        self.sql = "COPY %s (%s) FROM STDIN" % (table, ", ".join(columns))
+        self.chunk_size = chunk_size
+        self.parents = parents
+        self.rows = []
+        self.count = 0
+
+    def add(self, *values):
+        """
+        Строка из уже отформатированных значений (NULL - для NULL)
+        """
+        self.rows.append(u"\t".join(values))
+        if len(self.rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        for parent in self.parents:
+            parent.flush()
+        data = (u"\n".join(self.rows) + u"\n").encode('utf-8')
+        self.cursor.copy_expert(self.sql, io.BytesIO(data))
+        self.count += len(self.rows)
+        self.rows = []
+
+
+class Seeder(object):
+
+    """
+    Генерация customers заказчиков, performers исполнителей и bookings
+    заказов. Имена пользователей начинаются с prefix, пароль у всех
+    password.
+    """
+
+    def __init__(self, customers=1000, performers=1000, bookings=10000,
+                 statuses=STATUS_MIX, price_median=50, price_sigma=0.8,
+                 cash_max=2000, applicants=5, comments=3, days=365, seed=0,
+                 prefix='seed', password='password', chunk_size=50000):
+        if customers < 1 or performers < 1:
+            raise ValueError(u"Нужны хотя бы один заказчик и один исполнитель")
+        if not 1 <= applicants <= performers:
+            raise ValueError(u"Претендентов на заказ должно быть от 1 до "
+                             u"числа исполнителей")
+        if not statuses or sum(weight for status, weight in statuses) <= 0:
+            raise ValueError(u"Не заданы доли статусов")
+        if not 0 <= cash_max * 100 <= MAX_CASH:
+            raise ValueError(u"Наибольшая сумма на счету - %s" %
+                             format_cents(MAX_CASH))
+        if price_median <= 0 or price_sigma < 0:
+            raise ValueError(u"Неверное распределение цен")
+        self.customers = customers
+        self.performers = performers
+        self.bookings = bookings
+        self.statuses = [status for status, weight in statuses]
+        self.cumulative = []
+        total = 0
+        for status, weight in statuses:
+            total += weight
+            self.cumulative.append(total)
+        self.price_mu = math.log(price_median)
+        self.price_sigma = price_sigma
+        self.cash_max = int(cash_max * 100)
+        self.applicants = applicants
+        self.comments = comments
+        self.days = days
+        self.prefix = prefix
+        self.password = password
+        self.chunk_size = chunk_size
+        self.rng = random.Random(seed)
+
+    # Вспомогательные значения
+
+    def make_texts(self, min_words, max_words):
+        rng = self.rng
+        return [u" ".join(rng.choice(WORDS) for i in range(
+            rng.randint(min_words, max_words))) for i in range(TEXT_POOL)]
+
+    def choose_status(self):
+        return self.statuses[bisect.bisect_right(
+            self.cumulative, self.rng.random() * self.cumulative[-1])]
+
+    def choose_price(self):
+        cents = int(round(self.rng.lognormvariate(
+            self.price_mu, self.price_sigma) * 100))
+        return min(max(cents, 100), MAX_PRICE)
+
+    def writer(self, table, columns, parents=()):
+        writer = CopyWriter(self.cursor, table, columns, self.chunk_size,
+                            parents)
+        self.writers.append(writer)
+        return writer
+
+    # Этапы
+
+    def prepare(self):
+        if User.objects.filter(
+                username__startswith=self.prefix + '_').exists():
+            raise ValueError(u"Пользователи с префиксом %s уже есть" %
+                             self.prefix)
+        self.customer_group = get_group(roles.CUSTOMERS, ('add_booking',))
+        self.performer_group = get_group(roles.PERFORMERS, ('perform_perm',))
+        account = SystemAccount.objects.order_by('pk').first()
+        if account is None:
+            account = SystemAccount.objects.create()
+        # Комиссия в сотых долях (SystemAccount.commission - два знака)
+        self.commission = int(account.get_comission() * 100)
+        self.cursor.execute(LOCK_SQL)
+        # Внешние ключи проверяются сразу при вставке строк, а не в конце
+        # транзакции: очередь отложенных проверок миллионов строк не
+        # помещается в память
+        self.cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+        self.cursor.execute("SELECT COALESCE(MAX(id), 0) FROM auth_user")
+        self.first_user_id = self.cursor.fetchone()[0] + 1
+        self.cursor.execute("SELECT COALESCE(MAX(id), 0) FROM booking_booking")
+        self.first_booking_id = self.cursor.fetchone()[0] + 1
+        self.now = datetime.utcnow()
+        self.start = self.now - timedelta(days=self.days)
+
+        self.users = self.writer('auth_user', (
+            'id', 'password', 'last_login', 'is_superuser', 'username',
+            'first_name', 'last_name', 'email', 'is_staff', 'is_active',
+            'date_joined'))
+        users = (self.users,)
+        self.user_groups = self.writer('auth_user_groups',
+                                       ('user_id', 'group_id'), users)
+        self.profiles = self.writer('booking_userprofile',
+                                    ('user_id', 'cash', 'held'), users)
+        self.booking_rows = self.writer('booking_booking', (
+            'id', 'title', 'text', 'price', 'status', 'customer_id',
+            'performer_id', 'date', 'version', 'affordable'), users)
+        bookings = (self.users, self.booking_rows)
+        self.applications = self.writer('booking_booking_possible_performers',
+                                        ('booking_id', 'user_id'), bookings)
+        self.comment_rows = self.writer('booking_comment', (
+            'booking_id', 'text', 'date', 'creator_id'), bookings)
+        self.holds = self.writer('booking_escrowhold', (
+            'customer_id', 'booking_id', 'amount', 'date'), bookings)
+        self.settlements = self.writer('booking_settlement', (
+            'booking_id', 'date', 'error'), bookings)
+        self.ledger = self.writer('booking_ledgerentry', (
+            'user_id', 'amount', 'kind', 'booking_id', 'date'), bookings)
+
+    def create_users(self):
+        """
+        Пользователи и их группы. Остатки заказчиков выбираются сразу: от
+        них зависит признак affordable заказов.
+        """
+        password = make_password(self.password)
+        joined = format_date(self.start)
+        user_id = self.first_user_id
+        for role, count, group in (
+                ('c', self.customers, self.customer_group),
+                ('p', self.performers, self.performer_group)):
+            for i in range(count):
+                username = u"%s_%s%s" % (self.prefix, role, i)
+                self.users.add(
+                    unicode(user_id), password, joined, u"f", username, u"",
+                    u"", u"%s@example.com" % username, u"f", u"t", joined)
+                self.user_groups.add(unicode(user_id), unicode(group.pk))
+                user_id += 1
+        self.customer_ids = range(self.first_user_id,
+                                  self.first_user_id + self.customers)
+        self.performer_ids = range(self.first_user_id + self.customers,
+                                   user_id)
+        self.customer_cash = [self.rng.randint(0, self.cash_max)
+                              for i in range(self.customers)]
+        self.customer_spent = [0] * self.customers
+        self.customer_held = [0] * self.customers
+        self.performer_earned = [0] * self.performers
+        self.commission_total = 0
+
+    def create_bookings(self):
+        rng = self.rng
+        titles = self.make_texts(2, 5)
+        texts = self.make_texts(5, 30)
+        comment_texts = self.make_texts(3, 15)
+        step = self.days * 86400.0 / max(self.bookings, 1)
+        for i in range(self.bookings):
+            booking_id = unicode(self.first_booking_id + i)
+            status = self.choose_status()
+            customer = rng.randrange(self.customers)
+            customer_id = unicode(self.customer_ids[customer])
+            price = self.choose_price()
+            date = self.start + timedelta(seconds=(i + rng.random()) * step)
+            formatted_date = format_date(date)
+            applicants = []
+            performer = None
+            if status == Booking.WAITING_FOR_APPROVAL:
+                applicants = rng.sample(self.performer_ids,
+                                        rng.randint(1, self.applicants))
+            elif status != Booking.PENDING:
+                performer = rng.randrange(self.performers)
+            self.booking_rows.add(
+                booking_id, rng.choice(titles), rng.choice(texts),
+                format_cents(price), status, customer_id,
+                NULL if performer is None else
+                unicode(self.performer_ids[performer]),
+                formatted_date, unicode(VERSIONS[status]),
+                u"t" if price <= self.customer_cash[customer] else u"f")
+            for user_id in applicants:
+                self.applications.add(booking_id, unicode(user_id))
+
+            participants = [self.customer_ids[customer]] + applicants
+            if performer is not None:
+                participants.append(self.performer_ids[performer])
+            for j in range(rng.randint(0, self.comments)):
+                self.comment_rows.add(
+                    booking_id, rng.choice(comment_texts), format_date(
+                        date + timedelta(minutes=j + 1)),
+                    unicode(rng.choice(participants)))
+
+            if performer is None:
+                continue
+            # Цена списана со счета заказчика при подтверждении исполнителя
+            self.customer_spent[customer] += price
+            self.ledger.add(customer_id, format_cents(-price),
+                            LedgerEntry.HOLD, booking_id, formatted_date)
+            if status in HELD_STATUSES:
+                self.customer_held[customer] += price
+                self.holds.add(customer_id, booking_id, format_cents(price),
+                               formatted_date)
+                if status == Booking.COMPLETING:
+                    self.settlements.add(booking_id, formatted_date, u"")
+                continue
+            # Комиссия округляется до копеек, как в transitions.complete_many
+            cash_for_system = (price * self.commission + 50) // 100
+            cash_for_performer = price - cash_for_system
+            self.performer_earned[performer] += cash_for_performer
+            self.commission_total += cash_for_system
+            self.ledger.add(unicode(self.performer_ids[performer]),
+                            format_cents(cash_for_performer),
+                            LedgerEntry.PAYOUT, booking_id, formatted_date)
+            self.ledger.add(NULL, format_cents(cash_for_system),
+                            LedgerEntry.COMMISSION, booking_id, formatted_date)
+
+    def create_profiles(self):
+        """
+        Профили с остатками и операции журнала, сводящие остатки к ним
+        """
+        opened = format_date(self.start)
+        withdrawn = format_date(self.now)
+        for i, user_id in enumerate(self.customer_ids):
+            cash = self.customer_cash[i]
+            self.profiles.add(unicode(user_id), format_cents(cash),
+                              format_cents(self.customer_held[i]))
+            opening = cash + self.customer_spent[i]
+            if opening:
+                self.ledger.add(unicode(user_id), format_cents(opening),
+                                LedgerEntry.OPENING, NULL, opened)
+        for i, user_id in enumerate(self.performer_ids):
+            earned = self.performer_earned[i]
+            cash = min(earned, self.rng.randint(0, self.cash_max))
+            self.profiles.add(unicode(user_id), format_cents(cash), u"0.00")
+            if cash != earned:
+                self.ledger.add(unicode(user_id), format_cents(cash - earned),
+                                LedgerEntry.ADJUSTMENT, NULL, withdrawn)
+        # Остаток счета системы не изменяется
+        if self.commission_total:
+            self.ledger.add(NULL, format_cents(-self.commission_total),
+                            LedgerEntry.ADJUSTMENT, NULL, withdrawn)
+
+    def run(self):
+        """
+        Генерация данных. Возвращает число строк по таблицам и время
+        генерации, секунды.
+        """
+        started = time.time()
+        self.writers = []
+        with transaction.atomic():
+            self.cursor = connection.cursor()
+            self.prepare()
+            self.create_users()
+            self.create_bookings()
+            self.create_profiles()
+            for writer in self.writers:
+                writer.flush()
+            # Внешние ключи Django - отложенные (DEFERRABLE INITIALLY
+            # DEFERRED)
+            self.cursor.execute("SET CONSTRAINTS ALL DEFERRED")
+            for table in ('auth_user', 'booking_booking'):
+                self.cursor.execute(SETVAL_SQL % (table, table))
+            feed.rebuild()
+            counters.rebuild()
+        report = dict((writer.sql.split()[1], writer.count)
+                      for writer in self.writers)
+        report['elapsed'] = time.time() - started
+        return report
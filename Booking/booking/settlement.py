@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+"""
+Очередь расчетов по завершенным заказам (таблица Settlement).
+
+При асинхронном завершении (BOOKING_SETTLEMENT_ASYNC) запрос заказчика
+только переводит заказ в статус "Завершается" и ставит его в очередь, а
+деньги исполнителю и системе переводят обработчики очереди (команда
+settlement_worker) - порциями, через transitions.complete_many. Обработчиков
+может быть несколько: каждый занимает задания транзакционными
+advisory-блокировками (pg_try_advisory_xact_lock, есть в PostgreSQL 9.4),
+пропуская задания, занятые другими, поэтому обработчики не ждут друг друга
+и не берут одно задание дважды. Задание удаляется в той же транзакции, в
+которой переведены деньги, и блокировка снимается вместе с ней.
+"""
+
+import logging
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from .models import Booking, Settlement
+from .transitions import TransitionError
+from . import escrow, transitions
+
+
+logger = logging.getLogger(__name__)
+
+# Ключ класса advisory-блокировок заданий (второй ключ - id задания)
+LOCK_CLASS = 15
+
+# Число заданий-кандидатов на одно задание порции: задания, занятые другими
+# обработчиками, пропускаются
+CLAIM_CANDIDATES = 10
+
+# Очередная порция заданий. Блокировка пробуется по кандидатам в порядке id,
+# пока не занята вся порция (LIMIT внешнего запроса), поэтому блокируются
+# только возвращенные задания. Задание, выполненное другим обработчиком
+# после начала запроса, может быть занято повторно: его заказ уже не в
+# статусе "Завершается", и повторный расчет ничего не меняет.
+CLAIM_SQL = """
+SELECT id, booking_id FROM (
+    SELECT id, booking_id FROM booking_settlement
+    WHERE error = ''
+    ORDER BY id
+    LIMIT %s
+) AS candidates
+WHERE pg_try_advisory_xact_lock(%s, id)
+LIMIT %s
+"""
+
+# Состояние очереди: число заданий, число заданий с ошибкой, время
+# постановки в очередь самого старого задания
+STATS_SQL = """
+SELECT COUNT(*) FILTER (WHERE error = ''),
+       COUNT(*) FILTER (WHERE error <> ''),
+       MIN(date) FILTER (WHERE error = ''),
+       now()
+FROM booking_settlement
+"""
+
+
+def queue_stats():
+    """
+    Состояние очереди расчетов: depth - число заданий в очереди, failed -
+    число заданий с ошибкой, lag - сколько секунд ждет самое старое задание.
+    """
+    cursor = connection.cursor()
+    cursor.execute(STATS_SQL)
+    depth, failed, oldest, now = cursor.fetchone()
+    lag = (now - oldest).total_seconds() if oldest is not None else 0.0
+    return {'depth': depth, 'failed': failed, 'lag': lag}
+
+
+def settle_one(task_id, booking_id):
+    """
+    Расчет по одному заказу. Если расчет невозможен, ошибка записывается
+    в задание.
+    """
+    try:
+        with transaction.atomic():
+            split = transitions.complete_many([booking_id],
+                                              status=Booking.COMPLETING)
+    except TransitionError as e:
+        logger.error(u"Расчет по заказу %s невозможен: %s", booking_id,
+                     e.message)
+        Settlement.objects.filter(id=task_id).update(error=e.message)
+        return []
+    Settlement.objects.filter(id=task_id).delete()
+    return split
+
+
+def process_batch(batch_size=None):
+    """
+    Расчет по очередной порции заданий одной транзакцией. Возвращает
+    (число обработанных заданий, список (id заказа, комиссия, сумма
+    исполнителю)).
+    """
+    if batch_size is None:
+        batch_size = settings.BOOKING_SETTLEMENT_BATCH_SIZE
+    try:
+        return claim_and_settle(batch_size)
+    finally:
+        # Признак "хватает средств" заказов исполнителей, получивших деньги
+        escrow.flush()
+
+
+def claim_and_settle(batch_size):
+    """
+    Выборка порции заданий и расчет по ней (см. process_batch)
+    """
+    with transaction.atomic():
+        cursor = connection.cursor()
+        cursor.execute(CLAIM_SQL, [batch_size * CLAIM_CANDIDATES, LOCK_CLASS,
+                                   batch_size])
+        tasks = cursor.fetchall()
+        if not tasks:
+            return 0, []
+        try:
+            with transaction.atomic():
+                split = transitions.complete_many(
+                    [booking_id for task_id, booking_id in tasks],
+                    status=Booking.COMPLETING)
+        except TransitionError:
+            # Расчет по одному из заказов невозможен - остальные заказы
+            # порции рассчитываются по одному
+            split = []
+            for task_id, booking_id in tasks:
+                split.extend(settle_one(task_id, booking_id))
+            return len(tasks), split
+        # Задания заказов, которые уже не в статусе "Завершается" (например,
+        # удалены), тоже удаляются
+        Settlement.objects.filter(
+            id__in=[task_id for task_id, booking_id in tasks]).delete()
+    return len(tasks), split
+
+
+def run(batch_size=None, poll_interval=None, once=False):
+    """
+    Обработка очереди. Пока очередь не пуста, порции обрабатываются одна за
+    другой, затем очередь проверяется раз в poll_interval секунд. При
+    once=True обработка заканчивается, когда очередь пуста.
+    """
+    if poll_interval is None:
+        poll_interval = settings.BOOKING_SETTLEMENT_POLL_INTERVAL
+    while True:
+        count, split = process_batch(batch_size)
+        if count:
+            logger.info(u"Обработано заданий: %s, завершено заказов: %s",
+                        count, len(split))
+            continue
+        if once:
+            return
+        time.sleep(poll_interval)
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+"""
+Сигналы приложения заказов
+"""
+
+from django.dispatch import Signal
+
+
+# Сумма на счету пользователя изменена запросом UPDATE в обход save()
+# (см. UserProfile.change_cash). cash - новая сумма.
+balance_changed = Signal(providing_args=['user_id', 'cash'])
+
+# Признак Booking.affordable заказов изменен запросом UPDATE (см. escrow.py).
+# changes - список пар (id заказа, новое значение признака).
+affordable_changed = Signal(providing_args=['changes'])
+
+# Статус заказа изменился. Посылается после сохранения заказа с новым
+# статусом, в той же транзакции.
+booking_status_changed = Signal(providing_args=['booking', 'old_status'])
+
+# Заказ изменен запросом UPDATE в обход save() (post_save не посылается).
+# booking - заказ с новыми значениями, old_status и old_performer_id -
+# значения до изменения.
+booking_updated = Signal(providing_args=['booking', 'old_status',
+                                         'old_performer_id'])
+
+# Заказы завершены одним запросом UPDATE (см. transitions.complete_many).
+# bookings - список словарей с полями id, customer_id, performer_id, price,
+# version, cash_for_system, cash_for_performer завершенных заказов, old_status - статус до завершения, balances -
+# {id пользователя: новая сумма на счету} исполнителей, получивших деньги.
+bookings_completed = Signal(providing_args=['bookings', 'old_status',
+                                            'balances'])
@@ -1,5 +1,6 @@
 from django import template
-from django.contrib.auth.models import Group
+
+from booking.roles import has_role
 
 
 register = template.Library()
@@ -7,5 +8,4 @@ register = template.Library()
 
 @register.filter(name='has_group')
 def has_group(user, group_name):
-    group = Group.objects.get(name=group_name)
-    return True if group in user.groups.all() else False
+    return has_role(user, group_name)
@@ -1,14 +1,68 @@
 # -*- coding: utf-8 -*-
 
-from django.test import TestCase
-from booking.models import Booking, SystemAccount, UserProfile, Comment
+from django.test import Client, TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from booking.models import Booking, SystemAccount, UserProfile, Comment,\
+    FeedEntry, BookingCounter, LedgerEntry, BalanceSnapshot, Settlement, \
+    EscrowHold, IdempotencyKey
+from booking.views import BookingListView, OwnBookingListView
+from booking import benchmark, counters, escrow, events, feed, \
+    idempotency, instrumentation, ledger, metrics, roles, settlement, \
+    transitions
+from booking.transitions import TransitionError
+from booking.pagination import CachedCountPaginator, EstimatedCountPaginator
+from booking.roles import registry
+from booking.templatetags.has_group import has_group
 from django.contrib.auth.models import User, Group, Permission
 from django.contrib.contenttypes.models import ContentType
 from django.core.urlresolvers import reverse
-
+from django.conf import settings
+from django.db.models import Sum
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, transaction, DatabaseError
+from django.test.utils import CaptureQueriesContext
+from django.core.cache import cache
+from django.template import Context, Template
+from django.core.cache.utils import make_template_fragment_key
+from django.utils import timezone
+
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+from StringIO import StringIO
+import base64
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
 import time
 
 
+class BookingClient(Client):
+
+    """
+    Клиент тестов: реестр групп, сброшенный созданием групп при подготовке
+    данных, загружается до запроса - как у работающего процесса
+    """
+
+    def request(self, **request):
+        registry.get_names([])
+        return super(BookingClient, self).request(**request)
+
+
+# Превышение бюджета запросов (BOOKING_QUERY_BUDGETS) любым запросом теста -
+# ошибка
+@override_settings(BOOKING_QUERY_BUDGET_STRICT=True)
+class BookingTestCase(TestCase):
+
+    client_class = BookingClient
+
+
 class BookingModelTestCase(TestCase):
 
     def setUp(self):
@@ -67,7 +121,9 @@ class BookingModelTestCase(TestCase):
         self.assertEqual(booking.get_status(), Booking.COMPLETED)
 
 
-class BookingViewsTestCase(TestCase):
+# Завершение заказа с переводом денег в том же запросе
+@override_settings(BOOKING_SETTLEMENT_ASYNC=False)
+class BookingViewsTestCase(BookingTestCase):
 
     def setUp(self):
         """
@@ -268,7 +324,7 @@ class BookingViewsTestCase(TestCase):
         self.assertEqual(booking.get_status(), Booking.COMPLETED)
         system_account = SystemAccount.objects.all()[0]
         comission = system_account.get_comission()
-        self.assertEqual(system_account.account, booking.price * comission)
+        self.assertEqual(system_account.get_balance(), booking.price * comission)
         self.assertEqual(user2.profile.cash, booking.price * (1 - comission))
 
     def test_create_three_users_create_booking_and_2nd_customer_can_not_complete(self):
@@ -406,7 +462,7 @@ class BookingViewsTestCase(TestCase):
         self.assertEqual(booking.get_status(), Booking.RUNNING)
         system_account = SystemAccount.objects.all()[0]
         comission = system_account.get_comission()
-        self.assertEqual(system_account.account, 0.0)
+        self.assertEqual(system_account.get_balance(), 0.0)
         self.assertEqual(user3.profile.cash, 0.0)
         self.assertEqual(user2.profile.cash, user2_cash_before)
 
@@ -776,7 +832,7 @@ class BookingViewsTestCase(TestCase):
         self.assertEqual(booking.get_status(), Booking.COMPLETED)
         system_account = SystemAccount.objects.all()[0]
         comission = system_account.get_comission()
-        self.assertEqual(system_account.account, booking.price * comission)
+        self.assertEqual(system_account.get_balance(), booking.price * comission)
         self.assertEqual(user2.profile.cash, booking.price * (1 - comission))
 
     def test_customer_create_and_delete_booking(self):
@@ -1527,231 +1583,2215 @@ class BookingViewsTestCase(TestCase):
         self.assertEqual(booking.get_status(), Booking.COMPLETED)
         system_account = SystemAccount.objects.all()[0]
         comission = system_account.get_comission()
-        self.assertEqual(system_account.account, booking.price * comission)
+        self.assertEqual(system_account.get_balance(), booking.price * comission)
         self.assertEqual(user3.profile.cash, booking.price * (1 - comission))
 
 
-class BookingViewsPerformanceTestCase(TestCase):
+class BookingListPaginationTestCase(BookingTestCase):
 
-    # Число пользователей
-    K = 10
-    # Число заказов одного пользователя
-    M = 1
+    # Число заказов
+    N = 45
 
     def setUp(self):
         """
-        Создать 2*K пользователей: K заказчиков, K исполнителей.
-        Назначение им прав на создание и исполнение заказа соответсвенно.
+        Заказчик с N заказами. Часть заказов создана в один и тот же момент,
+        чтобы проверить упорядочивание по id внутри одной даты.
         """
-        SystemAccount.objects.create()
+        user = User.objects.create_user(
+            'john', 'lennon@thebeatles.com', 'johnpassword'
+        )
+        UserProfile.objects.create(user=user, cash=1000.00)
+        content_type = ContentType.objects.get_for_model(Booking)
+        permission, is_created = Permission.objects.get_or_create(
+            content_type=content_type, codename='add_booking')
+        user.user_permissions.add(permission)
+        customers, is_created = Group.objects.get_or_create(name="customers")
+        user.groups.add(customers)
+
+        Booking.objects.bulk_create([
+            Booking(title="".join(['title', str(i)]),
+                    text="".join(['text', str(i)]), price=10, customer=user)
+            for i in range(self.N)
+        ])
+        same_date_ids = Booking.objects.order_by('id').values_list(
+            'id', flat=True)[10:30]
+        Booking.objects.filter(id__in=list(same_date_ids)).update(
+            date=Booking.objects.order_by('id')[10].date)
+        # bulk_create и update не посылают сигналов, лента строится заново
+        feed.rebuild()
+
+        self.client.login(username='john', password='johnpassword')
+        # Пересчеты affordable, отложенные при подготовке данных (см.
+        # escrow.py)
+        escrow.flush()
+
+    def walk(self, url):
+        """
+        Проход по всем страницам вперед, затем назад по курсорам
+        """
+        forward = []
+        response = self.client.get(url)
+        pages = [response.context['page_obj']]
+        while pages[-1].has_next():
+            response = self.client.get(url, {'after': pages[-1].next_cursor})
+            self.assertEqual(response.status_code, 200)
+            pages.append(response.context['page_obj'])
+        for page in pages:
+            forward.extend(o.pk for o in page.object_list)
+
+        backward = [o.pk for o in pages[-1].object_list]
+        page = pages[-1]
+        while page.has_previous():
+            response = self.client.get(url, {'before': page.previous_cursor})
+            self.assertEqual(response.status_code, 200)
+            page = response.context['page_obj']
+            backward = [o.pk for o in page.object_list] + backward
+        return forward, backward, pages
+
+    def test_keyset_pages_of_booking_list(self):
+        expected = list(Booking.objects.order_by('-date', '-id').values_list(
+            'id', flat=True))
+        forward, backward, pages = self.walk(reverse('booking-list'))
+        self.assertEqual(len(pages), 3)
+        self.assertEqual(forward, expected)
+        self.assertEqual(backward, expected)
+
+    def test_keyset_pages_of_own_booking_list(self):
+        expected = list(Booking.objects.order_by('-date', '-id').values_list(
+            'id', flat=True))
+        forward, backward, pages = self.walk(reverse('own-booking-list'))
+        self.assertEqual(forward, expected)
+        self.assertEqual(backward, expected)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('booking-list'),
+                                   {'after': 'not a cursor'})
+        self.assertEqual(response.status_code, 404)
+        # Подделанные значения ключа
+        for values in ([1, "abc"], [10 ** 30, 1], [-10 ** 20, 1], [1, [1]],
+                       ["1", 1], [1, None]):
+            cursor = base64.urlsafe_b64encode(json.dumps(values))
+            for url_name in ('booking-list', 'own-booking-list'):
+                for parameter in ('after', 'before'):
+                    response = self.client.get(reverse(url_name),
+                                               {parameter: cursor})
+                    self.assertEqual(response.status_code, 404,
+                                     (values, url_name, parameter))
+
+    def test_empty_previous_page(self):
+        """
+        Перед первой строкой списка строк нет: выводится первая страница
+        """
+        first = Booking.objects.order_by('-date', '-id')[0]
+        paginator = BookingListView.keyset_paginator_class(
+            Booking.objects.all(), 3)
+        page = paginator.page(before=paginator.cursor_for(first))
+        self.assertEqual(list(page), list(paginator.page()))
+        self.assertFalse(page.has_previous())
+        self.assertTrue(page.next_cursor)
+        response = self.client.get(reverse('own-booking-list'), {
+            'before': paginator.cursor_for(first)})
+        self.assertEqual(response.status_code, 200)
 
-        # Здесь хранятся пользователи
-        customer_users = []
-        performer_users = []
 
-        # Создание группы с правами на создание заказа
-        booking_content = ContentType.objects.get_for_model(Booking)
+class QueryBudgetMixin(object):
 
-        customers = Group.objects.create(name="customers")
+    """
+    Проверка бюджетов запросов views (BOOKING_QUERY_BUDGETS) и отсутствия
+    в них повторяющихся запросов (N+1)
+    """
+
+    def assertQueryBudget(self, url_name, page_size=None, view=None, args=(),
+                          data=None, method='get', **extra):
+        """
+        Запрос к view url_name; при странице из page_size заказов (view -
+        класс списка заказов), если page_size указан. Превышение бюджета -
+        ошибка QueryBudgetExceeded, повторяющиеся запросы - ошибка
+        RepeatedQueries.
+        """
+        # Пересчеты, отложенные при подготовке данных (см. escrow.py)
+        escrow.flush()
+        if page_size is not None:
+            saved = view.paginate_by
+            view.paginate_by = page_size
+        try:
+            with self.settings(BOOKING_QUERY_BUDGET_STRICT=True,
+                               BOOKING_REPEATED_QUERIES_DETECTION=True,
+                               BOOKING_REPEATED_QUERIES_STRICT=True):
+                response = getattr(self.client, method)(
+                    reverse(url_name, args=args), data or {}, **extra)
+        finally:
+            if page_size is not None:
+                view.paginate_by = saved
+        self.assertLess(response.status_code, 400)
+        return response
+
+
+class BookingListQueriesTestCase(QueryBudgetMixin, BookingTestCase):
 
+    def setUp(self):
+        """
+        Исполнитель и заказчики; половине заказчиков не хватает средств на
+        их заказы.
+        """
+        customers, is_created = Group.objects.get_or_create(name="customers")
+        performers, is_created = Group.objects.get_or_create(name="performers")
+        content_type = ContentType.objects.get_for_model(Booking)
         add, is_created = Permission.objects.get_or_create(
-            content_type=booking_content, codename='add_booking')
-        change, is_created = Permission.objects.get_or_create(
-            content_type=booking_content, codename='change_booking')
-        delete, is_created = Permission.objects.get_or_create(
-            content_type=booking_content, codename='delete_booking')
+            content_type=content_type, codename='add_booking')
+        perform = Permission.objects.get(
+            content_type=content_type, codename='perform_perm')
 
-        customers.permissions.add(add)
-        customers.permissions.add(change)
-        customers.permissions.add(delete)
-        customers.save()
+        self.performer = User.objects.create_user(
+            'performer', 'performer@test.com', 'performerpassword')
+        self.performer.groups.add(performers)
+        self.performer.user_permissions.add(perform)
+        UserProfile.objects.create(user=self.performer, cash=0.00)
 
-        self.assertEqual(len(customers.permissions.all()), 3)
-        self.assertEqual(customers.permissions.all()[0], add)
-        self.assertEqual(customers.permissions.all()[1], change)
-        self.assertEqual(customers.permissions.all()[2], delete)
-
-        # Создание K пользователей.
-        # Назначение каждому из K пользователей прав на создание заказа
-        for i in range(self.K):
-            print "".join(['_test_customer', str(i)])
+        self.customers = []
+        for i in range(20):
             user = User.objects.create_user(
-                "".join(['_test_customer', str(i)]),
-                "".join(["_test_customer", str(i), "@test_user.com"]),
-                'test_password'
-            )
+                "".join(['customer', str(i)]),
+                "".join(['customer', str(i), '@test.com']), 'customerpassword')
             user.groups.add(customers)
             user.user_permissions.add(add)
-            user.user_permissions.add(change)
-            user.user_permissions.add(delete)
-            user.save()
-            UserProfile.objects.create(user=user, cash=100.00)
-            self.assertEqual(len(user.groups.all()), 1)
-            self.assertEqual(user.groups.all()[0], customers)
-            customer_users.append(user)
+            UserProfile.objects.create(user=user, cash=100.00 if i % 2 else 5)
+            self.customers.append(user)
+        # Пересчеты affordable, отложенные при подготовке данных (см.
+        # escrow.py)
+        escrow.flush()
 
-        # Создание группы с правами
-        performers, is_created = Group.objects.get_or_create(name="performers")
-        perform, is_created = Permission.objects.get_or_create(
-            content_type=booking_content, codename='perform_perm')
+    def create_bookings(self, count):
+        """
+        Заказы по одному на заказчика: ожидающие исполнителя и ожидающие
+        подтверждения, на часть из последних исполнитель уже подал заявку.
+        """
+        for i in range(count):
+            booking = Booking.objects.create(
+                title="".join(['title', str(i)]), text='text', price=10,
+                customer=self.customers[i])
+            if i % 4 >= 2:
+                booking.set_status(Booking.WAITING_FOR_APPROVAL)
+            if i % 4 == 3:
+                booking.possible_performers.add(self.performer)
+
+    def count_list_queries(self, username, password):
+        self.client.login(username=username, password=password)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('booking-list'))
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response
+
+    def test_performer_actions(self):
+        self.create_bookings(8)
+        count, response = self.count_list_queries(
+            'performer', 'performerpassword')
+        actions = dict((o.customer_id, action)
+                       for o, action, relation in response.context['bookings'])
+        for i in range(8):
+            expected = [BookingListView.NOT_ACTIVE, BookingListView.CAN_TAKE,
+                        BookingListView.CAN_TAKE, BookingListView.CAN_VIEW][i % 4]
+            self.assertEqual(actions[self.customers[i].id], expected)
+
+    def test_customer_actions(self):
+        self.create_bookings(8)
+        count, response = self.count_list_queries(
+            'customer2', 'customerpassword')
+        actions = dict((o.customer_id, action)
+                       for o, action, relation in response.context['bookings'])
+        self.assertEqual(actions[self.customers[0].id],
+                         BookingListView.NOT_ACTIVE)
+        self.assertEqual(actions[self.customers[1].id],
+                         BookingListView.CAN_VIEW)
+        self.assertEqual(actions[self.customers[2].id],
+                         BookingListView.CAN_APPROVE)
+        self.assertEqual(actions[self.customers[3].id],
+                         BookingListView.CAN_VIEW)
+
+    def test_query_count_does_not_depend_on_page_size(self):
+        self.create_bookings(4)
+        # Первый запрос загружает общие для процесса данные (реестр групп)
+        self.count_list_queries('performer', 'performerpassword')
+        small_page_queries, response = self.count_list_queries(
+            'performer', 'performerpassword')
+        self.create_bookings(20)
+        full_page_queries, response = self.count_list_queries(
+            'performer', 'performerpassword')
+        self.assertEqual(len(response.context['bookings']), 20)
+        self.assertEqual(small_page_queries, full_page_queries)
+
+    def test_list_query_budgets(self):
+        self.create_bookings(20)
+        for username in ('performer', 'customer2'):
+            self.client.login(username=username, password='performerpassword'
+                              if username == 'performer' else
+                              'customerpassword')
+            for page_size in (2, 20):
+                response = self.assertQueryBudget(
+                    'booking-list', page_size, BookingListView)
+                self.assertEqual(len(response.context['bookings']), page_size)
+                self.assertQueryBudget('own-booking-list', page_size,
+                                       OwnBookingListView)
+
+    def test_budget_exceeded(self):
+        self.create_bookings(4)
+        self.client.login(username='performer', password='performerpassword')
+        with self.settings(BOOKING_QUERY_BUDGETS={'booking-list': 1}):
+            self.assertRaises(instrumentation.QueryBudgetExceeded,
+                              self.assertQueryBudget, 'booking-list')
+            # Без BOOKING_QUERY_BUDGET_STRICT (вне тестов) превышение
+            # бюджета только записывается в лог
+            messages = []
+            handler = logging.Handler()
+            handler.emit = lambda record: messages.append(record.getMessage())
+            instrumentation.logger.addHandler(handler)
+            instrumentation.logger.propagate = False
+            try:
+                with self.settings(BOOKING_QUERY_BUDGET_STRICT=False):
+                    response = self.client.get(reverse('booking-list'))
+            finally:
+                instrumentation.logger.propagate = True
+                instrumentation.logger.removeHandler(handler)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(messages), 1)
+        self.assertTrue(messages[0].startswith(u'booking-list: '))
+        self.assertIn(u'FROM "booking_feedentry"', messages[0])
+
+    def row_cache_key(self, booking, action, relation, page_type):
+        return make_template_fragment_key('booking_row', [
+            booking.pk, booking.version, action, relation, page_type])
+
+    def test_row_cache(self):
+        """
+        Строка заказа кэшируется по версии заказа, действию и отношению
+        пользователя к заказу. Изменение заказа меняет его версию.
+        """
+        cache.clear()
+        self.create_bookings(2)
+        booking = Booking.objects.get(customer=self.customers[1])
+        version = booking.version
+        key = self.row_cache_key(booking, BookingListView.CAN_TAKE, 'other',
+                                 'all_bookings')
+        self.assertIsNone(cache.get(key))
+        self.count_list_queries('performer', 'performerpassword')
+        self.assertIn('title1', cache.get(key))
+
+        booking.title = 'new_title'
+        booking.save()
+        self.assertEqual(booking.version, version + 1)
+        count, response = self.count_list_queries(
+            'performer', 'performerpassword')
+        self.assertContains(response, 'new_title')
+        key = self.row_cache_key(booking, BookingListView.CAN_TAKE, 'other',
+                                 'all_bookings')
+        self.assertIn('new_title', cache.get(key))
 
-        performers.permissions.add(perform)
-        performers.save()
 
-        self.assertEqual(len(performers.permissions.all()), 1)
-        self.assertEqual(performers.permissions.all()[0], perform)
+    def test_transition_query_budgets(self):
+        """
+        Переходы заказа из списка: AJAX-запросы с ключом идемпотентности
+        """
+        SystemAccount.objects.create()
+        self.create_bookings(2)
+        booking = Booking.objects.get(customer=self.customers[1])
+        steps = (
+            ('performer', 'performerpassword', 'serve-booking',
+             {'id': booking.pk}),
+            ('customer1', 'customerpassword', 'approve-booking',
+             {'booking_id': booking.pk,
+              'possible_performer': self.performer.pk}),
+            ('customer1', 'customerpassword', 'complete-booking',
+             {'id': booking.pk}),
+        )
+        for username, password, url_name, data in steps:
+            self.client.login(username=username, password=password)
+            response = self.assertQueryBudget(
+                url_name, data=data, method='post',
+                HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                HTTP_IDEMPOTENCY_KEY=url_name)
+            self.assertTrue(json.loads(response.content)['success'])
+        self.assertEqual(Booking.objects.get(pk=booking.pk).status,
+                         Booking.COMPLETED)
+
+
+class QueryShapeTestCase(BookingTestCase):
+
+    def test_query_shape(self):
+        self.assertEqual(instrumentation.query_shape(
+            """SELECT "id" FROM "booking_booking"
+               WHERE "id" IN (1, 2, 3) AND "title" = 'it''s' AND price > -1.5
+            """),
+            'SELECT "id" FROM "booking_booking" WHERE "id" IN (...) AND '
+            '"title" = ? AND price > ?')
+        self.assertEqual(
+            instrumentation.query_shape('SELECT 1 FROM t WHERE id IN (7)'),
+            instrumentation.query_shape('SELECT 2 FROM t WHERE id IN (7, 8)'))
+        self.assertEqual(
+            instrumentation.query_shape('SAVEPOINT "s1404239_x4"'),
+            'SAVEPOINT ?')
+
+    def test_query_log(self):
+        with instrumentation.QueryLog() as log:
+            # Отладочный курсор Django не включается
+            self.assertFalse(connection.queries_logged)
+            with instrumentation.QueryLog() as inner:
+                User.objects.filter(pk=1).exists()
+            User.objects.filter(pk=2).exists()
+        User.objects.filter(pk=3).exists()
+        self.assertEqual(inner.count, 1)
+        self.assertEqual(log.count, 2)
+        self.assertEqual(log.shapes().values(), [2])
+        self.assertIn(u'= 2', log.queries[1]['sql'])
+        self.assertTrue(log.sql_time >= 0)
+
+
+class RepeatedQueriesTestCase(BookingTestCase):
 
-        # Создание K пользователей-исполнителей.
-        # Назначение каждому из K пользователей прав на выполнение заказа
-        for i in range(self.K):
+    def setUp(self):
+        for i in range(3):
             user = User.objects.create_user(
-                "".join(['test_performer', str(i)]),
-                "".join(["test_performer", str(i), "@test_user.com"]),
-                'test_password'
-            )
-            UserProfile.objects.create(user=user, cash=0.00)
-            user.groups.add(performers)
-            user.user_permissions.add(perform)
-            user.save()
-            self.assertEqual(len(user.groups.all()), 1)
-            self.assertEqual(user.groups.all()[0], performers)
-            performer_users.append(user)
-
-    def test_K_customers_K_performers_M_bookings(self):
-        """
-        K заказчиков создают каждый M заказов.
-        K исполнителей берут на выполнение каждый M заказов.
-        Каждый из K заказчиков подтверждают взятие на выполнение M заказов.
-        Каждый из K заказчиков завершают M заказов.
-        """
-
-        time_before = time.time()
-
-        for i in range(self.K):
-            user1 = User.objects.get(username="".join(['_test_customer', str(i)]))
-            user1_cash_before = user1.profile.cash
-
-            # Вход
-            response = self.client.post('/accounts/login/',
-                {'username': "".join(['_test_customer', str(i)]),
-                 'password': 'test_password'},
-                 follow=True)
-            self.assertEqual(response.status_code, 200)
-            self.assertTemplateUsed(response, 'booking/booking_list.html')
+                'user%s' % i, 'user%s@test.com' % i, 'password')
+            Booking.objects.create(title='title%s' % i, text='text',
+                                   price=10, customer=user)
+
+    def test_code_site(self):
+        with instrumentation.RepeatedQueriesDetector(threshold=3) as detector:
+            names = [booking.customer.username
+                     for booking in Booking.objects.order_by('pk')]
+        self.assertEqual(names, ['user0', 'user1', 'user2'])
+        repeats = detector.repeats()
+        self.assertEqual(len(repeats), 1)
+        shape, count, sites = repeats[0]
+        self.assertEqual(count, 3)
+        self.assertIn(u'FROM "auth_user"', shape)
+        site, site_count = sites.most_common(1)[0]
+        self.assertEqual(site_count, 3)
+        self.assertTrue(site.startswith(u'booking/tests.py:'))
+        self.assertTrue(site.endswith(u' in test_code_site'), site)
+        with self.assertRaises(instrumentation.RepeatedQueries) as error:
+            detector.check('test', strict=True)
+        self.assertIn('3 x SELECT', error.exception.message)
+
+        # Запросы с select_related не повторяются
+        with instrumentation.RepeatedQueriesDetector(threshold=3) as detector:
+            names = [booking.customer.username for booking in
+                     Booking.objects.select_related('customer')]
+        self.assertEqual(detector.repeats(), [])
+        detector.check('test', strict=True)
+
+    @override_settings(TEMPLATE_DEBUG=True)
+    def test_template_site(self):
+        template = Template(u'<ul>\n{% for booking in bookings %}\n'
+                            u'<li>{{ booking.customer.username }}</li>\n'
+                            u'{% endfor %}</ul>')
+        bookings = Booking.objects.order_by('pk')
+        with instrumentation.RepeatedQueriesDetector(threshold=3) as detector:
+            template.render(Context({'bookings': bookings}))
+        shape, count, sites = detector.repeats()[0]
+        self.assertEqual(count, 3)
+        site, site_count = sites.most_common(1)[0]
+        self.assertTrue(site.endswith(u'template <unknown source>:3'), site)
+
+    def test_middleware(self):
+        """
+        Views и шаблоны списков заказов не выполняют повторяющихся запросов
+        """
+        self.client.login(username='user0', password='password')
+        with self.settings(BOOKING_REPEATED_QUERIES_DETECTION=True,
+                           BOOKING_REPEATED_QUERIES_STRICT=True,
+                           BOOKING_REPEATED_QUERIES_THRESHOLD=2):
+            for url_name in ('booking-list', 'own-booking-list'):
+                response = self.client.get(reverse(url_name))
+                self.assertEqual(response.status_code, 200)
+            with self.settings(BOOKING_REPEATED_QUERIES_THRESHOLD=1):
+                self.assertRaises(instrumentation.RepeatedQueries,
+                                  self.client.get, reverse('booking-list'))
+
+    def test_delete(self):
+        """
+        Удаление заказа загружает заказ один раз
+        """
+        booking = Booking.objects.get(title='title0')
+        self.client.login(username='user0', password='password')
+        with self.settings(BOOKING_REPEATED_QUERIES_DETECTION=True,
+                           BOOKING_REPEATED_QUERIES_STRICT=True,
+                           BOOKING_REPEATED_QUERIES_THRESHOLD=2):
+            response = self.client.post(reverse('delete-booking',
+                                                kwargs={'pk': booking.pk}))
+        self.assertRedirects(response, reverse('booking-list'))
+        self.assertFalse(Booking.objects.filter(pk=booking.pk).exists())
 
-            # Просмотр списка заказов
-            response = self.client.get(reverse('booking-list'))
-            self.assertEqual(response.status_code, 200)
-            self.assertTemplateUsed(response, 'booking/booking_list.html')
 
-            # Просмотр формы создания заказа
-            response = self.client.get(reverse('create-booking'))
-            self.assertEqual(response.status_code, 200)
-            self.assertTemplateUsed(response, 'booking/booking_form.html')
-
-            # Создание заказа
-            response = self.client.post(reverse('create-booking'),
-                                        {'title': "".join(['test_title', str(i)]),
-                                         'text': "".join(['test_text', str(i)]),
-                                         'price': '10.00'},
-                                        follow=True)
-            self.assertEqual(response.status_code, 200)
-            self.assertTemplateUsed(response, 'booking/booking_list.html')
+class MetricsTestCase(BookingTestCase):
 
-            # Проверка того, что заказ в базе после создания
-            self.assertEqual(len(Booking.objects.all()), i+1)
-            booking = Booking.objects.all()[i]
+    def setUp(self):
+        User.objects.create_user('john', 'lennon@thebeatles.com',
+                                 'johnpassword')
+        metrics.registry.reset()
+
+    def get_metrics(self):
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], metrics.CONTENT_TYPE)
+        return dict(line.rsplit(' ', 1) for line in
+                    response.content.decode('utf-8').splitlines()
+                    if not line.startswith('#'))
+
+    def test_metrics(self):
+        self.client.login(username='john', password='johnpassword')
+        for i in range(2):
+            self.client.get(reverse('booking-list'))
+        values = self.get_metrics()
+        labels = u'{view="booking-list",method="GET"}'
+        self.assertEqual(values[
+            u'booking_requests_total{view="booking-list",method="GET",'
+            u'status="200"}'], u'2')
+        self.assertEqual(values[u'booking_request_duration_seconds_count' +
+                                labels], u'2')
+        self.assertEqual(values[
+            u'booking_request_duration_seconds_bucket{view="booking-list",'
+            u'method="GET",le="+Inf"}'], u'2')
+        queries = int(values[u'booking_sql_queries_total' + labels])
+        self.assertTrue(queries > 0)
+        self.assertEqual(values[u'booking_request_sql_queries_sum' + labels],
+                         unicode(queries))
+        self.assertIn(u'booking_sql_seconds_total' + labels, values)
+        self.assertEqual(values[u'booking_settlement_queue_depth'], u'0')
+
+    def test_merge_processes(self):
+        directory = tempfile.mkdtemp()
+        try:
+            other = {'booking_requests_total': [
+                [['booking-list', 'GET', '200'], 3]],
+                'booking_request_sql_queries': [
+                    [['booking-list', 'GET'],
+                     [0, 0, 0, 3, 3, 3, 3, 24, 3]]]}
+            with open(os.path.join(directory, '1.json'), 'w') as f:
+                json.dump(other, f)
+            with self.settings(BOOKING_METRICS_DIR=directory):
+                self.client.get(reverse('metrics'))
+                self.assertTrue(os.path.exists(os.path.join(
+                    directory, '%s.json' % os.getpid())))
+                values = self.get_metrics()
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(values[
+            u'booking_requests_total{view="booking-list",method="GET",'
+            u'status="200"}'], u'3')
+        self.assertEqual(values[
+            u'booking_requests_total{view="metrics",method="GET",'
+            u'status="200"}'], u'1')
+        self.assertEqual(values[
+            u'booking_request_sql_queries_bucket{view="booking-list",'
+            u'method="GET",le="10"}'], u'3')
+
+    def test_stale_files_are_removed(self):
+        directory = tempfile.mkdtemp()
+        try:
+            exited = subprocess.Popen(['true'])
+            exited.wait()
+            for filename in ('%s.json' % exited.pid,
+                             '%s.json.1.tmp' % exited.pid,
+                             '%s.json' % os.getpid(), 'README'):
+                open(os.path.join(directory, filename), 'w').close()
+            self.assertEqual(metrics.remove_stale_files(directory), 2)
+            self.assertEqual(sorted(os.listdir(directory)),
+                             ['%s.json' % os.getpid(), 'README'])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_access(self):
+        url = reverse('metrics')
+        self.assertEqual(self.client.get(
+            url, REMOTE_ADDR='10.0.0.1').status_code, 403)
+        with self.settings(BOOKING_METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get(
+                url, REMOTE_ADDR='10.0.0.1',
+                HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            self.assertEqual(self.client.get(
+                url, REMOTE_ADDR='10.0.0.1',
+                HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+
+
+class FeedTestCase(BookingTestCase):
 
-            user1 = User.objects.get(username="".join(['_test_customer', str(i)]))
+    def setUp(self):
+        self.customer = User.objects.create_user(
+            'john', 'lennon@thebeatles.com', 'johnpassword')
+        self.performer = User.objects.create_user(
+            'johndow', 'johndow@test.com', 'dowpassword')
+        UserProfile.objects.create(user=self.customer, cash=Decimal('20.00'))
+        UserProfile.objects.create(user=self.performer, cash=Decimal('0.00'))
+        SystemAccount.objects.create()
 
-            self.assertEqual(booking.get_customer(), user1)
-            self.assertEqual(booking.title, "".join(['test_title', str(i)]))
-            self.assertEqual(booking.text, "".join(['test_text', str(i)]))
-            self.assertEqual(booking.price, 10.0)
-            self.assertEqual(booking.status, Booking.PENDING)
+    def entry(self, booking):
+        return FeedEntry.objects.get(booking=booking)
 
-            # Выход
-            response = self.client.post('/accounts/logout/', follow=True)
-            self.assertEqual(response.status_code, 200)
-            self.assertTemplateUsed(response, 'registration/logged_out.html')
+    def test_feed_follows_booking_changes(self):
+        """
+        Строка ленты создается вместе с заказом, обновляется при подаче
+        заявки, подтверждении и изменении счета заказчика и удаляется при
+        завершении заказа.
+        """
+        booking = Booking.objects.create(
+            title='title', text='text', price=15, customer=self.customer)
+        entry = self.entry(booking)
+        self.assertEqual(entry.customer_username, 'john')
+        self.assertEqual(entry.status, Booking.PENDING)
+        self.assertEqual(entry.applicants_count, 0)
+        self.assertTrue(entry.customer_can_afford)
+
+        booking.possible_performers.add(self.performer)
+        booking.set_status(Booking.WAITING_FOR_APPROVAL)
+        entry = self.entry(booking)
+        self.assertEqual(entry.status, Booking.WAITING_FOR_APPROVAL)
+        self.assertEqual(entry.applicants_count, 1)
+
+        profile = self.customer.profile
+        profile.decrease_cash(booking.price)
+        profile.save()
+        escrow.flush()
+        self.assertFalse(self.entry(booking).customer_can_afford)
+        profile.increase_cash(booking.price)
+        profile.save()
+        escrow.flush()
+        self.assertTrue(self.entry(booking).customer_can_afford)
+
+        booking.set_performer(self.performer)
+        booking.possible_performers.clear()
+        booking.set_status(Booking.RUNNING)
+        entry = self.entry(booking)
+        self.assertEqual(entry.performer_username, 'johndow')
+        self.assertEqual(entry.applicants_count, 0)
+
+        self.performer.username = 'johndow2'
+        self.performer.save()
+        self.assertEqual(self.entry(booking).performer_username, 'johndow2')
+
+        booking.set_status(Booking.COMPLETED)
+        self.assertFalse(FeedEntry.objects.filter(booking=booking).exists())
+
+    def test_rebuild(self):
+        first = Booking.objects.create(
+            title='title1', text='text', price=15, customer=self.customer)
+        second = Booking.objects.create(
+            title='title2', text='text', price=25, customer=self.customer)
+        second.possible_performers.add(self.performer)
+        second.set_status(Booking.WAITING_FOR_APPROVAL)
+        Booking.objects.create(
+            title='title3', text='text', price=5, customer=self.customer,
+            status=Booking.COMPLETED)
+        fields = ('booking', 'customer_username', 'price', 'status',
+                  'applicants_count', 'customer_can_afford')
+        incremental = list(FeedEntry.objects.order_by('booking').values_list(
+            *fields))
+        feed.rebuild()
+        self.assertEqual(
+            list(FeedEntry.objects.order_by('booking').values_list(*fields)),
+            incremental)
+        self.assertEqual([row[0] for row in incremental],
+                         [first.id, second.id])
+
+    def test_feed_is_read_without_bookings(self):
+        """
+        Выборка ленты не соединяется с таблицей заказов, признак "хватает
+        средств" копируется из заказа. Заголовок и текст выведенных строк
+        читаются одним запросом по ключу.
+        """
+        booking = Booking.objects.create(
+            title='title', text='text', price=15, customer=self.customer)
+        booking.title = 'new title'
+        booking.save()
+        self.assertNotIn('booking_booking',
+                         str(feed.get_feed_queryset().query))
+        with self.assertNumQueries(2):
+            entries = list(feed.get_feed_queryset())
+            feed.load_texts(entries)
+        entry, = entries
+        self.assertEqual((entry.title, entry.text), ('new title', 'text'))
+        self.assertTrue(entry.customer_can_afford)
 
-            # Вход из-под исполнителя
-            response = self.client.post('/accounts/login/',
-                {'username': "".join(['test_performer', str(i)]),
-                 'password': 'test_password'},
-                 follow=True)
-            self.assertEqual(response.status_code, 200)
-            self.assertTemplateUsed(response, 'booking/booking_list.html')
+        UserProfile.objects.get(user=self.customer).decrease_cash(10)
+        escrow.flush()
+        self.assertFalse(Booking.objects.get(pk=booking.pk).affordable)
+        self.assertFalse(self.entry(booking).customer_can_afford)
 
-            user2 = User.objects.get(username="".join(['test_performer', str(i)]))
 
+class RolesTestCase(BookingTestCase):
 
+    def setUp(self):
+        self.customers, is_created = Group.objects.get_or_create(
+            name="customers")
+        self.performers, is_created = Group.objects.get_or_create(
+            name="performers")
+        self.user = User.objects.create_user(
+            'john', 'lennon@thebeatles.com', 'johnpassword')
+        self.user.groups.add(self.customers)
+
+    def test_role_checks_are_cached(self):
+        user = User.objects.get(username='john')
+        # Первая проверка - один запрос групп пользователя
+        # (и один запрос реестра групп, если он еще не загружен)
+        self.assertTrue(has_group(user, "customers"))
+        with self.assertNumQueries(0):
+            self.assertTrue(has_group(user, "customers"))
+            self.assertFalse(has_group(user, "performers"))
+            self.assertFalse(has_group(user, "admins"))
+
+        user.groups.add(self.performers)
+        self.assertTrue(has_group(user, "performers"))
+
+    def test_registry_follows_group_changes(self):
+        registry.get_id("customers")
+        admins = Group.objects.create(name="admins")
+        self.assertEqual(registry.get_id("admins"), admins.id)
+        admins.delete()
+        self.assertRaises(Group.DoesNotExist, registry.get_id, "admins")
+
+    def test_registry_loads_groups_created_elsewhere(self):
+        """
+        Группа, созданная в другом процессе (без сигналов), находится по
+        имени и по id
+        """
+        registry.get_id("customers")
+        Group.objects.bulk_create([Group(name="admins")])
+        admins = Group.objects.get(name="admins")
+        self.assertEqual(registry.get_id("admins"), admins.id)
+        registry.get_id("customers")
+        Group.objects.bulk_create([Group(name="moderators")])
+        moderators = Group.objects.get(name="moderators")
+        self.assertEqual(registry.get_names([moderators.id]),
+                         frozenset(["moderators"]))
+        self.assertRaises(Group.DoesNotExist, registry.get_id, "nobody")
+
+    def test_registration_assigns_group(self):
+        response = self.client.post(reverse('registration_register'), {
+            'username': 'new_customer', 'email': 'new@test.com',
+            'password1': 'password', 'password2': 'password',
+            'user_type': 'customer'}, follow=True)
+        self.assertEqual(response.status_code, 200)
+        user = User.objects.get(username='new_customer')
+        self.assertEqual(list(user.groups.all()), [self.customers])
+        self.assertEqual(user.profile.cash, Decimal('1100.00'))
+
+
+class BookingApiTestCase(BookingTestCase):
 
-            # Просмотр списка заказов
-            response = self.client.get(reverse('booking-list'))
-            self.assertEqual(response.status_code, 200)
-            self.assertTemplateUsed(response, 'booking/booking_list.html')
+    def setUp(self):
+        self.customer = User.objects.create_user(
+            'john', 'lennon@thebeatles.com', 'johnpassword')
+        other = User.objects.create_user(
+            'paul', 'paul@thebeatles.com', 'paulpassword')
+        UserProfile.objects.create(user=self.customer, cash=Decimal('100.00'))
+        UserProfile.objects.create(user=other, cash=Decimal('100.00'))
+        for i in range(7):
+            Booking.objects.create(
+                title="".join(['title', str(i)]), text='text', price=10,
+                customer=self.customer if i % 2 else other)
+        completed = Booking.objects.filter(customer=self.customer)[0]
+        completed.set_status(Booking.COMPLETED)
+        self.client.login(username='john', password='johnpassword')
+        # Пересчеты affordable, отложенные при подготовке данных (см.
+        # escrow.py)
+        escrow.flush()
+
+    def get_rows(self, **params):
+        response = self.client.get(reverse('booking-api'), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        content = ''.join(response.streaming_content)
+        return [json.loads(line) for line in content.splitlines()]
+
+    @override_settings(BOOKING_API_CHUNK_SIZE=2)
+    def test_ndjson_feed(self):
+        rows = self.get_rows()
+        expected = Booking.objects.exclude(status=Booking.COMPLETED).order_by(
+            '-date', '-id')
+        self.assertEqual([row['id'] for row in rows],
+                         [booking.id for booking in expected])
+        self.assertEqual(rows[0]['title'], expected[0].title)
+        self.assertEqual(rows[0]['customer'], expected[0].customer.username)
+        self.assertEqual(rows[0]['price'], '10.00')
+
+    @override_settings(BOOKING_API_CHUNK_SIZE=2)
+    def test_own_bookings_and_status_filter(self):
+        rows = self.get_rows(scope='own')
+        self.assertEqual(len(rows), 3)
+        self.assertTrue(all(row['customer'] == 'john' for row in rows))
+
+        rows = self.get_rows(scope='own', status=Booking.COMPLETED)
+        self.assertEqual([row['status'] for row in rows], [Booking.COMPLETED])
+
+    def test_json_format(self):
+        response = self.client.get(reverse('booking-api'), {'format': 'json'})
+        rows = json.loads(''.join(response.streaming_content))
+        self.assertEqual(len(rows), 6)
+
+    def test_invalid_parameters(self):
+        response = self.client.get(reverse('booking-api'), {'status': 'foo'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(reverse('booking-api'), {'scope': 'foo'})
+        self.assertEqual(response.status_code, 400)
+
+
+class BookingSearchTestCase(BookingTestCase):
 
-            # Взятие заказа на исполнение
-            response = self.client.post(reverse('serve-booking'),
-                                        {'booking': booking.id}, follow=True)
-            self.assertEqual(response.status_code, 200)
-            self.assertTemplateUsed(response, 'booking/booking_list.html')
+    def setUp(self):
+        user = User.objects.create_user(
+            'john', 'lennon@thebeatles.com', 'johnpassword')
+        UserProfile.objects.create(user=user, cash=Decimal('1000.00'))
+        customers, is_created = Group.objects.get_or_create(name="customers")
+        user.groups.add(customers)
+        self.in_title = Booking.objects.create(
+            title=u"Ремонт квартиры", text=u"Покраска стен", price=10,
+            customer=user)
+        self.in_text = Booking.objects.create(
+            title=u"Квартира", text=u"Нужен косметический ремонт", price=10,
+            customer=user)
+        self.other = Booking.objects.create(
+            title=u"Доставка", text=u"Перевезти мебель", price=10,
+            customer=user)
+        self.client.login(username='john', password='johnpassword')
+
+    def search(self, query, **params):
+        params['q'] = query
+        response = self.client.get(reverse('booking-list'), params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_ranked_results(self):
+        # Поиск учитывает словоформы, совпадение в заголовке выше
+        response = self.search(u"ремонта")
+        found = [o.pk for o in response.context['page_obj'].object_list]
+        self.assertEqual(found, [self.in_title.pk, self.in_text.pk])
+
+    def test_completed_bookings_are_not_found(self):
+        self.in_title.set_status(Booking.COMPLETED)
+        response = self.search(u"ремонт")
+        found = [o.pk for o in response.context['page_obj'].object_list]
+        self.assertEqual(found, [self.in_text.pk])
+
+    def test_search_vector_follows_text(self):
+        self.other.text = u"Ремонт после переезда"
+        self.other.save()
+        response = self.search(u"ремонт")
+        self.assertEqual(len(response.context['page_obj'].object_list), 3)
+        response = self.search(u"мебель")
+        self.assertContains(response, u"заказов не найдено")
+
+    def test_keyset_pages_of_results(self):
+        user = self.in_title.customer
+        for i in range(25):
+            Booking.objects.create(
+                title="".join(['title', str(i)]),
+                text=u"ремонт " * (i % 3 + 1), price=10, customer=user)
+        forward = []
+        response = self.search(u"ремонт")
+        page = response.context['page_obj']
+        forward.extend(o.pk for o in page.object_list)
+        self.assertContains(response, u"?q=%D1%80%D0%B5%D0%BC%D0%BE%D0%BD%D1%82&amp;after=")
+        while page.has_next():
+            response = self.search(u"ремонт", after=page.next_cursor)
+            page = response.context['page_obj']
+            forward.extend(o.pk for o in page.object_list)
+        backward = [o.pk for o in page.object_list]
+        while page.has_previous():
+            response = self.search(u"ремонт", before=page.previous_cursor)
+            page = response.context['page_obj']
+            backward = [o.pk for o in page.object_list] + backward
+
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT id FROM booking_booking WHERE search_vector @@ "
+            "plainto_tsquery('russian', %s) ORDER BY ts_rank(search_vector, "
+            "plainto_tsquery('russian', %s)) DESC, id DESC",
+            [u"ремонт", u"ремонт"])
+        expected = [row[0] for row in cursor.fetchall()]
+        self.assertEqual(len(expected), 27)
+        self.assertEqual(forward, expected)
+        self.assertEqual(backward, expected)
+
+    def test_gin_index(self):
+        cursor = connection.cursor()
+        cursor.execute("SET LOCAL enable_seqscan = off")
+        cursor.execute(
+            "EXPLAIN SELECT id FROM booking_booking WHERE search_vector @@ "
+            "plainto_tsquery('russian', %s)", [u"ремонт"])
+        plan = "\n".join(row[0] for row in cursor.fetchall())
+        self.assertIn('booking_booking_search_vector', plan)
+
+
+class BookingIndexesTestCase(BookingTestCase):
+
+    # Число заказов и пользователей тестовой базы
+    BOOKINGS = 30000
+    USERS = 300
 
-            # Ждет подтверждения взятия на исполнение
-            booking = Booking.objects.all()[i]
-            self.assertEqual(booking.possible_performers.all()[0], user2)
-            self.assertEqual(booking.get_status(), Booking.WAITING_FOR_APPROVAL)
+    def setUp(self):
+        """
+        Большая база заказов: 90% заказов завершены, заказы распределены
+        между USERS заказчиками и исполнителями.
+        """
+        self.user = User.objects.create_user(
+            'john', 'lennon@thebeatles.com', 'johnpassword')
+        customers, is_created = Group.objects.get_or_create(name="customers")
+        self.user.groups.add(customers)
+        User.objects.bulk_create([
+            User(username='user%s' % i) for i in range(self.USERS - 1)])
+        user_ids = list(User.objects.values_list('id', flat=True))
+        cursor = connection.cursor()
+        cursor.execute("""
+            INSERT INTO booking_booking (title, text, price, status,
+                customer_id, performer_id, date, version)
+            SELECT 'title ' || i, 'text ' || i, 10,
+                   CASE WHEN i %% 10 = 0 THEN 'pending' ELSE 'completed' END,
+                   (%s::int[])[1 + i %% %s], (%s::int[])[1 + (i * 7) %% %s],
+                   now() - i * interval '1 minute', 0
+            FROM generate_series(1, %s) i
+        """, [user_ids, self.USERS, user_ids, self.USERS, self.BOOKINGS])
+        cursor.execute("ANALYZE booking_booking")
+        self.client.login(username='john', password='johnpassword')
+
+    def explain(self, sql, params=()):
+        cursor = connection.cursor()
+        cursor.execute("EXPLAIN " + sql, params)
+        return "\n".join(row[0] for row in cursor.fetchall())
+
+    def test_feed_uses_date_index(self):
+        """
+        Лента незавершенных заказов (booking-list) читается по индексу
+        ленты (date, booking_id), а не перебором таблицы
+        """
+        feed.rebuild()
+        connection.cursor().execute("ANALYZE booking_feedentry")
+        page = self.assertFeedPlan({})
+        self.assertFeedPlan({'after': page.next_cursor})
 
-            # Выход
-            response = self.client.post('/accounts/logout/', follow=True)
-            self.assertEqual(response.status_code, 200)
-            self.assertTemplateUsed(response, 'registration/logged_out.html')
+    def test_feed_rebuild_uses_open_index(self):
+        """
+        Перестроение ленты выбирает незавершенные заказы по частичному
+        индексу, а не перебором всех заказов
+        """
+        plan = self.explain(feed.REBUILD_SQL)
+        self.assertIn('booking_booking_open_date', plan)
+        self.assertNotIn('Seq Scan on booking_booking', plan)
+
+    def assertFeedPlan(self, parameters):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('booking-list'), parameters)
+        self.assertEqual(response.status_code, 200)
+        sql = [query['sql'] for query in queries.captured_queries
+               if query['sql'].startswith('SELECT') and
+               'FROM "booking_feedentry"' in query['sql']]
+        self.assertEqual(len(sql), 1)
+        plan = self.explain(sql[0])
+        self.assertIn('Index Scan Backward using booking_feedentry_date_',
+                      plan)
+        self.assertNotIn('Seq Scan on booking_feedentry', plan)
+        return response.context['page_obj']
+
+    def test_own_bookings_use_composite_indexes(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('own-booking-list'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['page_obj'].object_list), 20)
+        sql = [query['sql'] for query in queries.captured_queries
+               if ' UNION ' in query['sql']]
+        self.assertEqual(len(sql), 1)
+        plan = self.explain(sql[0])
+        self.assertIn('booking_booking_customer_date', plan)
+        self.assertIn('booking_booking_performer_date', plan)
+        self.assertNotIn('Seq Scan on booking_booking', plan)
+
+        # Следующая страница - те же индексы с условием по ключу
+        cursor = response.context['page_obj'].next_cursor
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('own-booking-list'),
+                                       {'after': cursor})
+        sql = [query['sql'] for query in queries.captured_queries
+               if ' UNION ' in query['sql']]
+        plan = self.explain(sql[0])
+        self.assertIn('booking_booking_customer_date', plan)
+        self.assertIn('booking_booking_performer_date', plan)
+
+
+class BookingCountersTestCase(BookingTestCase):
 
-            # Вход из-под заказчика
-            response = self.client.post('/accounts/login/',
-                {'username': "".join(['_test_customer', str(i)]),
-                 'password': 'test_password'}, follow=True)
-            self.assertEqual(response.status_code, 200)
-            self.assertTemplateUsed(response, 'booking/booking_list.html')
+    def setUp(self):
+        self.customer = User.objects.create_user(
+            'john', 'lennon@thebeatles.com', 'johnpassword')
+        self.performer = User.objects.create_user(
+            'paul', 'paul@thebeatles.com', 'paulpassword')
+        customers, is_created = Group.objects.get_or_create(name="customers")
+        self.customer.groups.add(customers)
+        UserProfile.objects.create(user=self.customer, cash=Decimal('1000.00'))
+        for i in range(5):
+            Booking.objects.create(
+                title="".join(['title', str(i)]), text='text', price=10,
+                customer=self.customer)
+        self.client.login(username='john', password='johnpassword')
+        # Пересчеты affordable, отложенные при подготовке данных (см.
+        # escrow.py)
+        escrow.flush()
+
+    def counts(self):
+        """
+        Ненулевые счетчики, части счетчиков статусов сложены
+        """
+        counts = defaultdict(int)
+        for name, value in BookingCounter.objects.values_list('name', 'value'):
+            if counters.is_striped(name):
+                name = name.rsplit(':', 1)[0]
+            counts[name] += value
+        return dict((name, value) for name, value in counts.items() if value)
+
+    def test_counters_follow_bookings(self):
+        booking = Booking.objects.order_by('id')[0]
+        booking.set_performer(self.performer)
+        booking.set_status(Booking.RUNNING)
+        Booking.objects.order_by('id')[1].delete()
+        incremental = self.counts()
+        self.assertEqual(incremental, {
+            'status:pending': 3,
+            'status:running': 1,
+            'customer:%s' % self.customer.pk: 4,
+            'performer:%s' % self.performer.pk: 1,
+        })
+        counters.rebuild()
+        self.assertEqual(self.counts(), incremental)
+
+    def pages(self, view, paginator_class, url, **params):
+        """
+        Проход по страницам списка по номерам. Возвращает id заказов и число
+        запросов COUNT.
+        """
+        found, counts, number = [], 0, 1
+        saved = dict((name, view.__dict__[name]) for name in (
+            'paginator_class', 'paginate_by'))
+        view.keyset_pagination = False
+        view.paginator_class = paginator_class
+        view.paginate_by = 2
+        try:
+            while True:
+                params['page'] = number
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.client.get(url, params)
+                self.assertEqual(response.status_code, 200)
+                counts += len([q for q in queries.captured_queries
+                               if 'COUNT(' in q['sql']])
+                page = response.context['page_obj']
+                found.extend(o.pk for o in page.object_list)
+                if not page.has_next():
+                    self.assertEqual(page.paginator.num_pages, number)
+                    return found, counts
+                number += 1
+        finally:
+            del view.keyset_pagination
+            for name, value in saved.items():
+                setattr(view, name, value)
+
+    def test_counter_paginator(self):
+        expected = list(Booking.objects.order_by('-date', '-id').values_list(
+            'id', flat=True))
+        found, counts = self.pages(BookingListView, BookingListView.paginator_class,
+                                   reverse('booking-list'))
+        self.assertEqual(found, expected)
+        self.assertEqual(counts, 0)
+        found, counts = self.pages(OwnBookingListView,
+                                   OwnBookingListView.paginator_class,
+                                   reverse('own-booking-list'))
+        self.assertEqual(found, expected)
+        self.assertEqual(counts, 0)
+
+    def test_stale_counters_do_not_lose_rows(self):
+        BookingCounter.objects.all().update(value=1)
+        found, counts = self.pages(BookingListView, BookingListView.paginator_class,
+                                   reverse('booking-list'))
+        self.assertEqual(len(found), 5)
+
+    def test_cached_count_paginator(self):
+        cache.clear()
+        found, counts = self.pages(BookingListView, CachedCountPaginator,
+                                   reverse('booking-list'))
+        self.assertEqual(len(found), 5)
+        self.assertEqual(counts, 1)
+
+    def test_estimated_count_paginator(self):
+        connection.cursor().execute("ANALYZE booking_booking")
+        queryset = Booking.objects.filter(customer=self.customer)
+        paginator = EstimatedCountPaginator(queryset, 2)
+        paginator.exact_threshold = 0
+        self.assertTrue(paginator.count > 0)
+        found, counts = self.pages(OwnBookingListView, EstimatedCountPaginator,
+                                   reverse('own-booking-list'))
+        self.assertEqual(len(found), 5)
+
+
+class TransitionsTestCase(BookingTestCase):
 
-            user = User.objects.get(username="".join(['_test_customer', str(i)]))
+    def setUp(self):
+        self.customer = User.objects.create_user(
+            'john', 'lennon@thebeatles.com', 'johnpassword')
+        self.performer = User.objects.create_user(
+            'paul', 'paul@thebeatles.com', 'paulpassword')
+        UserProfile.objects.create(user=self.customer, cash=Decimal('100.00'))
+        UserProfile.objects.create(user=self.performer, cash=Decimal('0.00'))
+        SystemAccount.objects.create()
+        self.booking = Booking.objects.create(
+            title='title', text='text', price=Decimal('50.00'),
+            customer=self.customer)
+
+    def test_transitions(self):
+        transitions.serve(self.booking.pk, self.performer)
+        self.assertEqual(FeedEntry.objects.get(pk=self.booking.pk).status,
+                         Booking.WAITING_FOR_APPROVAL)
+        transitions.approve(self.booking.pk, self.customer, self.performer.pk)
+        booking = Booking.objects.get(pk=self.booking.pk)
+        self.assertEqual(booking.status, Booking.RUNNING)
+        self.assertEqual(booking.performer, self.performer)
+        self.assertEqual(booking.version, self.booking.version + 2)
+        self.assertEqual(UserProfile.objects.get(user=self.customer).cash,
+                         Decimal('50.00'))
+        self.assertEqual(FeedEntry.objects.get(pk=self.booking.pk).status,
+                         Booking.RUNNING)
+        self.assertEqual(counters.get_total(['status:running']), 1)
+        self.assertEqual(counters.get_total(
+            ['performer:%s' % self.performer.pk]), 1)
+
+        transitions.complete(self.booking.pk, self.customer)
+        self.assertEqual(Booking.objects.get(pk=self.booking.pk).status,
+                         Booking.COMPLETED)
+        self.assertFalse(FeedEntry.objects.filter(pk=self.booking.pk).exists())
+        self.assertEqual(UserProfile.objects.get(user=self.performer).cash,
+                         Decimal('48.50'))
+        self.assertEqual(SystemAccount.objects.get().get_balance(), Decimal('1.50'))
+
+    def test_model_complete(self):
+        """
+        Booking.complete() завершает заказ переходом complete: деньги
+        переведены, объект заказа и счетчики соответствуют базе
+        """
+        transitions.serve(self.booking.pk, self.performer)
+        transitions.approve(self.booking.pk, self.customer, self.performer.pk)
+        booking = Booking.objects.get(pk=self.booking.pk)
+        self.assertEqual(booking.complete(),
+                         (Decimal('1.50'), Decimal('48.50')))
+        self.assertEqual(booking.get_status(), Booking.COMPLETED)
+        self.assertEqual(booking.version, self.booking.version + 3)
+        self.assertEqual(UserProfile.objects.get(user=self.performer).cash,
+                         Decimal('48.50'))
+        self.assertEqual(ledger.verify(), [])
+        # Повторное сохранение объекта не меняет счетчики
+        booking.save()
+        self.assertEqual(counters.get_total(['status:running']), 0)
+        self.assertEqual(counters.get_total(['status:completed']), 1)
+
+    def test_stale_status_is_rejected(self):
+        transitions.serve(self.booking.pk, self.performer)
+        # Статус изменен параллельным запросом после чтения заказа
+        stale = Booking.objects.get(pk=self.booking.pk)
+        Booking.objects.filter(pk=self.booking.pk).update(
+            status=Booking.PENDING)
+        self.assertRaises(TransitionError, transitions.update_status, stale,
+                          (Booking.WAITING_FOR_APPROVAL,), Booking.RUNNING)
+        self.assertEqual(Booking.objects.get(pk=self.booking.pk).status,
+                         Booking.PENDING)
+
+    def test_approve_checks(self):
+        self.assertRaises(TransitionError, transitions.approve,
+                          self.booking.pk, self.customer, self.performer.pk)
+        transitions.serve(self.booking.pk, self.performer)
+        self.assertRaises(TransitionError, transitions.serve,
+                          self.booking.pk, self.performer)
+        self.assertRaises(TransitionError, transitions.approve,
+                          self.booking.pk, self.performer, self.performer.pk)
+        self.assertRaises(TransitionError, transitions.approve,
+                          self.booking.pk, self.customer, self.customer.pk)
+        self.assertRaises(TransitionError, transitions.approve,
+                          self.booking.pk, self.customer, 'x')
+
+    def test_transition_queries(self):
+        def booking_queries(queries):
+            return [query['sql'] for query in queries.captured_queries
+                    if re.search(r'\bbooking_booking\b', query['sql'])]
+
+        # Заказ не читается отдельно: блокировка, проверки и новые значения
+        # заказа - один условный запрос, счет заказчика при взятии заказа
+        # проверяется тем же запросом
+        with CaptureQueriesContext(connection) as queries:
+            transitions.serve(self.booking.pk, self.performer)
+        statements = booking_queries(queries)
+        self.assertEqual(len(statements), 1)
+        self.assertIn('booking_userprofile', statements[0])
+        self.assertFalse([query for query in queries.captured_queries
+                          if 'booking_userprofile' in query['sql']
+                          and query['sql'] not in statements])
+        # Имя исполнителя возвращается запросом перехода
+        with CaptureQueriesContext(connection) as queries:
+            transitions.approve(self.booking.pk, self.customer,
+                                self.performer.pk)
+        self.assertEqual(len(booking_queries(queries)), 1)
+        self.assertFalse([query for query in queries.captured_queries
+                          if 'FROM "auth_user"' in query['sql']])
+        # Деньги переводятся вторым запросом
+        with CaptureQueriesContext(connection) as queries:
+            transitions.complete(self.booking.pk, self.customer)
+        self.assertEqual(len(booking_queries(queries)), 1)
+        self.assertEqual(len([query for query in queries.captured_queries
+                              if 'booking_userprofile' in query['sql']]), 1)
+        self.assertFalse([query for query in queries.captured_queries
+                          if 'FROM "auth_user"' in query['sql']])
+
+    def test_serve_without_funds(self):
+        UserProfile.objects.filter(user=self.customer).update(
+            cash=Decimal('10.00'))
+        Booking.objects.filter(pk=self.booking.pk).update(affordable=False)
+        with self.assertRaises(TransitionError) as error:
+            transitions.serve(self.booking.pk, self.performer)
+        self.assertEqual(error.exception.message, u"Недостаточно средств")
+        UserProfile.objects.filter(user=self.customer).delete()
+        with self.assertRaises(TransitionError) as error:
+            transitions.serve(self.booking.pk, self.performer)
+        self.assertEqual(error.exception.message,
+                         u"У создателя заказа нет расширенного профиля")
+
+
+class SystemAccountStripesTestCase(BookingTestCase):
+
+    def test_large_balance(self):
+        # Комиссии копятся годами: остаток не ограничен 9999.99
+        system_account = SystemAccount.objects.create()
+        for i in range(3):
+            system_account.add_to_stripe(Decimal('6000.00'))
+        self.assertEqual(system_account.compact(), Decimal('18000.00'))
+        self.assertEqual(SystemAccount.objects.get().account,
+                         Decimal('18000.00'))
+
+    def test_stripes_and_compaction(self):
+        system_account = SystemAccount.objects.create()
+        for i in range(40):
+            system_account.add_to_stripe(Decimal('1.25'))
+        self.assertEqual(system_account.account, Decimal('0.00'))
+        self.assertTrue(system_account.stripes.count() <= SystemAccount.STRIPES)
+        self.assertEqual(system_account.get_balance(), Decimal('50.00'))
+
+        call_command('compact_system_account', stdout=StringIO())
+        system_account = SystemAccount.objects.get()
+        self.assertEqual(system_account.account, Decimal('50.00'))
+        self.assertEqual(system_account.get_balance(), Decimal('50.00'))
+        self.assertFalse(system_account.stripes.exclude(amount=0).exists())
+
+        system_account.add_to_stripe(Decimal('0.50'))
+        self.assertEqual(system_account.get_balance(), Decimal('50.50'))
+        self.assertEqual(system_account.compact(), Decimal('0.50'))
+        self.assertEqual(system_account.account, Decimal('50.50'))
+
+
+class AtomicCashTestCase(BookingTestCase):
 
-            # Подтверждение исполнителем взятия заказа заказчиком
-            performer_id = booking.possible_performers.all()[0].id
+    def setUp(self):
+        self.customer = User.objects.create_user(
+            'john', 'lennon@thebeatles.com', 'johnpassword')
+        self.profile = UserProfile.objects.create(user=self.customer,
+                                                  cash=Decimal('20.00'))
+        self.booking = Booking.objects.create(
+            title='title', text='text', price=Decimal('15.00'),
+            customer=self.customer)
+
+    def test_change_cash(self):
+        # Профиль не читается: изменение и запись журнала - один запрос
+        # (WITH ... UPDATE ... RETURNING, INSERT). Признак "хватает средств"
+        # пересчитывается после транзакции.
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.profile.decrease_cash(Decimal('15.00')),
+                             Decimal('5.00'))
+        self.assertEqual([query['sql'].split()[0]
+                          for query in queries.captured_queries],
+                         ['WITH'])
+        self.assertEqual(list(LedgerEntry.objects.filter(
+            user=self.customer).order_by('id').values_list('kind', 'amount')),
+            [(LedgerEntry.OPENING, Decimal('20.00')),
+             (LedgerEntry.ADJUSTMENT, Decimal('-15.00'))])
+        self.assertEqual(self.profile.cash, Decimal('5.00'))
+        self.assertTrue(Booking.objects.get(pk=self.booking.pk).affordable)
+        escrow.flush()
+        self.assertFalse(FeedEntry.objects.get(
+            pk=self.booking.pk).customer_can_afford)
+
+        # Средств не хватает - сумма на счету не меняется
+        self.assertEqual(self.profile.decrease_cash(Decimal('5.01')), None)
+        self.assertEqual(UserProfile.objects.get(pk=self.profile.pk).cash,
+                         Decimal('5.00'))
+        self.assertEqual(UserProfile.post_cash(
+            self.customer.pk, Decimal('-6.00'), LedgerEntry.ADJUSTMENT), None)
+        self.assertEqual(UserProfile.change_cash(0, Decimal('1.00')), None)
+
+        self.assertEqual(self.profile.increase_cash(Decimal('10.00')),
+                         Decimal('15.00'))
+        escrow.flush()
+        self.assertTrue(FeedEntry.objects.get(
+            pk=self.booking.pk).customer_can_afford)
+        # Изменения записаны в журнал операций
+        self.assertEqual(list(LedgerEntry.objects.filter(
+            kind=LedgerEntry.ADJUSTMENT).order_by('id').values_list(
+            'amount', flat=True)), [Decimal('-15.00'), Decimal('10.00')])
+        self.assertEqual(ledger.verify(), [])
+
+    def test_post_and_transfer(self):
+        self.assertEqual(self.profile.post(Decimal('-20.00'),
+                                           LedgerEntry.ADJUSTMENT),
+                         Decimal('0.00'))
+        self.assertEqual(ledger.verify(), [])
+        system_account = SystemAccount.objects.create()
+        self.assertEqual(system_account.transfer_cash(Decimal('2.50')),
+                         Decimal('2.50'))
+        self.assertEqual(SystemAccount.objects.get().account, Decimal('2.50'))
+        self.assertEqual(ledger.verify(), [])
+
+
+class EscrowTestCase(BookingTestCase):
 
-            response = self.client.post(reverse('approve-booking'),
-                {'booking': booking.id, 'possible_performer': performer_id}, follow=True)
-            self.assertEqual(response.status_code, 200)
-            self.assertTemplateUsed(response, 'booking/booking_list.html')
+    def setUp(self):
+        self.customer = User.objects.create_user(
+            'john', 'lennon@thebeatles.com', 'johnpassword')
+        self.performer = User.objects.create_user(
+            'paul', 'paul@thebeatles.com', 'paulpassword')
+        self.customer.user_permissions.add(
+            Permission.objects.get(codename='add_booking'))
+        UserProfile.objects.create(user=self.customer, cash=Decimal('100.00'))
+        UserProfile.objects.create(user=self.performer, cash=Decimal('0.00'))
+        SystemAccount.objects.create()
+        self.first = Booking.objects.create(
+            title='first', text='text', price=Decimal('60.00'),
+            customer=self.customer)
+        self.second = Booking.objects.create(
+            title='second', text='text', price=Decimal('60.00'),
+            customer=self.customer)
 
-            # Взят на исполнение
+    def affordable(self):
+        return dict(Booking.objects.values_list('title', 'affordable'))
 
-            booking = Booking.objects.all()[i]
-            self.assertEqual(booking.get_status(), Booking.RUNNING)
-            self.assertEqual(user1.profile.cash + booking.price, user1_cash_before)
+    def test_serve_checks_current_cash(self):
+        """
+        Взятие заказа проверяет сумму на счету, а не признак affordable,
+        пересчет которого отложен до конца транзакции
+        """
+        transitions.serve(self.first.pk, self.performer)
+        transitions.approve(self.first.pk, self.customer, self.performer.pk)
+        self.assertTrue(Booking.objects.get(pk=self.second.pk).affordable)
+        with self.assertRaises(TransitionError) as error:
+            transitions.serve(self.second.pk, self.performer)
+        self.assertEqual(error.exception.message, u"Недостаточно средств")
+        self.assertEqual(Booking.objects.get(pk=self.second.pk).status,
+                         Booking.PENDING)
+
+    def test_hold_and_release(self):
+        self.assertEqual(self.affordable(), {'first': True, 'second': True})
+        transitions.serve(self.first.pk, self.performer)
+        transitions.approve(self.first.pk, self.customer, self.performer.pk)
+        escrow.flush()
+        profile = UserProfile.objects.get(user=self.customer)
+        self.assertEqual((profile.cash, profile.held),
+                         (Decimal('40.00'), Decimal('60.00')))
+        self.assertEqual(EscrowHold.objects.get().booking_id, self.first.pk)
+        # Оставшихся средств на второй заказ не хватает
+        self.assertEqual(self.affordable()['second'], False)
+        self.assertFalse(FeedEntry.objects.get(
+            pk=self.second.pk).customer_can_afford)
+
+        transitions.complete(self.first.pk, self.customer)
+        profile = UserProfile.objects.get(user=self.customer)
+        self.assertEqual((profile.cash, profile.held),
+                         (Decimal('40.00'), Decimal('0.00')))
+        self.assertFalse(EscrowHold.objects.exists())
+        self.assertEqual(ledger.verify(), [])
+
+        UserProfile.objects.get(user=self.customer).increase_cash(
+            Decimal('20.00'))
+        escrow.flush()
+        self.assertEqual(self.affordable()['second'], True)
+
+    def test_complete_many_releases_holds(self):
+        for booking in (self.first, self.second):
+            transitions.serve(booking.pk, self.performer)
+        transitions.approve(self.first.pk, self.customer, self.performer.pk)
+        self.assertRaises(TransitionError, transitions.approve,
+                          self.second.pk, self.customer, self.performer.pk)
+        transitions.complete_many([self.first.pk], self.customer)
+        self.assertEqual(UserProfile.objects.get(user=self.customer).held,
+                         Decimal('0.00'))
+        self.assertFalse(EscrowHold.objects.exists())
+
+    def test_own_list_does_not_read_profiles(self):
+        escrow.flush()
+        self.client.login(username='john', password='johnpassword')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('own-booking-list'))
+        self.assertEqual(response.status_code, 200)
+        # Только остаток самого пользователя в шапке страницы
+        self.assertEqual(len([query for query in queries.captured_queries
+                              if 'booking_userprofile' in query['sql']]), 1)
+
+
+class IdempotencyTestCase(BookingTestCase):
 
-            # Закрытие заказа
-            response = self.client.post(reverse('complete-booking'),
-                                        {'booking': booking.id}, follow=True)
-            self.assertEqual(response.status_code, 200)
-            self.assertTemplateUsed(response, 'booking/booking_list.html')
-
-            # Завершен
-            user2 = User.objects.get(username="".join(['test_performer', str(i)]))
-            booking = Booking.objects.all()[i]
-            self.assertEqual(booking.get_status(), Booking.COMPLETED)
-            system_account = SystemAccount.objects.all()[0]
-            comission = system_account.get_comission()
-            self.assertEqual(system_account.account, booking.price * comission * (i+1))
-            self.assertEqual(user2.profile.cash, booking.price * (1 - comission))
-
-            # Выход
-            response = self.client.post('/accounts/logout/', follow=True)
-            self.assertEqual(response.status_code, 200)
-            self.assertTemplateUsed(response, 'registration/logged_out.html')
+    def setUp(self):
+        self.customer = User.objects.create_user(
+            'john', 'lennon@thebeatles.com', 'johnpassword')
+        self.performer = User.objects.create_user(
+            'paul', 'paul@thebeatles.com', 'paulpassword')
+        self.customer.user_permissions.add(
+            Permission.objects.get(codename='add_booking'))
+        self.performer.user_permissions.add(
+            Permission.objects.get(codename='perform_perm'))
+        UserProfile.objects.create(user=self.customer, cash=Decimal('100.00'))
+        UserProfile.objects.create(user=self.performer, cash=Decimal('0.00'))
+        SystemAccount.objects.create()
+        self.booking = Booking.objects.create(
+            title='title', text='text', price=Decimal('50.00'),
+            customer=self.customer)
+        # Пересчеты affordable, отложенные при подготовке данных (см.
+        # escrow.py)
+        escrow.flush()
+
+    def post(self, url, data, key):
+        return self.client.post(url, data, HTTP_IDEMPOTENCY_KEY=key,
+                                HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+    def test_duplicate_is_replayed(self):
+        self.client.login(username='paul', password='paulpassword')
+        first = self.post(reverse('serve-booking'), {'id': self.booking.pk},
+                          'key-1')
+        with CaptureQueriesContext(connection) as queries:
+            second = self.post(reverse('serve-booking'),
+                               {'id': self.booking.pk}, 'key-1')
+        # Только запросы сессии, прав пользователя и ключа
+        self.assertFalse(any('booking_' in query['sql']
+                             for query in queries.captured_queries
+                             if 'booking_idempotencykey' not in query['sql']))
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second['Idempotent-Replay'], 'true')
+        self.assertEqual(self.booking.possible_performers.count(), 1)
+
+        # Другой ключ - новый запрос
+        third = self.post(reverse('serve-booking'), {'id': self.booking.pk},
+                          'key-2')
+        self.assertEqual(json.loads(third.content)['request_status'],
+                         u"Вы уже подавали заявку на этот заказ")
+
+    def test_keys_are_per_user(self):
+        transitions.serve(self.booking.pk, self.performer)
+        transitions.approve(self.booking.pk, self.customer, self.performer.pk)
+        self.client.login(username='paul', password='paulpassword')
+        self.post(reverse('serve-booking'), {'id': self.booking.pk}, 'key')
+        self.client.login(username='john', password='johnpassword')
+        with override_settings(BOOKING_SETTLEMENT_ASYNC=False):
+            response = self.post(reverse('complete-booking'),
+                                 {'id': self.booking.pk}, 'key')
+            self.post(reverse('complete-booking'), {'id': self.booking.pk},
+                      'key')
+        self.assertFalse(response.has_header('Idempotent-Replay'))
+        self.assertEqual(UserProfile.objects.get(user=self.performer).cash,
+                         Decimal('48.50'))
+        self.assertEqual(LedgerEntry.objects.filter(
+            kind=LedgerEntry.PAYOUT).count(), 1)
+
+    def in_progress(self, expires):
+        IdempotencyKey.objects.create(key=idempotency.get_stored_key(
+            'booking.views.serve_booking_view', self.performer.pk, 'key'),
+            expires=expires)
+
+    def test_request_in_progress(self):
+        self.client.login(username='paul', password='paulpassword')
+        self.in_progress(timezone.now() + timedelta(seconds=30))
+        response = self.post(reverse('serve-booking'),
+                             {'id': self.booking.pk}, 'key')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.booking.possible_performers.count(), 0)
+
+    # Занятие истекшего ключа - лишний запрос UPDATE сверх бюджета
+    @override_settings(BOOKING_QUERY_BUDGET_STRICT=False)
+    def test_abandoned_request(self):
+        """
+        Отметка запроса прерванного процесса истекает быстро
+        """
+        self.client.login(username='paul', password='paulpassword')
+        self.in_progress(timezone.now() - timedelta(seconds=1))
+        response = self.post(reverse('serve-booking'),
+                             {'id': self.booking.pk}, 'key')
+        self.assertTrue(json.loads(response.content)['success'])
+        self.assertEqual(self.booking.possible_performers.count(), 1)
+        self.assertEqual(idempotency.purge(), 0)
+        IdempotencyKey.objects.update(expires=timezone.now())
+        self.assertEqual(idempotency.purge(), 1)
+
+    def test_refusal_is_not_stored(self):
+        """
+        Отказ не сохраняется: повтор с тем же ключом после пополнения счета
+        выполняется заново
+        """
+        transitions.serve(self.booking.pk, self.performer)
+        UserProfile.objects.filter(user=self.customer).update(cash=10)
+        self.client.login(username='john', password='johnpassword')
+        data = {'booking_id': self.booking.pk,
+                'possible_performer': self.performer.pk}
+        first = self.post(reverse('approve-booking'), data, 'key')
+        self.assertEqual(json.loads(first.content)['request_status'],
+                         u"Недостаточно средств")
+        self.assertFalse(IdempotencyKey.objects.exists())
+        UserProfile.objects.filter(user=self.customer).update(cash=100)
+        second = self.post(reverse('approve-booking'), data, 'key')
+        self.assertFalse(second.has_header('Idempotent-Replay'))
+        self.assertTrue(json.loads(second.content)['success'])
+        self.assertEqual(Booking.objects.get(pk=self.booking.pk).status,
+                         Booking.RUNNING)
+
+
+class LedgerTestCase(BookingTestCase):
+
+    def setUp(self):
+        self.customer = User.objects.create_user(
+            'john', 'lennon@thebeatles.com', 'johnpassword')
+        self.performer = User.objects.create_user(
+            'paul', 'paul@thebeatles.com', 'paulpassword')
+        UserProfile.objects.create(user=self.customer, cash=Decimal('100.00'))
+        UserProfile.objects.create(user=self.performer, cash=Decimal('0.00'))
+        SystemAccount.objects.create()
+        self.booking = Booking.objects.create(
+            title='title', text='text', price=Decimal('50.00'),
+            customer=self.customer)
+        transitions.serve(self.booking.pk, self.performer)
+        transitions.approve(self.booking.pk, self.customer, self.performer.pk)
+        transitions.complete(self.booking.pk, self.customer)
+
+    def test_entries(self):
+        entries = LedgerEntry.objects.order_by('id').values_list(
+            'user_id', 'kind', 'amount', 'booking_id')
+        self.assertEqual(list(entries), [
+            (self.customer.pk, LedgerEntry.OPENING, Decimal('100.00'), None),
+            (self.customer.pk, LedgerEntry.HOLD, Decimal('-50.00'),
+             self.booking.pk),
+            (self.performer.pk, LedgerEntry.PAYOUT, Decimal('48.50'),
+             self.booking.pk),
+            (None, LedgerEntry.COMMISSION, Decimal('1.50'), self.booking.pk),
+        ])
+        self.assertEqual(ledger.get_balance(self.customer.pk),
+                         Decimal('50.00'))
+        self.assertEqual(ledger.get_balance(self.performer.pk),
+                         Decimal('48.50'))
+        self.assertEqual(ledger.get_balance(), Decimal('1.50'))
+        self.assertEqual(ledger.verify(), [])
+
+    def test_snapshots(self):
+        self.assertEqual(ledger.take_snapshots(lag=0), 3)
+        # Новых операций нет - новых снимков тоже
+        self.assertEqual(ledger.take_snapshots(lag=0), 0)
+        # Операции моложе задержки в снимок не входят
+        self.assertEqual(ledger.take_snapshots(lag=60), 0)
+        LedgerEntry.objects.all().update(amount=0)
+        self.assertEqual(ledger.get_balance(self.customer.pk),
+                         Decimal('50.00'))
+        self.assertEqual(ledger.get_balance(), Decimal('1.50'))
+
+        profile = UserProfile.objects.select_for_update().get(
+            user=self.customer)
+        profile.post(Decimal('10.00'), LedgerEntry.ADJUSTMENT)
+        self.assertEqual(ledger.get_balance(self.customer.pk),
+                         Decimal('60.00'))
+        self.assertEqual(ledger.take_snapshots(lag=0), 1)
+        self.assertEqual(BalanceSnapshot.objects.filter(
+            user=self.customer).order_by('-last_entry_id')[0].balance,
+            Decimal('60.00'))
+
+    def test_verify_and_refresh(self):
+        UserProfile.objects.filter(user=self.performer).update(cash=0)
+        self.assertEqual(ledger.verify(), [
+            (self.performer.pk, Decimal('0.00'), Decimal('48.50'))])
+        self.assertEqual(ledger.refresh_cached_balance(self.performer.pk),
+                         Decimal('48.50'))
+        self.assertEqual(ledger.verify(), [])
+
+        # Сумма на счету системы, измененная в обход проводок
+        SystemAccount.objects.update(account=Decimal('5.00'))
+        self.assertEqual(ledger.verify(), [
+            (None, Decimal('6.50'), Decimal('1.50'))])
+
+    def test_system_account_is_read_only_in_admin(self):
+        User.objects.create_superuser('admin', 'admin@test.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        system_account = SystemAccount.objects.get()
+        url = reverse('admin:booking_systemaccount_change',
+                      args=[system_account.pk])
+        response = self.client.post(url, {'account': '1000.00',
+                                          'commission': '0.03'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(SystemAccount.objects.get().account, Decimal('0.00'))
+        self.assertEqual(ledger.verify(), [])
+
+    def test_admin_adjustment(self):
+        User.objects.create_superuser('admin', 'admin@test.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        profile = UserProfile.objects.get(user=self.customer)
+        url = reverse('admin:booking_userprofile_change', args=[profile.pk])
+        # Сумма на счету в форме не редактируется
+        response = self.client.post(url, {'cash': '1000.00',
+                                          'adjustment': '25.00'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(UserProfile.objects.get(pk=profile.pk).cash,
+                         Decimal('75.00'))
+        self.assertEqual(LedgerEntry.objects.filter(
+            user=self.customer, kind=LedgerEntry.ADJUSTMENT).get().amount,
+            Decimal('25.00'))
+        self.assertEqual(ledger.verify(), [])
+
+        response = self.client.post(url, {'adjustment': '-75.01'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(UserProfile.objects.get(pk=profile.pk).cash,
+                         Decimal('75.00'))
+
+
+class CompleteManyTestCase(BookingTestCase):
+
+    def setUp(self):
+        self.customer = User.objects.create_user(
+            'john', 'lennon@thebeatles.com', 'johnpassword')
+        self.performers = [
+            User.objects.create_user('paul', 'paul@thebeatles.com',
+                                     'paulpassword'),
+            User.objects.create_user('george', 'george@thebeatles.com',
+                                     'georgepassword')]
+        self.customer.user_permissions.add(
+            Permission.objects.get(codename='add_booking'))
+        UserProfile.objects.create(user=self.customer, cash=Decimal('1000.00'))
+        for performer in self.performers:
+            UserProfile.objects.create(user=performer, cash=Decimal('0.00'))
+        SystemAccount.objects.create()
+        self.bookings = []
+        for i in range(6):
+            booking = Booking.objects.create(
+                title='title %s' % i, text='text', price=Decimal('10.15'),
+                customer=self.customer)
+            performer = self.performers[i % 2]
+            transitions.serve(booking.pk, performer)
+            transitions.approve(booking.pk, self.customer, performer.pk)
+            self.bookings.append(booking)
+        self.pending = Booking.objects.create(
+            title='pending', text='text', price=Decimal('10.00'),
+            customer=self.customer)
+
+    def test_complete_many(self):
+        booking_ids = [booking.pk for booking in self.bookings]
+        with CaptureQueriesContext(connection) as queries:
+            split = transitions.complete_many(
+                booking_ids + [self.pending.pk], self.customer)
+        # Заказы изменяются одним запросом, счета, удержания, журнал
+        # операций и счет системы - вторым
+        statements = [query['sql'].split()[:4]
+                      for query in queries.captured_queries]
+        self.assertEqual(statements.count(
+            ['UPDATE', 'booking_booking', 'SET', 'status']), 1)
+        for table in ('booking_userprofile', 'booking_escrowhold',
+                      'booking_ledgerentry', 'booking_systemaccountstripe'):
+            self.assertEqual(len([query for query in queries.captured_queries
+                                  if table in query['sql']]), 1)
+        self.assertEqual(split, [(booking_id, Decimal('0.30'),
+                                  Decimal('9.85'))
+                                 for booking_id in booking_ids])
+        self.assertEqual(Booking.objects.filter(
+            status=Booking.COMPLETED).count(), 6)
+        self.assertEqual(Booking.objects.get(pk=self.pending.pk).status,
+                         Booking.PENDING)
+        for performer in self.performers:
+            self.assertEqual(UserProfile.objects.get(user=performer).cash,
+                             Decimal('29.55'))
+        self.assertEqual(SystemAccount.objects.get().get_balance(),
+                         Decimal('1.80'))
+        self.assertEqual(ledger.verify(), [])
+        self.assertEqual(ledger.get_balance(), Decimal('1.80'))
+        self.assertEqual(list(FeedEntry.objects.values_list('pk', flat=True)),
+                         [self.pending.pk])
+        self.assertEqual(counters.get_total(['status:running']), 0)
+        self.assertEqual(counters.get_total(['status:completed']), 6)
+
+        # Повторное завершение ничего не меняет
+        self.assertEqual(transitions.complete_many(booking_ids,
+                                                   self.customer), [])
+        self.assertEqual(SystemAccount.objects.get().get_balance(),
+                         Decimal('1.80'))
+
+    def test_single_and_bulk_split_match(self):
+        single = transitions.complete(self.bookings[0].pk, self.customer)
+        bulk = transitions.complete_many([self.bookings[1].pk], self.customer)
+        self.assertEqual(single, (Decimal('0.30'), Decimal('9.85')))
+        self.assertEqual(bulk, [(self.bookings[1].pk,) + single])
+        self.assertEqual(ledger.verify(), [])
+
+    def test_other_customer_bookings_are_skipped(self):
+        self.assertEqual(transitions.complete_many(
+            [self.bookings[0].pk], self.performers[0]), [])
+        self.assertEqual(Booking.objects.get(pk=self.bookings[0].pk).status,
+                         Booking.RUNNING)
+        self.assertRaises(TransitionError, transitions.complete_many, ['x'],
+                          self.customer)
+
+    def test_view(self):
+        self.client.login(username='john', password='johnpassword')
+        response = self.client.post(
+            reverse('complete-bookings'),
+            {'booking': [self.bookings[0].pk, self.bookings[1].pk,
+                         self.pending.pk]},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        data = json.loads(response.content)
+        self.assertEqual(data['bookings'], [
+            {'id': self.bookings[0].pk, 'cash_for_system': '0.30',
+             'cash_for_performer': '9.85'},
+            {'id': self.bookings[1].pk, 'cash_for_system': '0.30',
+             'cash_for_performer': '9.85'}])
+        self.assertEqual(data['skipped'], [str(self.pending.pk)])
+        self.assertEqual(counters.get_total(['status:running']), 4)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('settle_bookings', customer='john', batch_size=4,
+                     stdout=out)
+        self.assertIn(u"Завершено заказов: 6",
+                      out.getvalue().decode('utf-8'))
+        self.assertFalse(Booking.objects.filter(
+            status=Booking.RUNNING).exists())
+        self.assertEqual(ledger.verify(), [])
+
+
+@override_settings(BOOKING_SETTLEMENT_ASYNC=True)
+class SettlementQueueTestCase(BookingTestCase):
+
+    def setUp(self):
+        self.customer = User.objects.create_user(
+            'john', 'lennon@thebeatles.com', 'johnpassword')
+        self.performer = User.objects.create_user(
+            'paul', 'paul@thebeatles.com', 'paulpassword')
+        self.customer.user_permissions.add(
+            Permission.objects.get(codename='add_booking'))
+        UserProfile.objects.create(user=self.customer, cash=Decimal('100.00'))
+        UserProfile.objects.create(user=self.performer, cash=Decimal('0.00'))
+        SystemAccount.objects.create()
+        self.bookings = []
+        for i in range(3):
+            booking = Booking.objects.create(
+                title='title %s' % i, text='text', price=Decimal('10.00'),
+                customer=self.customer)
+            transitions.serve(booking.pk, self.performer)
+            transitions.approve(booking.pk, self.customer, self.performer.pk)
+            self.bookings.append(booking)
+        self.client.login(username='john', password='johnpassword')
+
+    def complete(self, booking):
+        response = self.client.post(reverse('complete-booking'),
+                                    {'id': booking.pk},
+                                    HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        return json.loads(response.content)
+
+    def test_completion_is_queued(self):
+        data = self.complete(self.bookings[0])
+        self.assertEqual(data['status'], Booking.COMPLETING)
+        booking = Booking.objects.get(pk=self.bookings[0].pk)
+        self.assertEqual(booking.status, Booking.COMPLETING)
+        self.assertEqual(FeedEntry.objects.get(pk=booking.pk).status,
+                         Booking.COMPLETING)
+        # Деньги еще не переведены
+        self.assertEqual(UserProfile.objects.get(user=self.performer).cash,
+                         Decimal('0.00'))
+        self.assertEqual(settlement.queue_stats()['depth'], 1)
+        # Повторное завершение отклоняется
+        self.assertEqual(self.complete(self.bookings[0])['request_status'],
+                         u"Неверный статус заказа")
+
+        self.complete(self.bookings[1])
+        self.assertEqual(settlement.process_batch(), (2, [
+            (self.bookings[0].pk, Decimal('0.30'), Decimal('9.70')),
+            (self.bookings[1].pk, Decimal('0.30'), Decimal('9.70'))]))
+        self.assertEqual(settlement.process_batch(), (0, []))
+        self.assertEqual(settlement.queue_stats(),
+                         {'depth': 0, 'failed': 0, 'lag': 0.0})
+        self.assertEqual(Booking.objects.filter(
+            status=Booking.COMPLETED).count(), 2)
+        self.assertEqual(UserProfile.objects.get(user=self.performer).cash,
+                         Decimal('19.40'))
+        self.assertEqual(SystemAccount.objects.get().get_balance(),
+                         Decimal('0.60'))
+        self.assertEqual(ledger.verify(), [])
+        self.assertEqual(counters.get_total(['status:completing']), 0)
+        self.assertEqual(counters.get_total(['status:completed']), 2)
+
+    def test_claimed_tasks_are_skipped(self):
+        """
+        Задание, занятое другим обработчиком (его advisory-блокировка), не
+        берется в порцию
+        """
+        for booking in self.bookings:
+            self.complete(booking)
+        task_id = Settlement.objects.get(booking=self.bookings[0]).pk
+        locked, release = threading.Event(), threading.Event()
+
+        def hold_lock():
+            # Другое соединение с базой - другой обработчик
+            cursor = connection.cursor()
+            cursor.execute("SELECT pg_advisory_lock(%s, %s)",
+                           [settlement.LOCK_CLASS, task_id])
+            locked.set()
+            release.wait()
+            cursor.execute("SELECT pg_advisory_unlock(%s, %s)",
+                           [settlement.LOCK_CLASS, task_id])
+            connection.close()
+
+        thread = threading.Thread(target=hold_lock)
+        thread.start()
+        try:
+            locked.wait()
+            count, split = settlement.process_batch()
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(count, 2)
+        self.assertEqual([row[0] for row in split],
+                         [self.bookings[1].pk, self.bookings[2].pk])
+        self.assertEqual(list(Settlement.objects.values_list('pk', flat=True)),
+                         [task_id])
+        self.assertEqual(settlement.process_batch()[0], 1)
+
+    def test_failed_settlement_does_not_block_batch(self):
+        for booking in self.bookings:
+            self.complete(booking)
+        # У исполнителя второго заказа нет профиля
+        other = User.objects.create_user('ringo', 'ringo@thebeatles.com',
+                                         'ringopassword')
+        Booking.objects.filter(pk=self.bookings[1].pk).update(performer=other)
+
+        count, split = settlement.process_batch()
+        self.assertEqual(count, 3)
+        self.assertEqual([row[0] for row in split],
+                         [self.bookings[0].pk, self.bookings[2].pk])
+        self.assertEqual(Booking.objects.get(pk=self.bookings[1].pk).status,
+                         Booking.COMPLETING)
+        stats = settlement.queue_stats()
+        self.assertEqual((stats['depth'], stats['failed']), (0, 1))
+        self.assertEqual(Settlement.objects.get().error,
+                         u"У исполнителя нет расширенного профиля")
+
+    def test_worker_command(self):
+        for booking in self.bookings:
+            self.complete(booking)
+        out = StringIO()
+        call_command('settlement_worker', stats=True, stdout=out)
+        self.assertIn(u"В очереди: 3", out.getvalue().decode('utf-8'))
+        call_command('settlement_worker', once=True, batch_size=2,
+                     stdout=StringIO())
+        self.assertFalse(Settlement.objects.exists())
+        self.assertEqual(Booking.objects.filter(
+            status=Booking.COMPLETED).count(), 3)
+
+
+class ConcurrentTransitionsTestCase(TransactionTestCase):
+
+    # Число параллельных запросов
+    THREADS = 5
+
+    def setUp(self):
+        self.customer = User.objects.create_user(
+            'john', 'lennon@thebeatles.com', 'johnpassword')
+        UserProfile.objects.create(user=self.customer, cash=Decimal('100.00'))
+        self.performers = []
+        for i in range(self.THREADS):
+            performer = User.objects.create_user(
+                'performer%s' % i, 'performer@test.com', 'password')
+            UserProfile.objects.create(user=performer, cash=Decimal('0.00'))
+            self.performers.append(performer)
+        SystemAccount.objects.create()
+        self.booking = Booking.objects.create(
+            title='title', text='text', price=Decimal('50.00'),
+            customer=self.customer)
+        for performer in self.performers:
+            transitions.serve(self.booking.pk, performer)
+
+    def tearDown(self):
+        ContentType.objects.clear_cache()
+
+    def run_concurrently(self, function, args_list):
+        """
+        Параллельный вызов function в отдельных транзакциях. Возвращает
+        число успешных вызовов.
+        """
+        start = threading.Event()
+        results = []
+        errors = []
+
+        def run(args):
+            start.wait()
+            try:
+                with transaction.atomic():
+                    function(*args)
+                results.append(True)
+            except TransitionError:
+                results.append(False)
+            except DatabaseError as e:
+                # Например, взаимная блокировка транзакций
+                errors.append(e)
+            finally:
+                escrow.flush()
+                connection.close()
+
+        threads = [threading.Thread(target=run, args=(args,))
+                   for args in args_list]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        return results.count(True)
+
+    def test_concurrent_approve_and_complete(self):
+        # Заказчик одновременно подтверждает всех исполнителей
+        succeeded = self.run_concurrently(transitions.approve, [
+            (self.booking.pk, self.customer, performer.pk)
+            for performer in self.performers])
+        self.assertEqual(succeeded, 1)
+        self.assertEqual(UserProfile.objects.get(user=self.customer).cash,
+                         Decimal('50.00'))
+
+        # Повторные нажатия "Завершить"
+        succeeded = self.run_concurrently(transitions.complete, [
+            (self.booking.pk, self.customer)] * self.THREADS)
+        self.assertEqual(succeeded, 1)
+        booking = Booking.objects.get(pk=self.booking.pk)
+        self.assertEqual(booking.status, Booking.COMPLETED)
+        self.assertEqual(UserProfile.objects.get(user=booking.performer).cash,
+                         Decimal('48.50'))
+        self.assertEqual(SystemAccount.objects.get().get_balance(), Decimal('1.50'))
+        self.assertEqual(counters.get_total(['status:completed']), 1)
+
+    def test_concurrent_approves_of_one_customer(self):
+        """
+        Подтверждения двух заказов одного заказчика, после которых
+        меняется признак "хватает средств" другого заказа, не блокируют друг
+        друга
+        """
+        customer = User.objects.create_user('ringo', 'ringo@test.com',
+                                            'ringopassword')
+        UserProfile.objects.create(user=customer, cash=Decimal('1100.00'))
+        bookings = [Booking.objects.create(
+            title='title', text='text', price=Decimal('600.00'),
+            customer=customer) for i in range(2)]
+        for booking, performer in zip(bookings, self.performers):
+            transitions.serve(booking.pk, performer)
+        succeeded = self.run_concurrently(transitions.approve, [
+            (booking.pk, customer, performer.pk)
+            for booking, performer in zip(bookings, self.performers)])
+        self.assertEqual(succeeded, 1)
+        self.assertEqual(UserProfile.objects.get(user=customer).cash,
+                         Decimal('500.00'))
+        waiting = Booking.objects.get(
+            pk__in=[booking.pk for booking in bookings],
+            status=Booking.WAITING_FOR_APPROVAL)
+        self.assertFalse(waiting.affordable)
+        self.assertFalse(FeedEntry.objects.get(
+            pk=waiting.pk).customer_can_afford)
+
+
+class LoadTestTestCase(TransactionTestCase):
+
+    def setUp(self):
+        SystemAccount.objects.create()
+        # Части счетчиков статусов, созданные миграцией, удалены очисткой
+        # базы после предыдущих тестов
+        counters.rebuild()
+
+    def tearDown(self):
+        ContentType.objects.clear_cache()
+        events.hub.stop()
+
+    def test_loadtest(self):
+        out = StringIO()
+        call_command('loadtest', customers=3, performers=4, bookings=2,
+                     threads=4, duration=120, seed=1, json=True, stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['completed'], 6)
+        self.assertEqual(report['problems'], [])
+        for url_name in ('create-booking', 'booking-list', 'serve-booking',
+                         'approve-booking', 'complete-booking'):
+            stats = report['urls'][url_name]
+            self.assertTrue(stats['count'] > 0)
+            self.assertEqual(stats['error'], 0)
+            self.assertTrue(stats['p50'] <= stats['p95'] <= stats['p99'])
+        self.assertEqual(report['urls']['create-booking']['ok'], 6)
+
+
+class SeedTestCase(BookingTestCase):
+
+    def seed(self, prefix, **options):
+        stdout = StringIO()
+        call_command('seed', customers=6, performers=5, bookings=80,
+                     applicants=3, comments=2, seed=7, prefix=prefix,
+                     stdout=stdout, **options)
+        return stdout.getvalue().decode('utf-8')
+
+    def test_seed(self):
+        output = self.seed('s')
+        self.assertIn(u'booking_booking', output)
+        bookings = Booking.objects.filter(customer__username__startswith='s_')
+        self.assertEqual(bookings.count(), 80)
+        self.assertEqual(User.objects.filter(
+            username__startswith='s_', groups__name=roles.PERFORMERS).count(),
+            5)
+        self.assertTrue(self.client.login(username='s_c0',
+                                          password='password'))
+
+        # Претенденты есть только у заказов, ожидающих подтверждения,
+        # исполнитель - у взятых заказов
+        applicants = Booking.possible_performers.through.objects
+        for booking in bookings.prefetch_related('possible_performers'):
+            count = len(booking.possible_performers.all())
+            if booking.status == Booking.WAITING_FOR_APPROVAL:
+                self.assertTrue(1 <= count <= 3)
+            else:
+                self.assertEqual(count, 0)
+            self.assertEqual(booking.performer_id is None, booking.status in (
+                Booking.PENDING, Booking.WAITING_FOR_APPROVAL))
+            self.assertEqual(booking.affordable,
+                             booking.price <= booking.customer.profile.cash)
+        self.assertTrue(applicants.exists())
+        self.assertTrue(Comment.objects.filter(booking__in=bookings).exists())
+
+        # Деньги согласованы: журнал, удержания, очередь расчетов
+        self.assertEqual(ledger.verify(), [])
+        held = UserProfile.objects.aggregate(total=Sum('held'))['total']
+        self.assertEqual(EscrowHold.objects.aggregate(
+            total=Sum('amount'))['total'], held)
+        self.assertEqual(EscrowHold.objects.count(), bookings.filter(
+            status__in=(Booking.RUNNING, Booking.COMPLETING)).count())
+        self.assertEqual(Settlement.objects.count(), bookings.filter(
+            status=Booking.COMPLETING).count())
+        self.assertEqual(ledger.get_balance(None), 0)
+
+        # Лента и счетчики перестроены
+        self.assertEqual(FeedEntry.objects.count(), bookings.exclude(
+            status=Booking.COMPLETED).count())
+        for status, name in Booking.STATUS_CHOICES:
+            self.assertEqual(
+                counters.get_total([counters.status_counter(status)]),
+                bookings.filter(status=status).count())
+
+        # Последовательности id сдвинуты
+        booking = Booking.objects.create(title='title', text='text', price=1,
+                                         customer=User.objects.create_user(
+                                             'after_seed', password='p'))
+        self.assertGreater(booking.pk, max(bookings.values_list(
+            'pk', flat=True)))
+
+    def test_deterministic(self):
+        self.seed('a')
+        self.seed('b', statuses='pending=1,completed=3')
+        self.seed('c')
+        fields = ('status', 'price', 'title', 'version')
+        first, second, third = [list(Booking.objects.filter(
+            customer__username__startswith=prefix).order_by('pk').values_list(
+                *fields)) for prefix in ('a_', 'b_', 'c_')]
+        self.assertEqual(first, third)
+        self.assertNotEqual(first, second)
+        self.assertEqual(set(status for status, price, title, version
+                             in second),
+                         set([Booking.PENDING, Booking.COMPLETED]))
+
+    def test_errors(self):
+        self.seed('s')
+        with self.assertRaises(CommandError):
+            self.seed('s')
+        with self.assertRaises(CommandError):
+            self.seed('t', statuses='unknown=1')
+
+
+class BookingEventsTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.customer = User.objects.create_user(
+            'john', 'lennon@thebeatles.com', 'johnpassword')
+        self.performer = User.objects.create_user(
+            'paul', 'paul@thebeatles.com', 'paulpassword')
+        self.booking = Booking.objects.create(
+            title='title', text='text', price=10, customer=self.customer)
+        self.client.login(username='john', password='johnpassword')
+
+    def tearDown(self):
+        # Соединение слушателя мешает удалению тестовой базы
+        events.hub.stop()
+        # После очистки базы типы содержимого создаются заново с другими id
+        ContentType.objects.clear_cache()
+
+    def events(self, version):
+        """
+        События заказа self.booking, известного клиенту в версии version
+        """
+        response = self.client.get(reverse('booking-events'), {
+            'bookings': '%s:%s' % (self.booking.pk, version)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        return json.loads(response.content)['events']
+
+    def test_login_required(self):
+        self.client.logout()
+        response = self.client.get(reverse('booking-events'))
+        self.assertEqual(response.status_code, 302)
+
+    def test_bad_bookings(self):
+        for value in ('x', '1:2:3', ','.join(
+                '%s:0' % i for i in range(events.MAX_BOOKINGS + 1))):
+            response = self.client.get(reverse('booking-events'),
+                                       {'bookings': value})
+            self.assertEqual(response.status_code, 400)
+
+    def test_status_event(self):
+        version = self.booking.version
+        self.assertEqual(self.events(version), [])
+
+        self.booking.performer = self.performer
+        self.booking.set_status(Booking.RUNNING)
+        self.assertEqual(self.events(version), [{
+            'id': self.booking.pk,
+            'status': Booking.RUNNING,
+            'performer': 'paul',
+            'version': self.booking.version,
+        }])
+        self.assertEqual(self.events(self.booking.version), [])
+
+    def test_price_split_is_private(self):
+        UserProfile.objects.create(user=self.customer, cash=Decimal('100.00'))
+        UserProfile.objects.create(user=self.performer, cash=Decimal('0.00'))
+        SystemAccount.objects.create()
+        version = self.booking.version
+        with transaction.atomic():
+            transitions.serve(self.booking.pk, self.performer)
+            transitions.approve(self.booking.pk, self.customer,
+                                self.performer.pk)
+            transitions.complete(self.booking.pk, self.customer)
+
+        event, = self.events(version)
+        self.assertEqual(event['status'], Booking.COMPLETED)
+        self.assertEqual(event['performer'], 'paul')
+        self.assertEqual(Decimal(event['cash_for_system']) +
+                         Decimal(event['cash_for_performer']),
+                         self.booking.price)
+
+        # Завершенный заказ пропадает из ленты: посторонний пользователь
+        # получает только удаление строки, как для несуществующего заказа
+        User.objects.create_user('george', password='georgepassword')
+        self.client.login(username='george', password='georgepassword')
+        self.assertEqual(self.events(version), [{'id': self.booking.pk,
+                                                 'removed': True}])
+        response = self.client.get(reverse('booking-events'),
+                                   {'bookings': '0:0'})
+        self.assertEqual(json.loads(response.content)['events'],
+                         [{'id': 0, 'removed': True}])
+
+    def test_other_users_open_bookings(self):
+        # Незавершенные заказы ленты видны всем пользователям
+        User.objects.create_user('george', password='georgepassword')
+        self.client.login(username='george', password='georgepassword')
+        version = self.booking.version
+        self.assertEqual(self.events(version), [])
+        self.booking.performer = self.performer
+        self.booking.set_status(Booking.RUNNING)
+        event, = self.events(version)
+        self.assertEqual((event['status'], event['performer']),
+                         (Booking.RUNNING, 'paul'))
+
+    @override_settings(BOOKING_EVENTS_POLL_TIMEOUT=30)
+    def test_poll_waits_for_change(self):
+        def change():
+            time.sleep(0.5)
+            booking = Booking.objects.get(pk=self.booking.pk)
+            booking.performer = self.performer
+            booking.set_status(Booking.RUNNING)
+            connection.close()
+
+        thread = threading.Thread(target=change)
+        started = time.time()
+        thread.start()
+        try:
+            event, = self.events(self.booking.version)
+        finally:
+            thread.join()
+        self.assertEqual(event['status'], Booking.RUNNING)
+        self.assertLess(time.time() - started, 30)
+
+
+# Завершение заказа с переводом денег в том же запросе
+@override_settings(
+    BOOKING_SETTLEMENT_ASYNC=False,
+    PASSWORD_HASHERS=('django.contrib.auth.hashers.MD5PasswordHasher',))
+class BookingBenchmarkTestCase(BookingTestCase):
+    """
+    Замеры шагов работы с заказами (см. benchmark.py) для конфигураций
+    BOOKING_BENCHMARK_SWEEP. Результаты записываются в
+    BOOKING_BENCHMARK_OUTPUT и сравниваются с BOOKING_BENCHMARK_BASELINE,
+    если они указаны.
+    """
+
+    def setUp(self):
+        SystemAccount.objects.create()
 
-        time_after = time.time()
-        time_delta = time_after - time_before
-        result = u"Число заказчиков K = %s. Число исполнителей K = %s. Время выполнения: %s секунд." % (self.K, self.K, time_delta)
-        print result
+    def test_benchmark(self):
+        results, benchmarks = benchmark.run_sweep(
+            settings.BOOKING_BENCHMARK_SWEEP, settings.BOOKING_BENCHMARK_REPEAT,
+            settings.BOOKING_BENCHMARK_WARMUP)
+
+        # Все заказы завершены, деньги заказчиков поделены между
+        # исполнителями и системой
+        booking_ids = sum([run.booking_ids for run in benchmarks], [])
+        self.assertEqual(Booking.objects.filter(
+            pk__in=booking_ids, status=Booking.COMPLETED).count(),
+            len(booking_ids))
+        paid = Decimal(benchmark.PRICE) * len(booking_ids)
+        performers_cash = UserProfile.objects.filter(
+            user__username__startswith='bench_performer').aggregate(
+                total=Sum('cash'))['total']
+        self.assertEqual(
+            performers_cash + SystemAccount.objects.get().get_balance(), paid)
+        self.assertEqual(ledger.verify(), [])
+
+        for run in results['runs']:
+            passes = run['customers'] * run['bookings'] * run['repeat']
+            for step in benchmark.STEPS:
+                self.assertEqual(run['steps'][step]['count'], passes)
+
+        if settings.BOOKING_BENCHMARK_OUTPUT:
+            benchmark.save(results, settings.BOOKING_BENCHMARK_OUTPUT)
+        if settings.BOOKING_BENCHMARK_BASELINE:
+            regressions = benchmark.compare(
+                results, benchmark.load(settings.BOOKING_BENCHMARK_BASELINE),
+                settings.BOOKING_BENCHMARK_THRESHOLD)
+            self.assertEqual(regressions, [], u"\n".join(
+                u"K=%s, M=%s, %s: %s" % regression
+                for regression in regressions).encode('utf-8'))
+
+    def test_refused_transition_fails(self):
+        run = benchmark.Benchmark(1, 1)
+        run.setup()
+        customer, customer_client, performer, performer_client = run.users[0]
+        with self.assertRaises(AssertionError):
+            run.transition(benchmark.SERVE, False, performer_client,
+                           'serve-booking', {'id': 0})
+
+    def test_compare(self):
+        def results(median, queries):
+            return {'runs': [{'customers': 10, 'bookings': 1, 'steps': dict(
+                (step, {'median': median, 'queries': queries})
+                for step in benchmark.STEPS)}]}
+
+        baseline = results(10.0, 5)
+        self.assertEqual(benchmark.compare(results(14.0, 5), baseline, 1.5),
+                         [])
+        regressions = benchmark.compare(results(16.0, 6), baseline, 1.5)
+        self.assertEqual(len(regressions), 2 * len(benchmark.STEPS))
+        self.assertEqual(regressions[0][:3], (10, 1, benchmark.LIST))
+        # Конфигурации, которых нет в baseline, не сравниваются
+        self.assertEqual(benchmark.compare(
+            results(16.0, 6), {'runs': []}, 1.5), [])
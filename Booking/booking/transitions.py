@@ -0,0 +1,511 @@
+# -*- coding: utf-8 -*-
+
+"""
+Переходы заказа между статусами: взятие заказа исполнителем, подтверждение
+исполнителя заказчиком, завершение заказа.
+
+Каждый переход - один условный запрос (CAS): заказ блокируется, условия
+перехода (статус, заказчик, заявка исполнителя, средства заказчика)
+проверяются и заказ получает новые значения в одном запросе
+
+    WITH old AS (SELECT ... FOR UPDATE) UPDATE booking_booking ... RETURNING
+
+Если статус заказа уже изменил параллельный запрос, запрос не изменяет ни
+одной строки и переход отклоняется; причина отказа для сообщения
+пользователю выясняется отдельным чтением заказа только в этом случае.
+Строка заказа остается заблокированной до конца транзакции, поэтому
+переходы одного заказа выполняются по очереди. Деньги переводятся вторым
+запросом: удержание цены заказа при подтверждении исполнителя
+(UserProfile.hold_cash), выплата исполнителю, снятие удержания, проводки
+журнала и комиссия при завершении (SETTLE_SQL). Счета пользователей
+блокируются всегда в порядке id пользователя, последней изменяется одна из
+частей счета системы (см. SystemAccount). Единый порядок блокировок
+исключает взаимные блокировки параллельных транзакций, поэтому другие
+заказы заказчика в транзакции перехода не изменяются: их признак "хватает
+средств" пересчитывается после нее (см. escrow.py). Движение денег
+записывается в журнал операций (см. ledger.py).
+
+Завершение по одному - частный случай завершения нескольких заказов одного
+заказчика (complete_many): статусы изменяются одним запросом, суммы
+исполнителям, удержания, проводки и комиссия - вторым запросом на все
+заказы.
+
+При асинхронном завершении (request_completion) заказ только переводится в
+статус "Завершается" и ставится в очередь расчетов, деньги переводит
+обработчик очереди (см. settlement.py) тем же complete_many.
+
+Функции вызываются внутри transaction.atomic(). При невозможности перехода
+выбрасывается TransitionError с сообщением для пользователя; изменения,
+сделанные до этого в транзакции, откатываются вместе с ней.
+"""
+
+from collections import defaultdict
+from decimal import Decimal, ROUND_HALF_UP
+import random
+
+from django.contrib.auth.models import User
+from django.db import connection
+
+from .models import Booking, LedgerEntry, UserProfile, SystemAccount, \
+    Settlement
+from .signals import booking_status_changed, booking_updated, \
+    bookings_completed
+
+
+# Ошибка перехода из-за того, что статус заказа уже изменен (в том числе
+# параллельным запросом)
+WRONG_STATUS = u"Неверный статус заказа"
+
+# Переходы заказа: имя перехода - (статусы, из которых он возможен, новый
+# статус)
+TRANSITIONS = {
+    'serve': ((Booking.PENDING, Booking.WAITING_FOR_APPROVAL),
+              Booking.WAITING_FOR_APPROVAL),
+    'approve': ((Booking.WAITING_FOR_APPROVAL,), Booking.RUNNING),
+    'complete': ((Booking.RUNNING,), Booking.COMPLETED),
+    'request_completion': ((Booking.RUNNING,), Booking.COMPLETING),
+}
+
+# Условный перевод заказа в новый статус. Новая версия заказа возвращается
+# тем же запросом.
+UPDATE_STATUS_SQL = """
+UPDATE booking_booking
+SET status = %s, version = version + 1,
+    performer_id = COALESCE(%s, performer_id)
+WHERE id = %s AND status = ANY(%s)
+RETURNING version
+"""
+
+# Завершение заказов одним запросом. Строки заказов блокируются в порядке id,
+# как и профили пользователей, чтобы параллельные завершения не ждали друг
+# друга взаимно. Счет системы и комиссия возвращаются тем же запросом.
+COMPLETE_MANY_SQL = """
+UPDATE booking_booking SET status = %s, version = version + 1
+WHERE id IN (
+    SELECT id FROM booking_booking
+    WHERE id = ANY(%s) AND status = %s
+      AND (%s::integer IS NULL OR customer_id = %s)
+    ORDER BY id FOR UPDATE)
+RETURNING id, customer_id, performer_id, price, version,
+    (SELECT id FROM booking_systemaccount ORDER BY id LIMIT 1),
+    (SELECT commission FROM booking_systemaccount ORDER BY id LIMIT 1)
+"""
+
+# Денежная часть завершения заказов - один запрос: блокировка профилей
+# исполнителей и заказчиков в порядке id пользователя, снятие удержаний,
+# зачисление выплат исполнителям, проводки журнала и зачисление комиссий в
+# случайно выбранную часть счета системы. Возвращает новые суммы на счетах
+# и число измененных частей счета (0, если части нет).
+SETTLE_SQL = """
+WITH locked AS (
+    SELECT user_id FROM booking_userprofile
+    WHERE user_id = ANY(%(user_ids)s) ORDER BY user_id FOR UPDATE
+), released AS (
+    DELETE FROM booking_escrowhold WHERE booking_id = ANY(%(booking_ids)s)
+    RETURNING customer_id, amount
+), changes AS (
+    SELECT user_id, SUM(cash) AS cash, SUM(held) AS held FROM (
+        SELECT c.user_id, c.amount AS cash, 0 AS held
+        FROM unnest(%(performer_ids)s::integer[], %(credits)s::numeric[])
+            AS c(user_id, amount)
+        UNION ALL
+        SELECT customer_id, 0, amount FROM released
+    ) c GROUP BY user_id
+), credited AS (
+    UPDATE booking_userprofile p
+    SET cash = p.cash + c.cash, held = p.held - c.held
+    FROM changes c
+    WHERE p.user_id = c.user_id AND p.user_id IN (SELECT user_id FROM locked)
+    RETURNING p.user_id, p.cash
+), entries AS (
+    INSERT INTO booking_ledgerentry (user_id, amount, kind, booking_id, date)
+    SELECT e.user_id, e.amount, e.kind, e.booking_id, now()
+    FROM unnest(%(entry_users)s::integer[], %(entry_amounts)s::numeric[],
+                %(entry_kinds)s::varchar[], %(entry_bookings)s::integer[])
+        AS e(user_id, amount, kind, booking_id)
+), stripe AS (
+    UPDATE booking_systemaccountstripe SET amount = amount + %(commission)s
+    WHERE account_id = %(account_id)s AND stripe = %(stripe)s
+    RETURNING id
+)
+SELECT user_id, cash, (SELECT COUNT(*) FROM stripe) FROM credited
+"""
+
+# Поля заказа, возвращаемые запросами переходов (см. booking_from_row)
+BOOKING_FIELDS = ('id', 'title', 'text', 'price', 'status', 'customer_id',
+                  'performer_id', 'date', 'version', 'affordable')
+
+BOOKING_COLUMNS = ', '.join('b.%s' % field for field in BOOKING_FIELDS)
+
+# Заявка исполнителя на заказ: блокировка заказа, проверка статуса, средств
+# заказчика и повторной заявки, заявка и перевод в новый статус - один
+# запрос. Возвращает заказ с новыми значениями, статус и исполнителя до
+# перехода.
+SERVE_SQL = """
+WITH old AS (
+    SELECT id, status, performer_id, customer_id, price FROM booking_booking
+    WHERE id = %%(id)s FOR UPDATE
+), applied AS (
+    INSERT INTO booking_booking_possible_performers (booking_id, user_id)
+    SELECT old.id, %%(performer_id)s FROM old
+    JOIN booking_userprofile p ON p.user_id = old.customer_id
+    WHERE old.status = ANY(%%(statuses)s) AND p.cash >= old.price
+      AND NOT EXISTS (
+          SELECT 1 FROM booking_booking_possible_performers
+          WHERE booking_id = old.id AND user_id = %%(performer_id)s)
+    RETURNING booking_id
+)
+UPDATE booking_booking b SET status = %%(status)s, version = b.version + 1
+FROM old, applied
+WHERE b.id = old.id AND applied.booking_id = old.id
+RETURNING %s, old.status, old.performer_id
+""" % BOOKING_COLUMNS
+
+# Подтверждение исполнителя: блокировка заказа, проверка статуса, заказчика
+# и заявки исполнителя, перевод в новый статус и удаление всех заявок - один
+# запрос. Возвращает заказ с новыми значениями, статус и исполнителя до
+# перехода и имя исполнителя.
+APPROVE_SQL = """
+WITH old AS (
+    SELECT id, status, performer_id, customer_id FROM booking_booking
+    WHERE id = %%(id)s FOR UPDATE
+), changed AS (
+    UPDATE booking_booking b
+    SET status = %%(status)s, version = b.version + 1,
+        performer_id = %%(performer_id)s
+    FROM old
+    WHERE b.id = old.id AND old.status = ANY(%%(statuses)s)
+      AND old.customer_id = %%(customer_id)s
+      AND EXISTS (
+          SELECT 1 FROM booking_booking_possible_performers
+          WHERE booking_id = old.id AND user_id = %%(performer_id)s)
+    RETURNING %s, old.status AS old_status,
+              old.performer_id AS old_performer_id
+), cleared AS (
+    DELETE FROM booking_booking_possible_performers
+    WHERE booking_id IN (SELECT id FROM changed)
+)
+SELECT changed.*, u.username FROM changed
+JOIN auth_user u ON u.id = changed.performer_id
+""" % BOOKING_COLUMNS
+
+# Точность денежных сумм
+CENT = Decimal('0.01')
+
+
+class TransitionError(Exception):
+    """
+    Переход заказа невозможен. Текст исключения - сообщение пользователю.
+    """
+
+    def __init__(self, message):
+        super(TransitionError, self).__init__(message)
+        self.message = message
+
+
+def split_price(price, comission):
+    """
+    Раздел цены заказа: (комиссия, сумма исполнителю). Комиссия округляется
+    до копеек, в сумме части равны цене заказа. Общий для завершения по
+    одному и пачкой.
+    """
+    cash_for_system = (price * comission).quantize(CENT, ROUND_HALF_UP)
+    return cash_for_system, price - cash_for_system
+
+
+def get_booking(booking_id, *related):
+    """
+    Заказ с заказчиком и исполнителем (их имена нужны ленте и событиям) и
+    связанными объектами related, выбранными тем же запросом
+    """
+    try:
+        return Booking.objects.select_related(
+            'customer', 'performer', *related).get(id=booking_id)
+    except (Booking.DoesNotExist, ValueError, TypeError):
+        raise TransitionError(u"Заказ не найден")
+
+
+def parse_id(booking_id):
+    """
+    Id заказа из параметра запроса
+    """
+    try:
+        return int(booking_id)
+    except (ValueError, TypeError):
+        raise TransitionError(u"Заказ не найден")
+
+
+def booking_from_row(row):
+    """
+    Заказ по строке запроса перехода: поля BOOKING_FIELDS, затем статус и
+    исполнитель до перехода. Возвращает (заказ, старый статус, старый
+    исполнитель).
+    """
+    count = len(BOOKING_FIELDS)
+    booking = Booking(**dict(zip(BOOKING_FIELDS, row[:count])))
+    booking._state.adding = False
+    booking._state.db = connection.alias
+    return booking, row[count], row[count + 1]
+
+
+def send_updated(booking, old_status, old_performer_id):
+    """
+    Сигналы об изменении заказа запросом перехода (посылаются в текущей
+    транзакции)
+    """
+    booking_updated.send(sender=Booking, booking=booking,
+                         old_status=old_status,
+                         old_performer_id=old_performer_id)
+    if old_status != booking.status:
+        booking_status_changed.send(sender=Booking, booking=booking,
+                                    old_status=old_status)
+
+
+def update_status(booking, statuses, status, performer=None):
+    """
+    Перевод заказа из статуса statuses в статус status одним условным
+    запросом. Объект booking получает новые значения, сигналы об изменении
+    заказа посылаются в текущей транзакции.
+    """
+    cursor = connection.cursor()
+    cursor.execute(UPDATE_STATUS_SQL, [
+        status, performer.pk if performer is not None else None, booking.pk,
+        list(statuses)])
+    row = cursor.fetchone()
+    if row is None:
+        raise TransitionError(WRONG_STATUS)
+
+    old_status, old_performer_id = booking.status, booking.performer_id
+    booking.status = status
+    if performer is not None:
+        booking.performer = performer
+    booking.version = row[0]
+    send_updated(booking, old_status, old_performer_id)
+
+
+def check_status(booking, transition):
+    """
+    Проверка, возможен ли переход transition из текущего статуса заказа
+    """
+    statuses, status = TRANSITIONS[transition]
+    if booking.status not in statuses:
+        raise TransitionError(WRONG_STATUS)
+
+
+def apply_transition(booking, transition, performer=None):
+    """
+    Переход transition заказа booking (см. update_status)
+    """
+    statuses, status = TRANSITIONS[transition]
+    update_status(booking, statuses, status, performer)
+
+
+def serve(booking_id, performer):
+    """
+    Исполнитель performer подает заявку на заказ. Проверки, заявка и
+    перевод заказа в новый статус - один запрос (SERVE_SQL), причина отказа
+    выясняется, только если запрос не изменил заказ.
+    """
+    statuses, status = TRANSITIONS['serve']
+    cursor = connection.cursor()
+    cursor.execute(SERVE_SQL, {'id': parse_id(booking_id),
+                               'performer_id': performer.pk,
+                               'statuses': list(statuses), 'status': status})
+    row = cursor.fetchone()
+    if row is None:
+        raise serve_error(booking_id)
+
+    booking, old_status, old_performer_id = booking_from_row(row)
+    send_updated(booking, old_status, old_performer_id)
+    return booking
+
+
+def serve_error(booking_id):
+    """
+    Причина отказа в заявке на заказ
+    """
+    booking = get_booking(booking_id, 'customer__profile')
+    check_status(booking, 'serve')
+    # Средства проверяются по сумме на счету, а не по признаку affordable:
+    # он пересчитывается только после транзакции, изменившей счет (см.
+    # escrow.py), и до пересчета может быть неверным
+    try:
+        cash = booking.customer.profile.cash
+    except UserProfile.DoesNotExist:
+        return TransitionError(u"У создателя заказа нет расширенного профиля")
+    if cash < booking.price:
+        return TransitionError(u"Недостаточно средств")
+    return TransitionError(u"Вы уже подавали заявку на этот заказ")
+
+
+def approve(booking_id, customer, performer_id):
+    """
+    Заказчик customer подтверждает исполнителя заказа. Проверки, перевод
+    заказа в новый статус и удаление заявок - один запрос (APPROVE_SQL),
+    удержание цены заказа со счета заказчика - второй.
+    """
+    statuses, status = TRANSITIONS['approve']
+    row = None
+    try:
+        params = {'id': int(booking_id), 'performer_id': int(performer_id),
+                  'customer_id': customer.pk, 'statuses': list(statuses),
+                  'status': status}
+    except (ValueError, TypeError):
+        pass
+    else:
+        cursor = connection.cursor()
+        cursor.execute(APPROVE_SQL, params)
+        row = cursor.fetchone()
+    if row is None:
+        raise approve_error(booking_id, customer, performer_id)
+
+    booking, old_status, old_performer_id = booking_from_row(row)
+    booking.performer = User(pk=booking.performer_id, username=row[-1])
+    send_updated(booking, old_status, old_performer_id)
+    # Проверка остатка, удержание цены заказа и проводка - один запрос
+    if UserProfile.hold_cash(booking.customer_id, booking) is None:
+        if not UserProfile.objects.filter(
+                user_id=booking.customer_id).exists():
+            raise TransitionError(
+                u"У создателя заказа нет расширенного профиля")
+        raise TransitionError(u"Недостаточно средств")
+    return booking
+
+
+def approve_error(booking_id, customer, performer_id):
+    """
+    Причина отказа в подтверждении исполнителя
+    """
+    booking = get_booking(booking_id)
+    if booking.customer_id != customer.pk:
+        return TransitionError(u"Это не Ваш заказ")
+    check_status(booking, 'approve')
+    if not performer_id:
+        return TransitionError(u"Не указан исполнитель")
+    return TransitionError(u"Исполнитель указан неверно")
+
+
+def complete(booking_id, customer):
+    """
+    Заказчик customer завершает заказ (см. complete_many). Цена заказа за
+    вычетом комиссии переводится исполнителю, комиссия - на счет системы.
+    Возвращает (комиссия, сумма исполнителю).
+    """
+    split = complete_many([parse_id(booking_id)], customer)
+    if not split:
+        # Причина отказа
+        booking = get_booking(booking_id)
+        check_status(booking, 'complete')
+        if booking.customer_id != customer.pk:
+            raise TransitionError(u"Это не ваш заказ")
+        raise TransitionError(WRONG_STATUS)
+    booking_id, cash_for_system, cash_for_performer = split[0]
+    return cash_for_system, cash_for_performer
+
+
+def request_completion(booking_id, customer):
+    """
+    Заказчик customer завершает заказ через очередь расчетов: заказ
+    переводится в статус "Завершается", деньги переводятся позже.
+    """
+    booking = get_booking(booking_id)
+    check_status(booking, 'request_completion')
+    if booking.customer_id != customer.pk:
+        raise TransitionError(u"Это не ваш заказ")
+
+    apply_transition(booking, 'request_completion')
+    Settlement.objects.create(booking=booking)
+    return booking
+
+
+def complete_many(booking_ids, customer=None, status=Booking.RUNNING):
+    """
+    Завершение заказов booking_ids заказчиком customer (None - любые заказы,
+    для команды settle_bookings). Завершаются только заказы заказчика в
+    статусе status, остальные пропускаются. Цены заказов за
+    вычетом комиссии переводятся исполнителям - каждому исполнителю одной
+    суммой, комиссии - на счет системы одной суммой. Журнал операций, как и
+    при завершении по одному, получает проводки по каждому заказу.
+    Возвращает список (id заказа, комиссия, сумма исполнителю) в порядке id.
+    """
+    try:
+        booking_ids = sorted(set(int(pk) for pk in booking_ids))
+    except (ValueError, TypeError):
+        raise TransitionError(u"Заказ не найден")
+    if not booking_ids:
+        return []
+    customer_id = customer.pk if customer is not None else None
+
+    cursor = connection.cursor()
+    cursor.execute(COMPLETE_MANY_SQL, [Booking.COMPLETED, booking_ids, status,
+                                       customer_id, customer_id])
+    rows = cursor.fetchall()
+    if not rows:
+        return []
+    account_id, comission = rows[0][-2:]
+    if account_id is None:
+        raise TransitionError(u"Нет счета системы")
+    fields = ('id', 'customer_id', 'performer_id', 'price', 'version')
+    bookings = sorted((dict(zip(fields, row)) for row in rows),
+                      key=lambda booking: booking['id'])
+    if any(booking['performer_id'] is None for booking in bookings):
+        raise TransitionError(u"У исполнителя нет расширенного профиля")
+
+    credits = defaultdict(Decimal)
+    split = []
+    entries = []
+    for booking in bookings:
+        # Комиссия округляется для каждого заказа: проводки журнала в сумме
+        # равны зачисленным суммам
+        cash_for_system, cash_for_performer = split_price(booking['price'],
+                                                          comission)
+        credits[booking['performer_id']] += cash_for_performer
+        split.append((booking['id'], cash_for_system, cash_for_performer))
+        booking['cash_for_system'] = cash_for_system
+        booking['cash_for_performer'] = cash_for_performer
+        entries.append((booking['performer_id'], cash_for_performer,
+                        LedgerEntry.PAYOUT, booking['id']))
+        entries.append((None, cash_for_system, LedgerEntry.COMMISSION,
+                        booking['id']))
+
+    balances = settle(bookings, credits, entries, account_id,
+                      sum(cash_for_system for booking_id, cash_for_system,
+                          cash_for_performer in split))
+    bookings_completed.send(sender=Booking, bookings=bookings,
+                            old_status=status, balances=balances)
+    return split
+
+
+def settle(bookings, credits, entries, account_id, commission):
+    """
+    Денежная часть завершения заказов bookings одним запросом (SETTLE_SQL):
+    выплаты credits {id исполнителя: сумма}, снятие удержаний, проводки
+    entries (пользователь, сумма, вид, заказ) и комиссия commission на счет
+    системы account_id. Возвращает {id исполнителя: новая сумма на счету}.
+    """
+    performer_ids = sorted(credits)
+    entry_users, entry_amounts, entry_kinds, entry_bookings = zip(*entries)
+    cursor = connection.cursor()
+    cursor.execute(SETTLE_SQL, {
+        'user_ids': sorted(set(performer_ids) | set(
+            booking['customer_id'] for booking in bookings)),
+        'booking_ids': [booking['id'] for booking in bookings],
+        'performer_ids': performer_ids,
+        'credits': [credits[user_id] for user_id in performer_ids],
+        'entry_users': list(entry_users),
+        'entry_amounts': list(entry_amounts),
+        'entry_kinds': list(entry_kinds),
+        'entry_bookings': list(entry_bookings),
+        'commission': commission,
+        'account_id': account_id,
+        'stripe': random.randrange(SystemAccount.STRIPES),
+    })
+    rows = cursor.fetchall()
+    balances = dict((user_id, cash) for user_id, cash, stripes in rows
+                    if user_id in credits)
+    if len(balances) != len(credits):
+        raise TransitionError(u"У исполнителя нет расширенного профиля")
+    if not rows[0][2]:
+        # Выбранной части нет (счет создан до появления частей)
+        SystemAccount(pk=account_id).add_to_stripe(commission)
+    return balances
@@ -1,9 +1,11 @@
 from django.conf.urls import patterns, url
 from django.contrib import admin
 from .views import BookingCreate, BookingListView, serve_booking_view,\
-    complete_booking_view, OwnBookingListView, DeleteBookingView,\
+    complete_booking_view, complete_bookings_view, OwnBookingListView, DeleteBookingView,\
     approve_performer_view, UpdateBookingView,\
     BookingDetailView, CreateCommentView
+from .api import booking_feed_api_view
+from .events import booking_events_view
 
 
 admin.autodiscover()
@@ -19,6 +21,8 @@ urlpatterns = patterns('',
                            name='approve-booking'),
                        url(r'^complete/$', complete_booking_view,
                            name='complete-booking'),
+                       url(r'^complete_many/$', complete_bookings_view,
+                           name='complete-bookings'),
                        url(r'^own_booking_list/$', OwnBookingListView.as_view(),
                            name='own-booking-list'),
                        url(r'^delete_booking/(?P<pk>\d+)/$', DeleteBookingView.as_view(),
@@ -29,4 +33,8 @@ urlpatterns = patterns('',
                            name='booking-detail'),
                        url(r'^create_comment/$', CreateCommentView.as_view(),
                            name='create-comment'),
+                       url(r'^api/bookings/$', booking_feed_api_view,
+                           name='booking-api'),
+                       url(r'^events/$', booking_events_view,
+                           name='booking-events'),
                        )
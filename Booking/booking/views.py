@@ -15,18 +15,30 @@ from django.http import HttpResponse
 from django.db import transaction
 from django.contrib import messages
 from django.db import DatabaseError
-from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.auth.decorators import user_passes_test
 from django.db.models import Q
 from django.core.urlresolvers import reverse_lazy
 from django.http import Http404
 from django.views.generic.edit import UpdateView
 from django.views.generic.detail import DetailView
-from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
+from django.db.models.query import prefetch_related_objects
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 
-from .models import Booking, Comment
+from .models import Booking, Comment, FeedEntry
 from .forms import BookingForm, CommentForm
+from .idempotency import idempotent, not_stored
+from .pagination import KeysetPaginationMixin, UnionKeysetPaginator, \
+    CounterPaginator
+from .permissions import BookingPermissionResolver
+from .search import SearchKeysetPaginator
+from .transitions import TransitionError
+from . import permissions
+from . import counters
+from . import feed
+from . import search
+from . import transitions
 from Booking.views import LoginRequiredMixin
 
 import json
@@ -53,7 +65,42 @@ class BookingCreate(CreateView):
         return HttpResponseRedirect(self.get_success_url())
 
 
-class BookingListView(LoginRequiredMixin, ListView):
+class BookingActionsMixin(object):
+    """
+    Действия пользователя над заказами страницы списка (см. permissions.py).
+    В контекст шаблона передаются тройки (заказ, действие, отношение
+    пользователя к заказу). Версия заказа, действие и отношение образуют ключ
+    кэша строки заказа в шаблоне.
+    """
+
+    page_type = permissions.ALL_BOOKINGS
+
+    def get_context_data(self, **kwargs):
+        context = super(BookingActionsMixin, self).get_context_data(**kwargs)
+        bookings = list(context['object_list'])
+        if bookings and isinstance(bookings[0], FeedEntry):
+            feed.load_texts(bookings)
+        resolver = BookingPermissionResolver(self.request.user, self.page_type)
+        actions = resolver.resolve(bookings)
+
+        # Претенденты на заказ нужны только в форме подтверждения заказа
+        approvable = [o for o, action in zip(bookings, actions)
+                      if action == permissions.CAN_APPROVE]
+        if approvable:
+            prefetch_related_objects(approvable, [
+                'booking__possible_performers'
+                if isinstance(approvable[0], FeedEntry)
+                else 'possible_performers'])
+
+        relations = [resolver.relation(o) for o in bookings]
+        context['bookings'] = zip(bookings, actions, relations)
+        context['page_type'] = self.page_type
+        context['row_cache_timeout'] = settings.BOOKING_ROW_CACHE_TIMEOUT
+        return context
+
+
+class BookingListView(LoginRequiredMixin, KeysetPaginationMixin,
+                      BookingActionsMixin, ListView):
     """
     Список всех заказов.
 
@@ -72,91 +119,108 @@ class BookingListView(LoginRequiredMixin, ListView):
     заказ - заказ "Взят на исполнение"(статус "running").
 
     - Заказ не отображается в таблице - “Завершен”(статус "completed").
+
+    Список выводится постранично по ключу (date, id), см. pagination.py.
+    Заказы читаются из ленты незавершенных заказов, см. feed.py.
+
+    GET-параметр q - полнотекстовый поиск по заголовку и тексту заказа
+    (см. search.py). Результаты поиска упорядочены по рангу.
+
+    При keyset_pagination = False список выводится по номерам страниц,
+    число заказов берется из счетчиков (paginator_class).
     """
     model = Booking
     paginate_by = 20
-    queryset = Booking.objects.select_related(
-            'customer', 'performer').prefetch_related(
-            'possible_performers').order_by('-date').exclude(
-                status__exact=Booking.COMPLETED)
+    paginator_class = CounterPaginator
+    template_name = 'booking/booking_list.html'
+
+    def get_search_query(self):
+        return search.clean_query(self.request.GET.get('q'))
+
+    def get_queryset(self):
+        queryset = feed.get_feed_queryset()
+        query = self.get_search_query()
+        if query:
+            return search.search_feed(queryset, query).order_by('-rank', '-pk')
+        return queryset.order_by('-date', '-pk')
+
+    def get_count_counters(self):
+        if self.get_search_query():
+            return None
+        return counters.open_bookings_counters()
+
+    def get_keyset_paginator(self, queryset, page_size):
+        query = self.get_search_query()
+        if query:
+            return SearchKeysetPaginator(queryset, page_size, query)
+        return super(BookingListView, self).get_keyset_paginator(
+            queryset, page_size)
+
+    def get_context_data(self, **kwargs):
+        context = super(BookingListView, self).get_context_data(**kwargs)
+        context['search_enabled'] = True
+        context['search_query'] = self.get_search_query()
+        return context
 
     # Заказчик может завершить заказ
-    CAN_COMPLETE = "can_complete"
+    CAN_COMPLETE = permissions.CAN_COMPLETE
     # Исполнитель может взять заказ
-    CAN_TAKE = "can_take"
+    CAN_TAKE = permissions.CAN_TAKE
     # Возможность смотреть заказ
-    CAN_VIEW = "can_view"
+    CAN_VIEW = permissions.CAN_VIEW
     # Кнопка взятия заказа неактивна
-    NOT_ACTIVE = "not_active"
+    NOT_ACTIVE = permissions.NOT_ACTIVE
     # Заказчик может подтверждать/отклонять заказ
-    CAN_APPROVE = "can_approve"
+    CAN_APPROVE = permissions.CAN_APPROVE
 
-    def get_context_data(self, **kwargs):
-        context = super(BookingListView, self).get_context_data(**kwargs)
-        permissions_list = []
-        user = self.request.user
-
-        for o in context['object_list']:
-            # Заказ ждет выполнения
-            if o.status == Booking.PENDING:
-                if not user.has_perm("booking.add_booking"):
-                    # Тип пользователя - исполнитель.
-                    if o.customer.profile.has_enough_cash_for_booking(o.price):
-                        # Такие пользователи могут брать заказы на выполнение,
-                        # если у заказчика достаточно средств
-                        permissions_list.append(self.CAN_TAKE)
-                    else:
-                        # Иначе - кнопка взятия заказа неактивна
-                        permissions_list.append(self.NOT_ACTIVE)
-                else:
-                    if o.customer.profile.has_enough_cash_for_booking(o.price):
-                        # Остальные могут просматривать
-                        permissions_list.append(self.CAN_VIEW)
-                    else:
-                        # Иначе - кнопка взятия заказа неактивна
-                        permissions_list.append(self.NOT_ACTIVE)
-            else:
-                # Заказ кем-то исполняется
-                if o.status == Booking.RUNNING:
-                    # Текущий пользователь создавал этот заказ.
-                    if o.customer == user:
-                        # Такой пользователь может завершать заказ.
-                        permissions_list.append(self.CAN_COMPLETE)
-                    else:
-                        # Иначе - только просматривать
-                        permissions_list.append(self.CAN_VIEW)
-                else:
-                    if o.status == Booking.COMPLETED:
-                        # Если заказ завершен, его можно только просматривать.
-                        permissions_list.append(self.CAN_VIEW)
-                    else:
-                        if o.status == Booking.WAITING_FOR_APPROVAL:
-                            # Заказ ждет подтверждения заказчиком после попытки
-                            # исполнителя его взять
-                            if not user.has_perm("booking.add_booking"):
-                                # Другие исполнители тоже могут пытаться
-                                # взять этот заказ, если они еще не делали
-                                # таких попыток
-                                if not user in o.possible_performers.all():
-                                    permissions_list.append(self.CAN_TAKE)
-                                else:
-                                    permissions_list.append(self.CAN_VIEW)
-                            else:
-                                # Заказчик может подтрверждать/отклонять,
-                                # если создавал этот заказ
-                                if o.customer == user:
-                                    permissions_list.append(self.CAN_APPROVE)
-                                else:
-                                    permissions_list.append(self.CAN_VIEW)
-
-        context['bookings'] = zip(context['object_list'], permissions_list)
-        context['page_type'] = "all_bookings"
+    page_type = permissions.ALL_BOOKINGS
 
-        return context
+
+def transition_response(request, status_message, success, **data):
+    """
+    Ответ на запрос перехода заказа: JSON для AJAX-запроса (с дополнительными
+    полями data), иначе сообщение пользователю и возврат к списку заказов.
+    Отказ не сохраняется для повторов с ключом идемпотентности.
+    """
+    if request.is_ajax():
+        data['request_status'] = status_message
+        data['success'] = success
+        response = HttpResponse(json.dumps(data, cls=DjangoJSONEncoder),
+                                content_type="application/json")
+    else:
+        if success:
+            messages.info(request, status_message)
+        else:
+            messages.error(request, status_message)
+        response = HttpResponseRedirect("/booking/booking_list/")
+    return response if success else not_stored(response)
+
+
+def get_booking_id(request, ajax_parameter):
+    """
+    id заказа из запроса: AJAX-запрос передает его параметром ajax_parameter,
+    форма - параметром booking
+    """
+    return request.POST.get(ajax_parameter if request.is_ajax() else 'booking')
+
+
+def run_transition(request, transition, *args):
+    """
+    Переход заказа (функция из transitions.py) в транзакции. Возвращает
+    (результат перехода, None) либо (None, ответ с сообщением об ошибке).
+    """
+    try:
+        with transaction.atomic():
+            return transition(*args), None
+    except TransitionError as e:
+        return None, transition_response(request, e.message, False)
+    except DatabaseError:
+        return None, transition_response(request, u'Внутренняя ошибка', False)
 
 
 @login_required
 @user_passes_test(lambda u: u.has_perm('booking.perform_perm'))
+@idempotent
 def serve_booking_view(request):
     """
     Один из исполнителей пытается взять заказ.
@@ -170,86 +234,20 @@ def serve_booking_view(request):
     заказ на исполнение.
     """
     if request.method == "POST":
-        if request.is_ajax():
-            try:
-                with transaction.atomic():
-                    # Проверка текущего статуса заказа
-                    booking = Booking.objects.select_related(
-                        'customer', 'performer').prefetch_related(
-                        'possible_performers').get(id=request.POST['id'])
-
-                    booking_status = booking.get_status()
-                    if booking_status != Booking.PENDING and \
-                        booking_status != Booking.WAITING_FOR_APPROVAL:
-                        status_message = u"Неверный статус заказа"
-                    else:
-                        if request.user in booking.possible_performers.all():
-                            status_message = u"Вы уже подавали заявку на этот заказ"
-                            return HttpResponse(json.dumps({'request_status':
-                                status_message}),
-                                content_type="application/json")
-
-                        customer = booking.get_customer()
-                        try:
-                            is_enough_cash = \
-                                customer.profile.has_enough_cash_for_booking(
-                                    booking.price
-                                )
-                        except ObjectDoesNotExist:
-                            status_message = \
-                                u'У создателя заказа нет расширенного профиля'
-                            return HttpResponse(json.dumps({'request_status':
-                                status_message}),
-                                content_type="application/json")
-                        # Проверка средств на счету пользователя.
-                        if is_enough_cash:
-                            booking.possible_performers.add(request.user)
-                            booking.set_status(Booking.WAITING_FOR_APPROVAL)
-                            status_message =\
-                             u"Заявка на выполнение ожидает подтверждения заказчиком."
-                        else:
-                            status_message = u"Недостаточно средств"
-            except DatabaseError:
-                # Проблема с generating relationships
-                status_message = u'Внутренняя ошибка'
-            return HttpResponse(json.dumps({'request_status': status_message}),
-                                content_type="application/json")
-        else:
-            try:
-                with transaction.atomic():
-                    booking = Booking.objects.select_related(
-                        'customer', 'performer').prefetch_related(
-                        'possible_performers').get(id=request.POST['booking'])
-
-                    booking_status = booking.get_status()
-                    if booking_status != Booking.PENDING and \
-                        booking_status != Booking.WAITING_FOR_APPROVAL:
-                        messages.error(request, u'Неверный статус заказа')
-                    else:
-                        if request.user in booking.possible_performers.all():
-                            messages.error(request, u"Вы уже подавали заявку на этот заказ")
-                            return HttpResponseRedirect("/booking/booking_list/")
-
-                        customer = booking.get_customer()
-                        is_enough_cash = \
-                            customer.profile.has_enough_cash_for_booking(
-                                booking.price
-                            )
-                        if is_enough_cash:
-                            messages.info(
-                                request, u"Заявка на выполнение ожидает подтверждения заказчиком.")
-                            booking.possible_performers.add(request.user)
-                            booking.set_status(Booking.WAITING_FOR_APPROVAL)
-                        else:
-                            messages.error(request, u'Недостаточно средств')
-            except DatabaseError:
-                messages.error(request, u'Внутренняя ошибка')
-            return HttpResponseRedirect("/booking/booking_list/")
+        booking, error = run_transition(request, transitions.serve,
+                                        get_booking_id(request, 'id'),
+                                        request.user)
+        if error is not None:
+            return error
+        return transition_response(
+            request,
+            u"Заявка на выполнение ожидает подтверждения заказчиком.", True)
     return HttpResponse("")
 
 
 @login_required
 @user_passes_test(lambda u: u.has_perm('booking.add_booking'))
+@idempotent
 def approve_performer_view(request):
     """
     Заказчик подтверждает одному из исполнителей списка возможных заказчиков
@@ -272,107 +270,34 @@ def approve_performer_view(request):
     заказчику, сделавшему этот заказ.
     """
     if request.method == "POST":
-        if request.is_ajax():
-            try:
-                with transaction.atomic():
-                    booking = Booking.objects.select_related(
-                        'customer', 'performer').prefetch_related(
-                        'possible_performers').get(id=request.POST['booking_id'])
-
-                    # Проверка того, что текущий пользователь создавал заказ
-                    customer = booking.get_customer()
-                    if request.user != customer:
-                        status_message = u"Это не Ваш заказ"
-                        return HttpResponse(json.dumps({'request_status':
-                            status_message}),
-                            content_type="application/json")
-
-                    # Проверка текущего статуса заказа
-                    booking_status = booking.get_status()
-                    if booking_status != Booking.WAITING_FOR_APPROVAL:
-                        status_message = u"Неверный статус заказа"
-                    else:
-                        try:
-                            is_enough_cash = \
-                                customer.profile.has_enough_cash_for_booking(
-                                    booking.price
-                                )
-                        except ObjectDoesNotExist:
-                            status_message = \
-                                u'У создателя заказа нет расширенного профиля'
-                            return HttpResponse(json.dumps({'request_status':
-                                status_message}),
-                                content_type="application/json")
-                        # Проверка средств на счету пользователя.
-                        if is_enough_cash:
-                            # Их вычет со счета. И назначение заказу исполнителя
-                            customer.profile.decrease_cash(booking.price)
-                            customer.profile.save()
-                            booking.set_status(Booking.RUNNING)
-                            status_message = u"Заказ в обработке. Деньги перешли от заказчика на временный системный счет."
-                        else:
-                            status_message = u"Недостаточно средств"
-            except DatabaseError:
-                # Проблема с generating relationships
-                status_message = u'Внутренняя ошибка'
-            return HttpResponse(json.dumps({'request_status': status_message}),
-                                content_type="application/json")
-        else:
-            try:
-                with transaction.atomic():
-                    booking = Booking.objects.select_related(
-                        'customer', 'performer').prefetch_related(
-                        'possible_performers').get(id=request.POST['booking'])
-
-                    # Проверка того, что текущий пользователь создавал заказ
-                    customer = booking.get_customer()
-                    if request.user != customer:
-                        messages.error(request, u'Это не Ваш заказ')
-                        return HttpResponseRedirect("/booking/booking_list/")
-
-                    booking_status = booking.get_status()
-                    if booking_status != Booking.WAITING_FOR_APPROVAL:
-                        messages.error(request, u'Неверный статус заказа')
-                    else:
-                        chosen_performer_id = request.POST.get('possible_performer', None)
-                        if chosen_performer_id is not None:
-                            chosen_performer_id = int(chosen_performer_id)
-                        else:
-                            messages.error(request, u'Не указан исполнитель')
-                            return HttpResponseRedirect("/booking/booking_list/")
-
-                        performers = booking.possible_performers.all()
-                        performers_ids = [performer.id for performer in performers]
-
-                        if not chosen_performer_id in performers_ids:
-                            messages.error(request, u'Исполнитель указан неверно')
-                            return HttpResponseRedirect("/booking/booking_list/")
-
-                        performer = User.objects.get(id=chosen_performer_id)
-
-                        customer = booking.get_customer()
-                        is_enough_cash = \
-                            customer.profile.has_enough_cash_for_booking(
-                                booking.price
-                            )
-                        if is_enough_cash:
-                            booking.set_performer(performer)
-                            booking.possible_performers.clear()
-                            customer.profile.decrease_cash(booking.price)
-                            customer.profile.save()
-                            messages.info(
-                                request, u"Заказ в обработке. Деньги перешли от заказчика на временный системный счет.")
-                            booking.set_status(Booking.RUNNING)
-                        else:
-                            messages.error(request, u'Недостаточно средств')
-            except DatabaseError:
-                messages.error(request, u'Внутренняя ошибка')
-            return HttpResponseRedirect("/booking/booking_list/")
+        booking, error = run_transition(
+            request, transitions.approve, get_booking_id(request, 'booking_id'),
+            request.user, request.POST.get('possible_performer'))
+        if error is not None:
+            return error
+        return transition_response(
+            request, u"Заказ в обработке. Деньги перешли от заказчика на "
+                     u"временный системный счет.", True)
     return HttpResponse("")
 
 
+def request_completion(request, booking_id):
+    """
+    Завершение заказа через очередь расчетов: заказ получает статус
+    “Завершается”, суммы расчета приходят позже событием живой ленты.
+    """
+    booking, error = run_transition(request, transitions.request_completion,
+                                    booking_id, request.user)
+    if error is not None:
+        return error
+    return transition_response(
+        request, u"Заказ завершается. Суммы комиссии и оплаты исполнителю "
+                 u"появятся после расчета.", True, status=Booking.COMPLETING)
+
+
 @login_required
 @permission_required('booking.add_booking', raise_exception=True)
+@idempotent
 def complete_booking_view(request):
     """
     Перевод средств со счета системы на счет исполнителя заказчиком и
@@ -385,148 +310,122 @@ def complete_booking_view(request):
     части суммы. Заказу назначается статус “Завершен”. Заказчику выводятся
     сообщения с указанием этих сумм. Страница обновляется. Заказ исчезает из
     ленты как выполнившийся.
+
+    При BOOKING_SETTLEMENT_ASYNC деньги переводит обработчик очереди
+    расчетов (см. request_completion).
     """
     if request.method == "POST":
-        if request.is_ajax():
-            try:
-                with transaction.atomic():
-                    booking = Booking.objects.select_related(
-                        'customer', 'performer').get(id=request.POST['id'])
-
-                    booking_status = booking.get_status()
-                    if booking_status != Booking.RUNNING:
-                        status_message = u"Неверный статус заказа"
-                    else:
-                        booking_customer = booking.get_customer()
-                        if booking_customer != request.user:
-                            status_message = u"Это не ваш заказ"
-                        else:
-                            cash_for_system, cash_for_performer = booking.complete()
-                            status_message = \
-                            (u"Заказ завершен. С суммы заказа считана комиссия"
-                       u" в размере %(cash_for_system)g. %(cash_for_performer)g"
-                            u" переведено исполнителю.") % {
-                            'cash_for_system': cash_for_system,
-                            'cash_for_performer': cash_for_performer }
-
-            except DatabaseError:
-                # Проблема с generating relationships
-                status_message = u'Внутренняя ошибка'
-            return HttpResponse(json.dumps({'request_status': status_message}),
-                                content_type="application/json")
-        else:
-            try:
-                with transaction.atomic():
-                    booking = Booking.objects.select_related(
-                        'customer', 'performer').get(id=request.POST['booking'])
-
-                    booking_status = booking.get_status()
-                    if booking_status != Booking.RUNNING:
-                        messages.error(request, u'Неверный статус заказа')
-                    else:
-                        booking_customer = booking.get_customer()
-                        if booking_customer != request.user:
-                            status_message = \
-                                u"Не этот пользователь создавал заказ"
-                            messages.error(request, status_message)
-                        else:
-                            cash_for_system, cash_for_performer = booking.complete()
-                            status_message = \
-                            (u"Заказ завершен. С суммы заказа считана комиссия"
-                       u" в размере %(cash_for_system)g. %(cash_for_performer)g"
-                            u" переведено исполнителю.") % {
-                            'cash_for_system': cash_for_system,
-                            'cash_for_performer': cash_for_performer }
-                            messages.info(request, status_message)
-            except DatabaseError:
-                messages.error(request, u'Внутренняя ошибка')
-            return HttpResponseRedirect("/booking/booking_list/")
+        booking_id = get_booking_id(request, 'id')
+        if settings.BOOKING_SETTLEMENT_ASYNC:
+            return request_completion(request, booking_id)
+        split, error = run_transition(request, transitions.complete,
+                                      booking_id, request.user)
+        if error is not None:
+            return error
+        cash_for_system, cash_for_performer = split
+        status_message = (
+            u"Заказ завершен. С суммы заказа считана комиссия"
+            u" в размере %(cash_for_system)g. %(cash_for_performer)g"
+            u" переведено исполнителю.") % {
+                'cash_for_system': cash_for_system,
+                'cash_for_performer': cash_for_performer}
+        return transition_response(request, status_message, True)
+    return HttpResponse("")
 
+
+@login_required
+@permission_required('booking.add_booking', raise_exception=True)
+def complete_bookings_view(request):
+    """
+    Завершение заказчиком нескольких выполняющихся заказов одним запросом
+    (заказы передаются параметром booking, можно указать несколько раз).
+
+    Деньги переводятся так же, как при завершении каждого заказа отдельно
+    (см. complete_booking_view), но в одной транзакции. Заказы не в статусе
+    “Выполняется” и чужие заказы пропускаются. Ответ на AJAX-запрос содержит
+    комиссию и сумму исполнителю для каждого завершенного заказа (bookings)
+    и id пропущенных заказов (skipped).
+    """
+    if request.method == "POST":
+        booking_ids = request.POST.getlist('booking')
+        split, error = run_transition(request, transitions.complete_many,
+                                      booking_ids, request.user)
+        if error is not None:
+            return error
+        completed = set(booking_id for booking_id, cash_for_system,
+                        cash_for_performer in split)
+        skipped = sorted(set(booking_ids) - set(
+            str(booking_id) for booking_id in completed))
+        if not split:
+            return transition_response(
+                request, u"Нет выполняющихся заказов для завершения", False,
+                bookings=[], skipped=skipped)
+        status_message = (
+            u"Завершено заказов: %(count)s. С сумм заказов считана комиссия"
+            u" в размере %(cash_for_system)g. %(cash_for_performer)g"
+            u" переведено исполнителям.") % {
+                'count': len(split),
+                'cash_for_system': sum(row[1] for row in split),
+                'cash_for_performer': sum(row[2] for row in split)}
+        return transition_response(
+            request, status_message, True,
+            bookings=[{'id': booking_id,
+                       'cash_for_system': cash_for_system,
+                       'cash_for_performer': cash_for_performer}
+                      for booking_id, cash_for_system, cash_for_performer
+                      in split],
+            skipped=skipped)
     return HttpResponse("")
 
 
-class OwnBookingListView(LoginRequiredMixin, ListView):
+class OwnBookingListView(LoginRequiredMixin, KeysetPaginationMixin,
+                         BookingActionsMixin, ListView):
     """
-    Список заказов самого пользователя
+    Список заказов самого пользователя.
+
+    Заказы пользователя как заказчика и как исполнителя выбираются отдельно
+    по индексам (customer_id, date, id) и (performer_id, date, id)
+    и объединяются (UNION).
     """
 
-    CAN_COMPLETE = "can_complete"
-    CAN_TAKE = "can_take"
-    CAN_VIEW = "can_view"
+    CAN_COMPLETE = permissions.CAN_COMPLETE
+    CAN_TAKE = permissions.CAN_TAKE
+    CAN_VIEW = permissions.CAN_VIEW
     # Кнопка взятия заказа неактивна
-    NOT_ACTIVE = "not_active"
+    NOT_ACTIVE = permissions.NOT_ACTIVE
     # Заказчик может подтверждать/отклонять заказ
-    CAN_APPROVE = "can_approve"
+    CAN_APPROVE = permissions.CAN_APPROVE
+
+    page_type = permissions.OWN_BOOKINGS
 
     model = Booking
     paginate_by = 20
+    paginator_class = CounterPaginator
     template_name = 'booking/booking_list.html'
 
+    def get_count_counters(self):
+        return counters.own_bookings_counters(self.request.user.pk)
+
+    def get_branches(self):
+        """
+        Заказы, созданные пользователем, и заказы, которые он исполняет
+        """
+        return [Q(customer=self.request.user), Q(performer=self.request.user)]
+
+    def get_base_queryset(self):
+        return Booking.objects.select_related(
+            'customer', 'performer').order_by('-date', '-pk')
+
     def get_queryset(self):
-        queryset = Booking.objects.select_related(
-            'customer', 'performer').prefetch_related(
-            'possible_performers').order_by('-date').filter(
-                Q(customer=self.request.user) | Q(performer=self.request.user)
-            )
-        return queryset
+        branches = self.get_branches()
+        return self.get_base_queryset().filter(branches[0] | branches[1])
 
-    def get_context_data(self, **kwargs):
-        context = super(OwnBookingListView, self).get_context_data(**kwargs)
-        permissions_list = []
-        user = self.request.user
-
-        for o in context['object_list']:
-            # Заказ ждет выполнения
-            if o.status == Booking.PENDING:
-                if not user.has_perm("booking.add_booking"):
-                    # Тип пользователя - исполнитель.
-                    if o.customer.profile.has_enough_cash_for_booking(o.price):
-                        # Такие пользователи могут брать заказы на выполнение,
-                        # если у заказчика достаточно средств
-                        permissions_list.append(self.CAN_TAKE)
-                    else:
-                        # Иначе - кнопка взятия заказа неактивна
-                        permissions_list.append(self.NOT_ACTIVE)
-                else:
-                    if o.customer.profile.has_enough_cash_for_booking(o.price):
-                        # Остальные могут просматривать
-                        permissions_list.append(self.CAN_VIEW)
-                    else:
-                        # Иначе - кнопка взятия заказа неактивна
-                        permissions_list.append(self.NOT_ACTIVE)
-            else:
-                # Заказ кем-то исполняется
-                if o.status == Booking.RUNNING:
-                    # Текущий пользователь создавал этот заказ.
-                    if o.customer == user:
-                        # Такой пользователь может завершать заказ.
-                        permissions_list.append(self.CAN_COMPLETE)
-                    else:
-                        # Иначе - только просматривать
-                        permissions_list.append(self.CAN_VIEW)
-                else:
-                    if o.status == Booking.COMPLETED:
-                        # Если заказ завершен, его можно только просматривать.
-                        permissions_list.append(self.CAN_VIEW)
-                    else:
-                        if o.status == Booking.WAITING_FOR_APPROVAL:
-                            # Заказ ждет подтверждения заказчиком после попытки
-                            # исполнителя его взять
-                            if not user.has_perm("booking.add_booking"):
-                                # Для исполнителя кнопка заказа неактивна
-                                permissions_list.append(self.NOT_ACTIVE)
-                            else:
-                                # Заказчик может подтрверждать/отклонять,
-                                # если создавал этот заказ
-                                if o.customer == user:
-                                    permissions_list.append(self.CAN_APPROVE)
-                                else:
-                                    permissions_list.append(self.CAN_VIEW)
-
-
-        context['bookings'] = zip(context['object_list'], permissions_list)
-        context['page_type'] = "own_bookings"
-        return context
+    def get_keyset_paginator(self, queryset, page_size):
+        """
+        Каждая ветвь выбирается по своему индексу, см. UnionKeysetPaginator
+        """
+        return UnionKeysetPaginator(self.get_base_queryset(), page_size,
+                                    self.keyset_keys, self.get_branches())
 
 
 class DeleteBookingView(DeleteView):
@@ -560,17 +459,22 @@ class DeleteBookingView(DeleteView):
         booking = super(DeleteBookingView, self).get_object()
         if booking.customer != self.request.user:
             raise Http404
-        # Если заказ выполняется, удалять его нельзя
+        # Если заказ выполняется или по нему идет расчет, удалять его нельзя
         status = booking.get_status()
-        if status == Booking.RUNNING or status == Booking.WAITING_FOR_APPROVAL:
+        if status in (Booking.RUNNING, Booking.WAITING_FOR_APPROVAL,
+                      Booking.COMPLETING):
             raise Http404
 
         return booking
 
     def delete(self, request, *args, **kwargs):
-        Comment.objects.filter(booking=self.get_object()).delete()
-        self.get_object().possible_performers.clear()
-        return super(DeleteBookingView, self).delete(request, *args, **kwargs)
+        """ Заказ загружается один раз """
+        self.object = self.get_object()
+        Comment.objects.filter(booking=self.object).delete()
+        self.object.possible_performers.clear()
+        success_url = self.get_success_url()
+        self.object.delete()
+        return HttpResponseRedirect(success_url)
 
 
 class UpdateBookingView(UpdateView):
@@ -607,7 +511,8 @@ class BookingDetailView(DetailView):
 
     def get_context_data(self, **kwargs):
         context = super(BookingDetailView, self).get_context_data(**kwargs)
-        context['comments'] = reversed(self.object.booking_comments.all())
+        context['comments'] = reversed(
+            self.object.booking_comments.select_related('creator'))
         return context
 
     @method_decorator(login_required)